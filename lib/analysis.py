@@ -0,0 +1,289 @@
+"""Spectral analysis of vibration captures.
+
+welch_psd       -- per axis Welch power spectral density of a finished capture
+find_peaks      -- resonance peaks of a PSD with frequency, amplitude and Q
+analyze_capture -- both of the above for a capture_file.CaptureReader
+segment_capture -- per move segments of a capture, between its MARK events
+analyze_segments, compare_segments -- per segment RMS and peaks, and their statistics per label
+StreamingSTFT   -- rolling spectrogram updated a chunk at a time during a capture
+
+Everything works on (N, axis) numpy arrays and is vectorized over
+segments and axes, no python loop runs per sample or per segment.
+"""
+
+import collections
+import threading
+
+import numpy
+from numpy.lib.stride_tricks import as_strided
+
+
+def _segments(samples, segment_length, step):
+    """Read-only (segments, segment_length, axis) view of overlapping segments."""
+    count = 1 + (len(samples) - segment_length) // step
+    row_stride, column_stride = samples.strides
+    return as_strided(samples, shape=(count, segment_length, samples.shape[1]),
+                      strides=(row_stride * step, row_stride, column_stride), writeable=False)
+
+
+def _spectra(segments, window):
+    """One sided power spectra of detrended, windowed segments, shape (segments, frequencies, axis)."""
+    detrended = segments - segments.mean(axis=1, keepdims=True)
+    spectrum = numpy.fft.rfft(detrended * window[None, :, None], axis=1)
+    return spectrum.real ** 2 + spectrum.imag ** 2
+
+
+def _density_scale(power, sample_rate, window, segment_length):
+    """Converts summed power spectra into a one sided density, in place."""
+    power /= sample_rate * (window ** 2).sum()
+    # every bin but DC (and Nyquist, for even lengths) holds the energy of the negative frequencies too
+    if segment_length % 2:
+        power[..., 1:, :] *= 2
+    else:
+        power[..., 1:-1, :] *= 2
+    return power
+
+
+def welch_psd(samples, sample_rate, segment_length=1024, overlap=0.5, max_segments_in_memory=64):
+    """Per axis Welch power spectral density.
+
+    samples -- (N, axis) array, or (N,) for a single axis.
+    sample_rate -- Hz.
+    segment_length -- samples per FFT segment, shortened to N for short captures.
+    overlap -- fraction of overlap between consecutive segments.
+    max_segments_in_memory -- segments transformed at once, bounds the memory use.
+    Returns (frequencies, psd) where psd has shape (frequencies, axis), in unit^2/Hz.
+    """
+    samples = numpy.asarray(samples, dtype=numpy.float64)
+    if samples.ndim == 1:
+        samples = samples[:, None]
+    if len(samples) < 2:
+        raise ValueError("Not enough samples for a spectrum")
+
+    segment_length = min(segment_length, len(samples))
+    step = max(1, int(segment_length * (1.0 - overlap)))
+    window = numpy.hanning(segment_length)
+
+    samples = numpy.ascontiguousarray(samples)
+    segments = _segments(samples, segment_length, step)
+
+    power = numpy.zeros((segment_length // 2 + 1, samples.shape[1]))
+    for start in range(0, len(segments), max_segments_in_memory):
+        power += _spectra(segments[start:start + max_segments_in_memory], window).sum(axis=0)
+    power /= len(segments)
+
+    frequencies = numpy.fft.rfftfreq(segment_length, 1.0 / sample_rate)
+    return frequencies, _density_scale(power, sample_rate, window, segment_length)
+
+
+def find_peaks(frequencies, psd, max_peaks=10, min_frequency=1.0, threshold=10.0):
+    """Finds the resonance peaks of a single axis PSD.
+
+    threshold -- a peak must exceed the median of the PSD by this factor.
+    Returns a list of dicts with frequency (Hz), amplitude (PSD value) and
+    q (quality factor: frequency / half-power bandwidth), strongest first.
+    """
+    psd = numpy.asarray(psd, dtype=numpy.float64)
+    if len(psd) < 3:
+        return []
+
+    floor = numpy.median(psd) * threshold
+    inner = psd[1:-1]
+    candidates = numpy.nonzero((inner > psd[:-2]) & (inner >= psd[2:]) & (inner > floor) &
+                               (frequencies[1:-1] >= min_frequency))[0] + 1
+    candidates = candidates[numpy.argsort(psd[candidates])[::-1]][:max_peaks]
+
+    resolution = frequencies[1] - frequencies[0]
+    peaks = []
+    for index in candidates:
+        # parabolic interpolation of the peak position between bins
+        left, centre, right = psd[index - 1], psd[index], psd[index + 1]
+        curvature = left - 2 * centre + right
+        shift = 0.5 * (left - right) / curvature if curvature else 0.0
+        frequency = frequencies[index] + shift * resolution
+
+        bandwidth = _half_power_bandwidth(frequencies, psd, index)
+        peaks.append(dict(
+            frequency=float(frequency),
+            amplitude=float(centre),
+            q=float(frequency / bandwidth) if bandwidth > 0 else None
+        ))
+    return peaks
+
+
+def _half_power_bandwidth(frequencies, psd, index):
+    """Width between the -3dB crossings around a peak, linearly interpolated."""
+    half = psd[index] / 2.0
+
+    below = numpy.nonzero(psd[:index] <= half)[0]
+    above = numpy.nonzero(psd[index + 1:] <= half)[0]
+    if not len(below) or not len(above):
+        return 0.0
+
+    i = below[-1]
+    low = numpy.interp(half, [psd[i], psd[i + 1]], [frequencies[i], frequencies[i + 1]])
+    j = index + 1 + above[0]
+    high = numpy.interp(half, [psd[j], psd[j - 1]], [frequencies[j], frequencies[j - 1]])
+    return high - low
+
+
+def analyze_capture(reader, segment_length=1024, max_peaks=10, start=0, stop=None):
+    """Welch PSD and peak list of every axis of a capture.
+
+    reader -- a capture_file.CaptureReader.
+    start, stop -- frame range to analyze, the whole capture by default.
+    Returns a dict with the frequencies, and per axis the psd and the peaks.
+    """
+    samples = reader.samples(start, stop)
+    frequencies, psd = welch_psd(samples, reader.sample_rate, segment_length)
+
+    axes = dict()
+    for column, name in enumerate(reader.axis):
+        axes[name] = dict(psd=psd[:, column], peaks=find_peaks(frequencies, psd[:, column], max_peaks))
+    return dict(sample_rate=reader.sample_rate, frequencies=frequencies, axes=axes)
+
+
+def segment_capture(reader, labels=None):
+    """Splits a capture at its marker events.
+
+    A segment runs from a marker to the next one, the last one to the end
+    of the capture. The frame boundaries come from a binary search of the
+    marker times in the frame times, the samples themselves are not read.
+    labels -- keep only the segments of these labels, all by default.
+    Returns a list of dicts with label, start, stop (frames), start_time and end_time.
+    """
+    marks = reader.marks()
+    if not marks:
+        return []
+
+    times = reader.times()
+    bounds = numpy.searchsorted(times, [mark["time"] for mark in marks], side="left")
+    stops = numpy.append(bounds[1:], len(times))
+
+    segments = []
+    for mark, start, stop in zip(marks, bounds, stops):
+        if labels is not None and mark["label"] not in labels:
+            continue
+        start, stop = int(start), int(stop)
+        segments.append(dict(
+            label=mark["label"],
+            start=start,
+            stop=stop,
+            start_time=float(mark["time"]),
+            end_time=float(times[stop - 1]) if stop > start else float(mark["time"])
+        ))
+    return segments
+
+
+def analyze_segments(reader, segments=None, segment_length=256, max_peaks=3, include_psd=False):
+    """RMS and resonance peaks of every segment of a capture.
+
+    segments -- from segment_capture(), all the segments of the capture by default.
+    segment_length -- Welch segment length, short segments use their own length.
+    Returns the segments, each with per axis rms (around the mean) and
+    peaks, plus frequencies and psd if include_psd is True.
+    Segments of less than 2 samples are skipped.
+    """
+    if segments is None:
+        segments = segment_capture(reader)
+
+    results = []
+    for segment in segments:
+        samples = reader.samples(segment["start"], segment["stop"])
+        if len(samples) < 2:
+            continue
+
+        result = dict(segment)
+        result["rms"] = dict(zip(reader.axis, (float(v) for v in samples.std(axis=0))))
+        frequencies, psd = welch_psd(samples, reader.sample_rate, segment_length)
+        result["peaks"] = dict((name, find_peaks(frequencies, psd[:, column], max_peaks))
+                               for column, name in enumerate(reader.axis))
+        if include_psd:
+            result["frequencies"] = frequencies
+            result["psd"] = psd
+        results.append(result)
+    return results
+
+
+def compare_segments(results):
+    """Groups analyze_segments() results by label.
+
+    Returns per label the segment count and the mean, standard deviation,
+    minimum and maximum of the per axis RMS, e.g. to compare the
+    acceleration and deceleration phases over all the passes of a test.
+    """
+    groups = collections.OrderedDict()
+    for result in results:
+        groups.setdefault(result["label"], []).append(result)
+
+    comparison = collections.OrderedDict()
+    for label, group in groups.items():
+        axis = list(group[0]["rms"])
+        rms = numpy.array([[result["rms"][name] for name in axis] for result in group])
+        comparison[label] = dict(
+            count=len(group),
+            rms=dict((name, dict(mean=float(rms[:, i].mean()), std=float(rms[:, i].std()),
+                                 min=float(rms[:, i].min()), max=float(rms[:, i].max())))
+                     for i, name in enumerate(axis))
+        )
+    return comparison
+
+
+class StreamingSTFT(object):
+    """Short-time Fourier transform fed a chunk at a time.
+
+    Only the last segment_length - hop samples are kept between updates, so
+    no sample is transformed twice beyond the segment overlap. The newest
+    max_frames spectra are kept as a rolling spectrogram. Instances are
+    capture listeners (see mpu6050.listeners), fed by the consumer thread
+    while spectrogram() is read from any other.
+    """
+
+    def __init__(self, sample_rate, axis_count, segment_length=256, hop=128, max_frames=600):
+        self.sample_rate = float(sample_rate)
+        self.segment_length = segment_length
+        self.hop = hop
+        self.window = numpy.hanning(segment_length)
+        self.frequencies = numpy.fft.rfftfreq(segment_length, 1.0 / self.sample_rate)
+        self.pending = numpy.empty((0, axis_count))
+        self.frames = collections.deque(maxlen=max_frames)
+        self.times = collections.deque(maxlen=max_frames)
+        self.consumed = 0  # samples dropped from the head of pending
+        self.lock = threading.Lock()
+
+    def __call__(self, samples):
+        """Capture listener, receives the decoded (N, axis) samples."""
+        with self.lock:
+            self.update(samples)
+
+    def update(self, samples):
+        """Adds an (N, axis) chunk of samples.
+
+        Returns the (new frames, frequencies, axis) array of spectra completed by this chunk.
+        """
+        self.pending = numpy.concatenate((self.pending, samples))
+        if len(self.pending) < self.segment_length:
+            return numpy.empty((0, len(self.frequencies), self.pending.shape[1]))
+
+        segments = _segments(numpy.ascontiguousarray(self.pending), self.segment_length, self.hop)
+        power = _density_scale(_spectra(segments, self.window), self.sample_rate, self.window,
+                               self.segment_length)
+
+        centres = (self.consumed + numpy.arange(len(segments)) * self.hop +
+                   self.segment_length / 2.0) / self.sample_rate
+        self.frames.extend(power)
+        self.times.extend(centres)
+
+        used = len(segments) * self.hop
+        self.pending = self.pending[used:]
+        self.consumed += used
+        return power
+
+    def spectrogram(self):
+        """Returns (times, frequencies, power) of the rolling spectrogram,
+        power with shape (frames, frequencies, axis)."""
+        with self.lock:
+            if not self.frames:
+                return (numpy.empty(0), self.frequencies,
+                        numpy.empty((0, len(self.frequencies), self.pending.shape[1])))
+            return numpy.asarray(self.times), self.frequencies, numpy.asarray(self.frames)
@@ -0,0 +1,266 @@
+"""Throughput benchmark of the MPU-6050 capture pipeline.
+
+Drives mpu6050.start_capture against a simulated bus at increasing sample
+rates, with and without the gyro axes, and reports for every run the
+sustained samples/s, CPU time and I2C transactions per sample and the
+overflow/packet loss counts. Per stage costs (decode, CSV formatting,
+binary writes) are measured separately on synthetic bursts, the import
+time of the plugin modules in a fresh interpreter, the cost they add to
+OctoPrint startup, and the start latency of cold and armed (standby)
+sensors.
+
+Usage:
+
+    python -m lib.benchmark [--rates 100,250,500,1000] [--duration 5] [--output results.json]
+
+The results are printed as JSON, to compare runs across releases.
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy
+
+from . import capture_file
+from . import fifo_decoder
+from .mpu6050 import mpu6050
+from .sample_clock import monotonic
+from .simulated_bus import SimulatedBus, SimulatedMPU6050, VibrationWaveform
+from .standby import StandbySensor
+
+AXIS_SETS = {
+    "accel": ["X", "Y", "Z"],
+    "accel_gyro": ["X", "Y", "Z", "GX", "GY", "GZ"]
+}
+
+# imported with the plugin, then on first use
+IMPORT_MODULES = ["lib.gcode_runner", "lib.script_templates", "lib.wait_strategy", "numpy", "lib.mpu6050",
+                  "lib.capture_session", "lib.capture_catalog", "lib.analysis", "octoprint_shooting"]
+
+process_time = getattr(time, "process_time", time.clock if hasattr(time, "clock") else time.time)
+
+
+def run_capture(sample_rate, axis, duration, basefolder, latency=0.0001, byte_time=0.0000225,
+                wait_mode="sleep"):
+    """Runs one simulated capture and returns its figures as a dict."""
+    device = SimulatedMPU6050(VibrationWaveform([(45.0, 0.5), (120.0, 0.2)], seed=0))
+    bus = SimulatedBus({0x68: device}, latency=latency, byte_time=byte_time)
+
+    logger = logging.getLogger("lib.benchmark.capture")
+    sensor = mpu6050(0x68, bus=bus, logger=logger, basefolder=basefolder, wait_mode=wait_mode)
+    sensor.configure(sample_rate=sample_rate, capture_gyro="GX" in axis)
+
+    bus.reset_counters()
+    cpu_start = process_time()
+    wall_start = time.time()
+    sensor.start()
+    time.sleep(duration)
+    sensor.stop()
+    sensor.join()
+    wall = time.time() - wall_start
+    cpu = process_time() - cpu_start
+
+    samples = max(sensor.packet_count, 1)
+    return dict(
+        sample_rate=sensor.get_sample_rate(),
+        axis=list(axis),
+        wait_mode=wait_mode,
+        duration=wall,
+        samples=sensor.packet_count,
+        samples_per_second=sensor.packet_count / wall,
+        samples_generated=device.samples_generated,
+        packet_loss=sensor.packet_loss,
+        overflow_resets=sensor.overflow_count,
+        recovered_packets=sensor.recovered_packets,
+        drain_budget=sensor.capture_budget.stats(),
+        device_overflows=device.overflows,
+        cpu_time_per_sample=cpu / samples,
+        cpu_load=cpu / wall,
+        i2c_transactions=bus.transactions,
+        i2c_transactions_per_sample=bus.transactions / float(samples),
+        i2c_bytes_per_sample=bus.bytes_transferred / float(samples),
+        i2c_busy_fraction=bus.busy_time / wall
+    )
+
+
+def run_stages(axis, samples=100000, repeat=5):
+    """Measures the CPU time per sample of each processing stage."""
+    capture_gyro = "GX" in axis
+    waveform = VibrationWaveform(seed=0)
+    accel, gyro = waveform.sample(numpy.arange(samples) / 1000.0)
+    columns = [accel / fifo_decoder.GRAVITIY_MS2 * fifo_decoder.ACCEL_SCALE_MODIFIER_2G]
+    if capture_gyro:
+        columns.append(gyro * fifo_decoder.GYRO_SCALE_MODIFIER_250DEG)
+    burst = numpy.hstack(columns).astype(fifo_decoder.RAW_DTYPE).tobytes()
+
+    def best(function):
+        timings = []
+        for _ in range(repeat):
+            start = process_time()
+            function()
+            timings.append(process_time() - start)
+        return min(timings) / samples
+
+    decoded = fifo_decoder.decode_FIFO_burst(burst, capture_gyro)
+    rows = numpy.column_stack((numpy.arange(samples) / 1000.0, decoded))
+    row_format = ["%.3f"] + ["%.5f"] * len(axis)
+
+    folder = tempfile.mkdtemp(prefix="mpu6050_stages_")
+    try:
+        path = os.path.join(folder, "stages" + capture_file.EXTENSION)
+
+        def write_binary():
+            writer = capture_file.CaptureWriter(path, dict(sample_rate=1000.0, axis=axis,
+                                                           accel_scale_modifier=16384.0,
+                                                           gyro_scale_modifier=131.0))
+            for offset in range(0, len(burst), 1020):
+                writer.write_frames(burst[offset:offset + 1020])
+            writer.close()
+
+        return dict(
+            axis=list(axis),
+            decode=best(lambda: fifo_decoder.decode_FIFO_burst(burst, capture_gyro)),
+            csv_format=best(lambda: numpy.savetxt(io.BytesIO(), rows, fmt=row_format, delimiter=",")),
+            binary_write=best(write_binary),
+            csv_bytes_per_sample=_csv_bytes(rows, row_format),
+            binary_bytes_per_sample=len(burst) / float(samples)
+        )
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def run_imports(modules=IMPORT_MODULES, repeat=3):
+    """Measures the import time of every module in a new interpreter, best of repeat.
+
+    Returns a dict of module -> seconds, or the error when it cannot be imported.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    script = "import time; start = time.time(); import %s; print(time.time() - start)"
+    imports = dict()
+    for module in modules:
+        timings = []
+        for _ in range(repeat):
+            process = subprocess.Popen([sys.executable, "-c", script % module], cwd=root,
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            output, error = process.communicate()
+            if process.returncode:
+                lines = error.decode("utf-8", "replace").strip().splitlines()
+                imports[module] = dict(error=lines[-1] if lines else "exit code %d" % process.returncode)
+                break
+            timings.append(float(output))
+        else:
+            imports[module] = min(timings)
+    return imports
+
+
+def run_start_latency(sample_rate, basefolder, latency=0.0001, byte_time=0.0000225, repeat=5):
+    """Measures the latency from the start request to the first sample of cold and standby starts.
+
+    A cold start creates and configures the sensor for every capture, as the
+    plugin does without standby; a standby start reuses one armed sensor.
+    Returns the best mpu6050.start_latency figures of each, in seconds.
+    """
+    device = SimulatedMPU6050(VibrationWaveform(seed=0))
+    bus = SimulatedBus({0x68: device}, latency=latency, byte_time=byte_time)
+    logger = logging.getLogger("lib.benchmark.start")
+
+    def first_read(sensor):
+        while sensor.start_latency is None and sensor.capturingData:
+            time.sleep(0.001)
+        return sensor.start_latency
+
+    cold = []
+    for _ in range(repeat):
+        requested = monotonic()
+        sensor = mpu6050(0x68, bus=bus, logger=logger, basefolder=basefolder)
+        sensor.configure(sample_rate=sample_rate)
+        sensor.start_requested = requested
+        sensor.start()
+        cold.append(first_read(sensor))
+        sensor.stop()
+        sensor.join()
+
+    standby = StandbySensor(mpu6050(0x68, bus=bus, logger=logger, basefolder=basefolder), logger)
+    standby.configure(sample_rate=sample_rate)
+    armed = []
+    try:
+        for _ in range(repeat):
+            standby.start()
+            armed.append(first_read(standby.sensor))
+            standby.stop()
+    finally:
+        standby.close()
+
+    def best(latencies):
+        latencies = [latency for latency in latencies if latency is not None]
+        if not latencies:
+            return dict()
+        return dict((key, min(latency[key] for latency in latencies)) for key in latencies[0])
+
+    return dict(sample_rate=sample_rate, cold=best(cold), standby=best(armed))
+
+
+def _csv_bytes(rows, row_format):
+    output = io.BytesIO()
+    numpy.savetxt(output, rows, fmt=row_format, delimiter=",")
+    return len(output.getvalue()) / float(len(rows))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark of the MPU-6050 capture pipeline")
+    parser.add_argument("--rates", default="100,250,500,1000", help="comma separated sample rates, Hz")
+    parser.add_argument("--axis", default=",".join(sorted(AXIS_SETS)), help="comma separated axis sets: %s" %
+                                                                           ", ".join(sorted(AXIS_SETS)))
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per capture run")
+    parser.add_argument("--latency", type=float, default=0.0001, help="simulated seconds per I2C transaction")
+    parser.add_argument("--byte-time", type=float, default=0.0000225, help="simulated seconds per I2C byte")
+    parser.add_argument("--wait-mode", default="sleep", help="spin or sleep")
+    parser.add_argument("--output", help="write the JSON results to this file")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+
+    results = dict(
+        python=platform.python_version(),
+        machine=platform.machine(),
+        timestamp=time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime()),
+        captures=[],
+        stages=[],
+        start_latency=[],
+        imports=run_imports()
+    )
+
+    basefolder = tempfile.mkdtemp(prefix="mpu6050_benchmark_")
+    try:
+        for axis_set in args.axis.split(","):
+            axis = AXIS_SETS[axis_set]
+            results["stages"].append(run_stages(axis))
+            for rate in args.rates.split(","):
+                results["captures"].append(run_capture(float(rate), axis, args.duration, basefolder,
+                                                       latency=args.latency, byte_time=args.byte_time,
+                                                       wait_mode=args.wait_mode))
+        for rate in args.rates.split(","):
+            results["start_latency"].append(run_start_latency(float(rate), basefolder, latency=args.latency,
+                                                              byte_time=args.byte_time))
+    finally:
+        shutil.rmtree(basefolder, ignore_errors=True)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as fd:
+            fd.write(output + "\n")
+    print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
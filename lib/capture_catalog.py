@@ -0,0 +1,286 @@
+"""SQLite index of the captures in a folder.
+
+Every capture file gets one row with its metadata (start time, duration,
+sample rate, axis, packet loss, the G-code script that produced it) and
+per axis summary statistics, so listings never open the capture files.
+
+add() indexes a single capture and is called when a capture closes,
+rebuild() brings the index in sync with the folder (new, changed and
+deleted files) and can recreate it from scratch.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+
+import numpy
+
+from . import capture_file
+from . import compressed_capture
+
+CAPTURE_EXTENSIONS = (capture_file.EXTENSION, compressed_capture.EXTENSION)
+STATS_BLOCK = 65536  # frames read at a time when computing the statistics
+MAX_LIMIT = 500
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS captures (
+    id TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    format TEXT NOT NULL,
+    start_time REAL,
+    duration REAL,
+    sample_rate REAL,
+    axis TEXT,
+    frames INTEGER,
+    packet_loss INTEGER,
+    gaps INTEGER,
+    script TEXT,
+    size INTEGER,
+    mtime REAL,
+    stats TEXT
+);
+CREATE INDEX IF NOT EXISTS captures_start_time ON captures (start_time);
+CREATE INDEX IF NOT EXISTS captures_script ON captures (script);
+"""
+
+_COLUMNS = ("id", "filename", "format", "start_time", "duration", "sample_rate", "axis", "frames",
+            "packet_loss", "gaps", "script", "size", "mtime", "stats")
+
+
+def capture_id(filename):
+    """Returns the catalog id of a capture file, its name without extension."""
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+def summary_stats(reader):
+    """Per axis mean, RMS around the mean, minimum and maximum of a capture, read a block at a time."""
+    columns = len(reader.axis)
+    total = numpy.zeros(columns)
+    squares = numpy.zeros(columns)
+    minimum = numpy.full(columns, numpy.inf)
+    maximum = numpy.full(columns, -numpy.inf)
+
+    for start in range(0, len(reader), STATS_BLOCK):
+        samples = reader.samples(start, start + STATS_BLOCK)
+        total += samples.sum(axis=0)
+        squares += (samples ** 2).sum(axis=0)
+        numpy.minimum(minimum, samples.min(axis=0), out=minimum)
+        numpy.maximum(maximum, samples.max(axis=0), out=maximum)
+
+    if not len(reader):
+        return dict()
+
+    mean = total / len(reader)
+    rms = numpy.sqrt(numpy.maximum(squares / len(reader) - mean ** 2, 0.0))
+    return dict((name, dict(mean=round(float(mean[i]), 5), rms=round(float(rms[i]), 5),
+                            min=round(float(minimum[i]), 5), max=round(float(maximum[i]), 5)))
+                for i, name in enumerate(reader.axis))
+
+
+def describe(path):
+    """Reads a capture file and returns its catalog row as a dict."""
+    reader = capture_file.open_capture(path)
+    header = reader.header
+    packet_loss = sum(event.get("samples", 0) for event in reader.gaps())
+    stat = os.stat(path)
+
+    return dict(
+        id=capture_id(path),
+        filename=os.path.basename(path),
+        format="compressed" if isinstance(reader, compressed_capture.CompressedCaptureReader) else "binary",
+        start_time=header.get("start_time"),
+        duration=(len(reader) + packet_loss) / reader.sample_rate,
+        sample_rate=reader.sample_rate,
+        axis=reader.axis,
+        frames=len(reader),
+        packet_loss=packet_loss,
+        gaps=len(reader.gaps()),
+        script=header.get("script"),
+        size=stat.st_size,
+        mtime=stat.st_mtime,
+        stats=summary_stats(reader)
+    )
+
+
+def _disk_usage(path):
+    """Bytes used by a capture file and its events file, 0 for the missing ones."""
+    usage = 0
+    for name in (path, capture_file.events_path(path)):
+        try:
+            usage += os.path.getsize(name)
+        except OSError:
+            pass
+    return usage
+
+
+class CaptureCatalog(object):
+    """Index of the captures stored in folder, kept in the SQLite database at path.
+
+    The connection is shared by the capture, startup and request threads,
+    every access goes through the lock.
+    """
+
+    def __init__(self, path, folder, logger=None):
+        self.path = path
+        self.folder = folder
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock:
+            self.connection.executescript(_SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def _store(self, row):
+        values = dict(row)
+        values["axis"] = json.dumps(values["axis"])
+        values["stats"] = json.dumps(values["stats"], sort_keys=True)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO captures (%s) VALUES (%s)" % (", ".join(_COLUMNS),
+                                                                      ", ".join("?" * len(_COLUMNS))),
+                [values[column] for column in _COLUMNS])
+
+    @staticmethod
+    def _row(row):
+        capture = dict(zip(row.keys(), row))
+        capture["axis"] = json.loads(capture["axis"])
+        capture["stats"] = json.loads(capture["stats"])
+        return capture
+
+    def add(self, path):
+        """Indexes (or re-indexes) one capture file, returns its row."""
+        row = describe(path)
+        self._store(row)
+        return row
+
+    def remove(self, capture_id):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM captures WHERE id = ?", (capture_id,))
+
+    def get(self, capture_id):
+        """Returns the row of a capture, None if it is not indexed."""
+        with self.lock:
+            row = self.connection.execute("SELECT * FROM captures WHERE id = ?", (capture_id,)).fetchone()
+        return self._row(row) if row is not None else None
+
+    def file_path(self, capture_id):
+        """Returns the path of an indexed capture file, None if it is not indexed."""
+        capture = self.get(capture_id)
+        return os.path.join(self.folder, capture["filename"]) if capture is not None else None
+
+    def rebuild(self, full=False, exclude=()):
+        """Synchronizes the index with the capture files on disk.
+
+        Only new and modified files are read, unless full is True.
+        exclude -- paths of the files still being recorded, left out of the index.
+        Returns the number of (re)indexed files.
+        """
+        excluded = set(os.path.basename(path) for path in exclude)
+        with self.lock:
+            known = dict((row["filename"], (row["size"], row["mtime"]))
+                         for row in self.connection.execute("SELECT filename, size, mtime FROM captures"))
+
+        on_disk = set()
+        indexed = 0
+        for filename in sorted(os.listdir(self.folder)):
+            if not filename.endswith(CAPTURE_EXTENSIONS):
+                continue
+            on_disk.add(filename)
+            if filename in excluded:
+                continue
+            path = os.path.join(self.folder, filename)
+            try:
+                stat = os.stat(path)
+                if not full and known.get(filename) == (stat.st_size, stat.st_mtime):
+                    continue
+                self.add(path)
+                indexed += 1
+            except (IOError, OSError, ValueError) as e:
+                if not os.path.exists(path):
+                    # deleted since the listing, e.g. by a rotation or a prune
+                    on_disk.discard(filename)
+                    continue
+                if self.logger is not None:
+                    self.logger.warning("Skipping capture %s: %s" % (filename, e))
+
+        for filename in set(known) - on_disk:
+            self.remove(capture_id(filename))
+        return indexed
+
+    def prune(self, max_bytes, exclude=()):
+        """Deletes the oldest captures, and their events, until the indexed ones fit in max_bytes.
+
+        The budget counts the capture files and their events files, as found on disk.
+
+        exclude -- paths of the files still being recorded, never deleted.
+        Returns the filenames deleted.
+        """
+        excluded = set(os.path.basename(path) for path in exclude)
+        with self.lock:
+            rows = self.connection.execute("SELECT id, filename, size FROM captures "
+                                           "ORDER BY start_time, id").fetchall()
+
+        sizes = [_disk_usage(os.path.join(self.folder, row["filename"])) for row in rows]
+        total = sum(sizes)
+        deleted = []
+        for row, size in zip(rows, sizes):
+            if total <= max_bytes:
+                break
+            if row["filename"] in excluded:
+                continue
+            path = os.path.join(self.folder, row["filename"])
+            try:
+                os.remove(path)
+            except OSError as e:
+                if os.path.exists(path):
+                    if self.logger is not None:
+                        self.logger.warning("Could not delete capture %s: %s" % (row["filename"], e))
+                    continue
+            try:
+                os.remove(capture_file.events_path(path))
+            except OSError:
+                pass
+            self.remove(row["id"])
+            total -= size
+            deleted.append(row["filename"])
+        return deleted
+
+    def query(self, offset=0, limit=50, since=None, until=None, script=None, sample_rate=None,
+              descending=True):
+        """Returns (total, rows) of the captures matching the filters, one page at a time.
+
+        since, until -- start time bounds, seconds since the epoch.
+        script -- G-code script name.
+        sample_rate -- Hz.
+        """
+        conditions = []
+        parameters = []
+        if since is not None:
+            conditions.append("start_time >= ?")
+            parameters.append(since)
+        if until is not None:
+            conditions.append("start_time < ?")
+            parameters.append(until)
+        if script is not None:
+            conditions.append("script = ?")
+            parameters.append(script)
+        if sample_rate is not None:
+            conditions.append("sample_rate = ?")
+            parameters.append(sample_rate)
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+
+        limit = max(1, min(int(limit), MAX_LIMIT))
+        offset = max(0, int(offset))
+        order = "DESC" if descending else "ASC"
+
+        with self.lock:
+            total = self.connection.execute("SELECT COUNT(*) FROM captures" + where, parameters).fetchone()[0]
+            rows = self.connection.execute(
+                "SELECT * FROM captures%s ORDER BY start_time %s, id %s LIMIT ? OFFSET ?" % (where, order, order),
+                parameters + [limit, offset]).fetchall()
+        return total, [self._row(row) for row in rows]
@@ -0,0 +1,99 @@
+"""Processing stage of a capture.
+
+The acquisition thread (mpu6050.start_capture) only moves raw FIFO bytes
+into a RingBuffer. CaptureConsumer runs on its own thread, takes the
+chunks out of the ring, persists them with the capture writer, decodes
+them for the registered listeners and logs the progress. Slow storage
+then delays this thread only, never the FIFO drain.
+"""
+
+import collections
+import threading
+
+from . import fifo_decoder
+
+
+class CaptureConsumer(threading.Thread):
+    """Drains a RingBuffer into a capture writer.
+
+    sensor -- the mpu6050 instance, used for logging and statistics.
+    ring -- the RingBuffer filled by the acquisition thread.
+    writer -- a capture_file.CaptureWriter, closed when the consumer ends.
+    capture_gyro -- True if the packets hold the gyro axes.
+    axis_names -- names of the packet columns.
+    """
+
+    LOG_EVERY = 50  # packets
+
+    def __init__(self, sensor, ring, writer, capture_gyro, axis_names, accel_scale_modifier,
+                 gyro_scale_modifier):
+        threading.Thread.__init__(self)
+        self.name = "MPU6050 Consumer"
+        self.daemon = True
+
+        self.sensor = sensor
+        self.ring = ring
+        self.writer = writer
+        self.capture_gyro = capture_gyro
+        self.axis_names = axis_names
+        self.packet_size = len(axis_names) * fifo_decoder.RAW_DTYPE.itemsize
+        self.scale = fifo_decoder.scale_factors(capture_gyro, accel_scale_modifier, gyro_scale_modifier)
+        self.events = collections.deque()
+        self.listeners = []
+        self.packets_written = 0
+
+    def add_listener(self, listener):
+        """Registers a callable receiving every decoded (N, columns) array of samples."""
+        self.listeners.append(listener)
+
+    def post_event(self, event):
+        """Queues a clock/marker event to be written with the capture."""
+        self.events.append(event)
+
+    def stop(self):
+        """Ends the consumer once every queued chunk is persisted."""
+        self.ring.close()
+
+    def run(self):
+        try:
+            while True:
+                self._write_events()
+
+                chunk = self.ring.peek(timeout=0.5)
+                if chunk is None:
+                    if self.ring.closed:
+                        break
+                    continue
+
+                try:
+                    self._process(chunk)
+                finally:
+                    self.ring.advance()
+        except Exception as e:
+            self.sensor.log_exception("Consumer failed: " + str(e))
+        finally:
+            self._write_events()
+            self.writer.close()
+
+    def _write_events(self):
+        while self.events:
+            self.writer.write_event(self.events.popleft())
+
+    def _process(self, chunk):
+        self.writer.write_frames(chunk)
+
+        previous_count = self.packets_written
+        self.packets_written += len(chunk) // self.packet_size
+        log_due = self.packets_written // self.LOG_EVERY != previous_count // self.LOG_EVERY
+
+        if not (self.listeners or log_due):
+            return
+
+        samples = fifo_decoder.decode_raw(chunk, self.capture_gyro) * self.scale
+        for listener in self.listeners:
+            listener(samples)
+
+        if log_due:
+            self.sensor.log_debug("Packets: %s Loss: %s Dropped: %s %s" % (
+                self.packets_written, self.sensor.packet_loss, self.ring.dropped_chunks,
+                ", ".join("%s: %3.5f" % (name, value) for name, value in zip(self.axis_names, samples[-1]))))
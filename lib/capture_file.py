@@ -0,0 +1,241 @@
+"""Binary capture format for MPU-6050 recordings.
+
+Layout:
+
+    MAGIC (8 bytes) | header length (uint32, big-endian) | JSON header | frames
+
+The JSON header describes the capture (sample rate, ranges, scale
+modifiers, offsets, axis list and the byte offset of the first frame).
+Frames are the raw big-endian int16 words as they come out of the FIFO,
+so the whole data section can be opened with numpy.memmap without parsing.
+
+Clock events (see sample_clock) are appended as JSON lines to a sidecar
+file next to the capture, "<capture>.events".
+
+Compressed captures (see compressed_capture) share the header fields and
+the events file, open_capture() returns the right reader for either.
+
+Usage as a converter:
+
+    python -m lib.capture_file mpu6050_20190101-120000.mpu [output.csv]
+"""
+
+import csv
+import json
+import os
+import struct
+import sys
+
+import numpy
+
+from . import fifo_decoder
+from . import sample_clock
+
+MAGIC = b"MPU6050\x00"
+VERSION = 1
+EXTENSION = ".mpu"
+EVENTS_EXTENSION = ".events"
+
+_LENGTH = struct.Struct(">I")
+_ALIGNMENT = 16
+
+
+class CaptureWriter(object):
+    """Appends raw FIFO frames to a binary capture file."""
+
+    path = None
+    header = None
+    frame_size = 0
+    frame_count = 0
+
+    def __init__(self, path, header):
+        self.path = path
+        self.header = dict(header)
+        self.header["version"] = VERSION
+        self.header["dtype"] = fifo_decoder.RAW_DTYPE.str
+        self.frame_size = len(self.header["axis"]) * fifo_decoder.RAW_DTYPE.itemsize
+
+        self._fd = open(path, "wb")
+        self._events_fd = None
+        self._write_header()
+
+    def _write_header(self):
+        # data_offset is part of the header itself, so pad the header until it is stable
+        self.header["data_offset"] = 0
+        while True:
+            encoded = json.dumps(self.header, sort_keys=True).encode("utf-8")
+            data_offset = len(MAGIC) + _LENGTH.size + len(encoded)
+            data_offset += -data_offset % _ALIGNMENT
+            if self.header["data_offset"] == data_offset:
+                break
+            self.header["data_offset"] = data_offset
+
+        padding = data_offset - len(MAGIC) - _LENGTH.size - len(encoded)
+        encoded += b" " * padding
+        self._fd.write(MAGIC)
+        self._fd.write(_LENGTH.pack(len(encoded)))
+        self._fd.write(encoded)
+
+    def write_frames(self, buffer):
+        """Appends a burst of raw FIFO bytes, aligned to whole frames."""
+        self._fd.write(buffer)
+        self.frame_count += len(buffer) // self.frame_size
+
+    def write_event(self, event):
+        """Appends an event (a JSON serializable dict) to the events file."""
+        if self._events_fd is None:
+            self._events_fd = open(events_path(self.path), "w")
+        self._events_fd.write(json.dumps(event, sort_keys=True) + "\n")
+
+    def flush(self):
+        self._fd.flush()
+        if self._events_fd is not None:
+            self._events_fd.flush()
+
+    def close(self):
+        if self._fd is not None:
+            self._fd.close()
+            self._fd = None
+        if self._events_fd is not None:
+            self._events_fd.close()
+            self._events_fd = None
+
+
+def events_path(path):
+    """Returns the path of the events file of a capture."""
+    return path + EVENTS_EXTENSION
+
+
+def read_events(path):
+    """Reads the events stored next to a capture, in the order they were written."""
+    try:
+        with open(events_path(path), "r") as fd:
+            return [json.loads(line) for line in fd if line.strip()]
+    except IOError:
+        return []
+
+
+def read_header(path):
+    """Reads and returns the JSON header of a capture file."""
+    with open(path, "rb") as fd:
+        magic = fd.read(len(MAGIC))
+        if magic != MAGIC:
+            raise ValueError("Not a MPU6050 capture file: %s" % path)
+        length, = _LENGTH.unpack(fd.read(_LENGTH.size))
+        header = json.loads(fd.read(length).decode("utf-8"))
+
+    if header.get("version", 0) > VERSION:
+        raise ValueError("Unsupported capture version %s: %s" % (header.get("version"), path))
+    return header
+
+
+class CaptureReader(object):
+    """Memory-mapped access to a binary capture file."""
+
+    path = None
+    header = None
+    axis = None
+    raw = None
+    events = None
+    _times = None
+
+    def __init__(self, path):
+        self.path = path
+        self.header = read_header(path)
+        self.axis = list(self.header["axis"])
+        self.events = read_events(path)
+
+        columns = len(self.axis)
+        dtype = numpy.dtype(str(self.header["dtype"]))
+        data_bytes = _file_size(path) - self.header["data_offset"]
+        frames = data_bytes // (columns * dtype.itemsize)
+
+        if frames > 0:
+            self.raw = numpy.memmap(path, dtype=dtype, mode="r", offset=self.header["data_offset"],
+                                    shape=(frames, columns))
+        else:
+            self.raw = numpy.empty((0, columns), dtype=dtype)
+
+    def __len__(self):
+        return len(self.raw)
+
+    @property
+    def sample_rate(self):
+        return float(self.header["sample_rate"])
+
+    def scale(self):
+        """Returns the per column multipliers from raw counts to physical units."""
+        return fifo_decoder.scale_factors("GX" in self.axis, self.header["accel_scale_modifier"],
+                                          self.header["gyro_scale_modifier"])
+
+    def raw_frames(self, start=0, stop=None):
+        """Returns the raw int16 frames [start, stop)."""
+        return self.raw[start:stop]
+
+    def samples(self, start=0, stop=None):
+        """Returns the frames [start, stop) converted to physical units."""
+        return self.raw[start:stop] * self.scale()
+
+    def times(self, start=0, stop=None):
+        """Returns the capture time of frames [start, stop) in seconds.
+
+        Times come from the sample index and the sample rate, corrected by
+        the clock anchors and gaps recorded in the events file.
+        """
+        if self._times is None:
+            self._times = sample_clock.reconstruct_times(len(self.raw), self.sample_rate, self.events)
+        return self._times[start:stop]
+
+    def gaps(self):
+        """Returns the gap events of the capture."""
+        return [event for event in self.events if event.get("event") == "gap"]
+
+    def marks(self):
+        """Returns the marker events of the capture, in time order."""
+        return sorted((event for event in self.events if event.get("event") == "mark"), key=lambda e: e["time"])
+
+
+def open_capture(path):
+    """Returns a CaptureReader or a compressed_capture.CompressedCaptureReader, from the file magic."""
+    from . import compressed_capture
+
+    with open(path, "rb") as fd:
+        magic = fd.read(len(MAGIC))
+    if magic == compressed_capture.MAGIC:
+        return compressed_capture.CompressedCaptureReader(path)
+    return CaptureReader(path)
+
+
+def _file_size(path):
+    with open(path, "rb") as fd:
+        fd.seek(0, 2)
+        return fd.tell()
+
+
+def export_csv(capture_path, csv_path=None, block_size=65536):
+    """Converts a binary or compressed capture to the CSV layout written by older versions.
+
+    Returns the path of the written CSV file.
+    """
+    reader = open_capture(capture_path)
+    if csv_path is None:
+        csv_path = os.path.splitext(capture_path)[0] + ".csv"
+
+    row_format = ["%.3f"] + ["%.5f"] * len(reader.axis)
+
+    with open(csv_path, "w") as fd:
+        csv.writer(fd, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL,
+                   lineterminator="\n").writerow(["Time"] + reader.axis)
+        for start in range(0, len(reader), block_size):
+            stop = min(start + block_size, len(reader))
+            rows = numpy.column_stack((reader.times(start, stop), reader.samples(start, stop)))
+            numpy.savetxt(fd, rows, fmt=row_format, delimiter=",")
+
+    return csv_path
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python -m lib.capture_file <capture%s> [output.csv]" % EXTENSION)
+        sys.exit(1)
+    print(export_csv(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None))
@@ -0,0 +1,184 @@
+"""Health metrics of the captures.
+
+CaptureMetrics holds the counters, gauges and histograms of one sensor.
+They live as long as the plugin, across captures, so the counters only
+grow, as monitoring systems expect. Updates are plain attribute
+increments and one bisect per histogram observation, made from the
+acquisition thread only; readers take a snapshot at any time.
+
+InstrumentedBus wraps a bus to count and time every I2C transaction.
+MetricsRegistry keeps the metrics of every sensor and renders them as a
+JSON friendly dict or in the Prometheus text exposition format:
+
+    registry = MetricsRegistry()
+    sensor = mpu6050(0x68, metrics=registry.sensor("hotend"))
+    ...
+    print(registry.prometheus())
+"""
+
+import bisect
+import threading
+
+from .sample_clock import monotonic
+
+PREFIX = "shooting_"
+
+# seconds, one transaction is 0.1 to 1 ms at 400 kHz
+TRANSACTION_BUCKETS = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.05)
+# seconds, a burst of up to 1024 bytes is 32 block transfers
+BURST_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.5)
+# seconds, an armed sensor starts within a sample period, a cold one spends most of it configuring
+START_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+
+COUNTERS = (
+    ("captures", "Captures started"),
+    ("samples", "Samples captured"),
+    ("lost_samples", "Samples lost in FIFO overflows, bus errors and consumer drops"),
+    ("overflow_resets", "FIFO overflows"),
+    ("resyncs", "FIFO resynchronizations"),
+    ("recovered_samples", "Samples drained from the FIFO on resynchronizations"),
+    ("dropped_chunks", "Bursts dropped because the writer queue was full"),
+    ("bursts", "FIFO burst reads"),
+    ("saturated_bursts", "FIFO burst reads slower than the sensor fills the FIFO"),
+    ("wait_iterations", "Acquisition loop iterations spent waiting for data"),
+    ("i2c_transactions", "I2C transactions"),
+    ("i2c_errors", "I2C transactions failed"),
+)
+
+GAUGES = (
+    ("capturing", "1 while a capture runs"),
+    ("queue_depth", "Bursts waiting for the writer"),
+    ("queue_high_water", "Most bursts waiting for the writer in the current capture"),
+)
+
+HISTOGRAMS = (
+    ("transaction_latency", "i2c_transaction_seconds", "Duration of the I2C transactions"),
+    ("burst_latency", "burst_read_seconds", "Duration of the FIFO burst reads"),
+    ("start_latency", "start_latency_seconds", "Seconds from the start request to the first sample"),
+)
+
+
+class Histogram(object):
+    """Counts of observations per bucket, bounds are the inclusive upper limits."""
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        """Returns the cumulative counts per upper bound, the last one is +Inf."""
+        cumulative = []
+        total = 0
+        for count in self.counts:
+            total += count
+            cumulative.append(total)
+        return dict(bounds=list(self.bounds) + ["+Inf"], counts=cumulative, sum=self.sum, count=self.count)
+
+
+class CaptureMetrics(object):
+    """Metrics of one sensor, see COUNTERS, GAUGES and HISTOGRAMS."""
+
+    def __init__(self):
+        for name, description in COUNTERS + GAUGES:
+            setattr(self, name, 0)
+        self.transaction_latency = Histogram(TRANSACTION_BUCKETS)
+        self.burst_latency = Histogram(BURST_BUCKETS)
+        self.start_latency = Histogram(START_BUCKETS)
+
+    def snapshot(self):
+        values = dict((name, getattr(self, name)) for name, description in COUNTERS + GAUGES)
+        for attribute, name, description in HISTOGRAMS:
+            values[attribute] = getattr(self, attribute).snapshot()
+        return values
+
+
+class InstrumentedBus(object):
+    """Bus wrapper counting and timing the transactions of the wrapped bus."""
+
+    def __init__(self, bus, metrics):
+        self.bus = bus
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self.bus, name)
+
+    def _call(self, method, *args):
+        metrics = self.metrics
+        started = monotonic()
+        try:
+            return method(*args)
+        except IOError:
+            metrics.i2c_errors += 1
+            raise
+        finally:
+            metrics.i2c_transactions += 1
+            metrics.transaction_latency.observe(monotonic() - started)
+
+    def read_byte_data(self, address, register):
+        return self._call(self.bus.read_byte_data, address, register)
+
+    def write_byte_data(self, address, register, value):
+        return self._call(self.bus.write_byte_data, address, register, value)
+
+    def read_i2c_block_data(self, address, register, length):
+        return self._call(self.bus.read_i2c_block_data, address, register, length)
+
+    def write_i2c_block_data(self, address, register, data):
+        return self._call(self.bus.write_i2c_block_data, address, register, data)
+
+
+class MetricsRegistry(object):
+    """The CaptureMetrics of every sensor, by sensor name."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sensors = dict()
+
+    def sensor(self, name):
+        """Returns the metrics of a sensor, created on first use."""
+        with self.lock:
+            if name not in self.sensors:
+                self.sensors[name] = CaptureMetrics()
+            return self.sensors[name]
+
+    def snapshot(self):
+        with self.lock:
+            sensors = sorted(self.sensors.items())
+        return dict((name, metrics.snapshot()) for name, metrics in sensors)
+
+    def prometheus(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = []
+
+        def family(name, kind, description):
+            lines.append("# HELP %s%s %s" % (PREFIX, name, description))
+            lines.append("# TYPE %s%s %s" % (PREFIX, name, kind))
+
+        for name, description in COUNTERS:
+            family(name + "_total", "counter", description)
+            for sensor, values in sorted(snapshot.items()):
+                lines.append('%s%s_total{sensor="%s"} %s' % (PREFIX, name, sensor, values[name]))
+
+        for name, description in GAUGES:
+            family(name, "gauge", description)
+            for sensor, values in sorted(snapshot.items()):
+                lines.append('%s%s{sensor="%s"} %s' % (PREFIX, name, sensor, values[name]))
+
+        for attribute, name, description in HISTOGRAMS:
+            family(name, "histogram", description)
+            for sensor, values in sorted(snapshot.items()):
+                histogram = values[attribute]
+                for bound, count in zip(histogram["bounds"], histogram["counts"]):
+                    lines.append('%s%s_bucket{sensor="%s",le="%s"} %s' % (PREFIX, name, sensor, bound, count))
+                lines.append('%s%s_sum{sensor="%s"} %r' % (PREFIX, name, sensor, histogram["sum"]))
+                lines.append('%s%s_count{sensor="%s"} %s' % (PREFIX, name, sensor, histogram["count"]))
+
+        return "\n".join(lines) + "\n"
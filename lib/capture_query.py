@@ -0,0 +1,143 @@
+"""Time range queries on capture files, downsampled for plotting.
+
+query_range() converts a time range into a frame range and only reads
+those frames (a slice of the memory map, or the chunks covering them for
+compressed captures), then reduces them to about the requested number
+of points per axis:
+
+    minmax -- the minimum and maximum of every bucket, in time order.
+              Keeps every peak, the right choice for vibration envelopes.
+    lttb   -- Largest-Triangle-Three-Buckets, keeps the visual shape of
+              the curve with exactly the requested number of points.
+
+Both return the indices of the kept frames per axis, so times and values
+come straight from the capture.
+"""
+
+import collections
+import os
+import threading
+
+import numpy
+
+from . import capture_file
+
+METHODS = ("minmax", "lttb")
+MAX_POINTS = 20000
+
+
+def minmax_indices(values, points):
+    """Indices of the per bucket minimum and maximum of (N, axis) values, shape (M, axis), M <= points."""
+    count, columns = values.shape
+    if count <= points:
+        return numpy.repeat(numpy.arange(count)[:, None], columns, axis=1)
+
+    buckets = max(1, points // 2)
+    size = -(-count // buckets)
+    # pad with the last frame, it cannot change the minimum or maximum of the last bucket
+    padding = -count % size
+    if padding:
+        values = numpy.concatenate((values, numpy.repeat(values[-1:], padding, axis=0)))
+    grouped = values.reshape(-1, size, columns)
+
+    low = grouped.argmin(axis=1)
+    high = grouped.argmax(axis=1)
+    base = (numpy.arange(len(grouped)) * size)[:, None]
+    indices = numpy.stack((numpy.minimum(low, high) + base, numpy.maximum(low, high) + base), axis=1)
+    return numpy.minimum(indices.reshape(-1, columns), count - 1)
+
+
+def lttb_indices(times, values, points):
+    """Largest-Triangle-Three-Buckets indices of (N, axis) values, shape (points, axis)."""
+    count, columns = values.shape
+    if count <= points or points < 3:
+        return numpy.repeat(numpy.arange(count)[:, None], columns, axis=1)
+
+    edges = numpy.linspace(1, count - 1, points - 1).astype(int)
+    edges = numpy.append(edges, count)
+    indices = numpy.empty((points, columns), dtype=int)
+    indices[0] = 0
+    indices[-1] = count - 1
+    all_columns = numpy.arange(columns)
+
+    selected = numpy.zeros(columns, dtype=int)
+    for bucket in range(points - 2):
+        start, stop = edges[bucket], edges[bucket + 1]
+        next_stop = edges[bucket + 2]
+        next_time = times[stop:next_stop].mean()
+        next_value = values[stop:next_stop].mean(axis=0)
+
+        selected_time = times[selected]
+        selected_value = values[selected, all_columns]
+        # twice the area of the triangle (selected, candidate, next bucket average), for every candidate and axis
+        area = numpy.abs((selected_time - next_time) * (values[start:stop] - selected_value) -
+                         (selected_time - times[start:stop, None]) * (next_value - selected_value))
+        selected = start + area.argmax(axis=0)
+        indices[bucket + 1] = selected
+    return indices
+
+
+def query_range(reader, start_time=None, end_time=None, axis=None, points=1000, method="minmax"):
+    """Downsampled slice of a capture.
+
+    reader -- a capture_file or compressed_capture reader.
+    start_time, end_time -- seconds on the time base of reader.times(), relative to the capture
+                            epoch: a rotated segment starts where the previous one ended, not
+                            at 0. The whole capture by default.
+    axis -- names of the axes to return, all by default.
+    Returns a dict with the frame range, and per axis the times and values of the kept points.
+    """
+    if method not in METHODS:
+        raise ValueError("Method must be one of %s" % ", ".join(METHODS))
+    axis = list(axis) if axis else list(reader.axis)
+    unknown = [name for name in axis if name not in reader.axis]
+    if unknown:
+        raise ValueError("Unknown axis: %s" % ", ".join(unknown))
+    points = max(3, min(int(points), MAX_POINTS))
+
+    all_times = reader.times()
+    start = 0 if start_time is None else int(numpy.searchsorted(all_times, start_time, side="left"))
+    stop = len(all_times) if end_time is None else int(numpy.searchsorted(all_times, end_time, side="right"))
+    stop = max(start, stop)
+
+    columns = [reader.axis.index(name) for name in axis]
+    times = all_times[start:stop]
+    values = reader.samples(start, stop)[:, columns]
+
+    if method == "lttb":
+        indices = lttb_indices(times, values, points)
+    else:
+        indices = minmax_indices(values, points)
+
+    return dict(
+        start=start,
+        stop=stop,
+        method=method,
+        axis=axis,
+        times=[times[indices[:, i]] for i in range(len(axis))],
+        values=[values[indices[:, i], i] for i in range(len(axis))]
+    )
+
+
+class ReaderCache(object):
+    """Keeps the readers of the last queried captures open.
+
+    A reader is reopened when its file changed, e.g. while it is still being captured.
+    """
+
+    def __init__(self, size=4):
+        self.size = size
+        self.lock = threading.Lock()
+        self.readers = collections.OrderedDict()
+
+    def get(self, path):
+        stat = os.stat(path)
+        key = (stat.st_size, stat.st_mtime)
+        with self.lock:
+            cached = self.readers.pop(path, None)
+            if cached is None or cached[0] != key:
+                cached = (key, capture_file.open_capture(path))
+            self.readers[path] = cached
+            while len(self.readers) > self.size:
+                self.readers.popitem(last=False)
+        return cached[1]
@@ -0,0 +1,145 @@
+"""Long captures split in segment files.
+
+RotatingWriter has the interface of the capture writers and runs in the
+consumer thread, so rotation never delays the FIFO drain. It starts a new
+segment file once the current one holds max_seconds of samples or
+max_bytes. Every segment is a complete capture: it has its own header
+(with "capture" and "segment" fields to find its siblings), events and,
+for compressed captures, index. Its events are renumbered from its first
+frame and a start event anchors that frame on the clock, so the times of
+every segment stay on the time base of the whole capture.
+
+Segments of "mpu6050_20190101-120000.mpu" are named
+"mpu6050_20190101-120000_0001.mpu", "..._0002.mpu" and so on.
+"""
+
+import collections
+import os
+
+SEGMENT_FORMAT = "%s_%04d%s"
+
+
+class RotatingWriter(object):
+    """Capture writer starting a new segment every max_seconds of samples or max_bytes.
+
+    writer_class -- capture_file.CaptureWriter or compressed_capture.CompressedCaptureWriter.
+    path -- path of the capture, the segments are named after it.
+    max_seconds, max_bytes -- segment limits, None (or 0) for no limit.
+    on_segment_closed -- callable receiving the path of every segment completed
+                         by a rotation, called from the consumer thread.
+    """
+
+    def __init__(self, writer_class, path, header, max_seconds=None, max_bytes=None, on_segment_closed=None):
+        self.writer_class = writer_class
+        self.base, self.extension = os.path.splitext(path)
+        self.header = dict(header)
+        self.sample_rate = float(header["sample_rate"])
+        self.max_frames = int(max_seconds * self.sample_rate) if max_seconds else None
+        self.max_bytes = max_bytes or None
+        self.on_segment_closed = on_segment_closed
+
+        self.segment = 0
+        self.frame_count = 0  # frames written in every segment
+        self.lost_samples = 0  # samples of the gap events written
+        self.segment_frame = 0  # frame and sample index of the first frame of the current segment
+        self.segment_sample = 0
+        self.start_time = None  # time of the capture start event
+        self.anchors = collections.deque(maxlen=2)  # last (sample, time) clock anchors
+        self.pending = collections.deque()  # events about frames not written yet
+
+        self.writer = None
+        self.path = None
+        self._open()
+
+    @property
+    def frame_size(self):
+        return self.writer.frame_size
+
+    def _open(self, time=None):
+        self.segment += 1
+        self.path = SEGMENT_FORMAT % (self.base, self.segment, self.extension)
+        header = dict(self.header, capture=os.path.basename(self.base), segment=self.segment)
+        if time is not None and self.start_time is not None:
+            header["start_time"] = self.header["start_time"] + time - self.start_time
+
+        self.segment_frame = self.frame_count
+        self.segment_sample = self.frame_count + self.lost_samples
+        self.writer = self.writer_class(self.path, header)
+        if time is not None:
+            self.writer.write_event(dict(event="start", frame=0, sample=0, time=time))
+
+    def _rotation_due(self):
+        frames = self.frame_count - self.segment_frame
+        if not frames:
+            return False
+        if self.max_frames is not None and frames >= self.max_frames:
+            return True
+        return self.max_bytes is not None and os.path.getsize(self.path) >= self.max_bytes
+
+    def _rotate(self):
+        time = self._time_of(self.frame_count + self.lost_samples)
+        path = self.path
+        self.writer.close()
+        self._open(time)
+        if self.on_segment_closed is not None:
+            self.on_segment_closed(path)
+
+    def _time_of(self, sample):
+        """Time of a sample index, extrapolated from the last clock anchors."""
+        if not self.anchors:
+            return None
+        anchor_sample, anchor_time = self.anchors[-1]
+        rate = self.sample_rate
+        if len(self.anchors) == 2:
+            first_sample, first_time = self.anchors[0]
+            if anchor_time > first_time and anchor_sample > first_sample:
+                rate = (anchor_sample - first_sample) / (anchor_time - first_time)
+        return anchor_time + (sample - anchor_sample) / rate
+
+    def write_frames(self, buffer):
+        if self._rotation_due():
+            self._rotate()
+        self.writer.write_frames(buffer)
+        self.frame_count += len(buffer) // self.writer.frame_size
+        self._write_pending()
+
+    def write_event(self, event):
+        if "frame" not in event:
+            # markers only carry a time
+            self._write(event)
+            return
+        self.pending.append(event)
+        self._write_pending()
+
+    def _write_pending(self):
+        # an event goes to the segment holding its frame, a gap before the next frame goes with that frame
+        while self.pending:
+            event = self.pending[0]
+            if event["frame"] > self.frame_count or (event["frame"] == self.frame_count and
+                                                     event.get("event") == "gap"):
+                break
+            self._write(self.pending.popleft())
+
+    def _write(self, event):
+        kind = event.get("event")
+        if kind == "start":
+            self.start_time = event["time"]
+        if kind == "gap":
+            self.lost_samples += event["samples"]
+        if kind in ("start", "sync", "gap"):
+            self.anchors.append((event["sample"], event["time"]))
+
+        event = dict(event)
+        if "frame" in event:
+            event["frame"] -= self.segment_frame
+        if "sample" in event:
+            event["sample"] -= self.segment_sample
+        self.writer.write_event(event)
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        while self.pending:
+            self._write(self.pending.popleft())
+        self.writer.close()
@@ -0,0 +1,260 @@
+"""Simultaneous capture from several MPU-6050 sensors.
+
+Sensors are grouped by I2C bus and every bus is serviced by one
+BusWorker thread, which polls its sensors in turn: transfers on a bus
+never contend, while separate buses are read in parallel.
+
+Every sensor writes its own capture file (see mpu6050.open_capture), but
+all their clocks share the session epoch, so the times of every stream
+are on one monotonic time base. The session manifest, "<session>.session",
+lists the streams; SessionReader opens them together and resamples them
+on a common time grid.
+
+    session = CaptureSession([dict(name="hotend", bus=1, address=0x68),
+                              dict(name="bed", bus=1, address=0x69),
+                              dict(name="frame", bus=3, address=0x68)], basefolder)
+    session.start()
+    ...
+    session.stop()
+"""
+
+import json
+import os
+import threading
+import time
+
+import numpy
+
+from . import capture_file
+from . import i2c_bus
+from . import wait_strategy
+from .mpu6050 import mpu6050
+from .sample_clock import monotonic
+
+EXTENSION = ".session"
+VERSION = 1
+
+
+class BusWorker(threading.Thread):
+    """Runs the captures of every sensor of one bus from a single thread.
+
+    A sensor is drained once its FIFO holds wait_watermark bytes, in
+    between the thread sleeps until the next sensor is due.
+    """
+
+    def __init__(self, session, bus, sensors):
+        threading.Thread.__init__(self)
+        self.name = "MPU6050 bus %s" % bus
+        self.daemon = True
+        self.session = session
+        self.bus = bus
+        self.sensors = sensors
+
+    def run(self):
+        waiters = []
+        opened = []
+        try:
+            for name, sensor in self.sensors:
+                sensor.open_capture(epoch=self.session.epoch, log_file=self.session.stream_path(name))
+                opened.append(sensor)
+                waiter = wait_strategy.SleepWait(sensor.wait_watermark)
+                waiter.prepare(sensor)
+                waiters.append(waiter)
+
+            while self.session.capturing:
+                delays = []
+                for (name, sensor), waiter in zip(self.sensors, waiters):
+                    delays.append(self._poll(sensor, waiter))
+                    if not sensor.capturingData:
+                        # timeout of one sensor ends the whole session
+                        self.session.capturing = False
+                time.sleep(max(wait_strategy.SleepWait.min_sleep, min(delays)))
+        except Exception as e:
+            self.session.log_exception("Bus %s failed: %s" % (self.bus, e))
+            self.session.capturing = False
+        finally:
+            # a sensor failing to open leaves the ones after it unopened
+            for sensor in opened:
+                sensor.close_capture()
+            self.session.worker_finished(self)
+
+    @staticmethod
+    def _poll(sensor, waiter):
+        """Drains the sensor if its FIFO is due, returns the seconds until it is due again."""
+        packet_size = sensor.capture_packet_size
+        threshold = sensor.capture_budget.threshold(waiter.threshold(packet_size))
+        try:
+            FIFO_count = sensor.get_FIFO_count()
+            mpu_int_status = sensor.get_int_status()
+            if FIFO_count >= threshold or mpu_int_status & sensor.INT_ENABLE_FIFO_OFLOW_INT:
+                sensor.service_FIFO(FIFO_count, mpu_int_status)
+                FIFO_count = 0
+            else:
+                sensor.metrics.wait_iterations += 1
+        except IOError as e:
+            sensor.recover_FIFO(e)
+            FIFO_count = 0
+        missing_packets = max(1, (threshold - FIFO_count) // packet_size)
+        return missing_packets / waiter.sample_rate
+
+
+class CaptureSession(object):
+    """One capture from several sensors, with a bus thread per I2C bus.
+
+    sensors -- list of dicts with name, bus and address.
+    basefolder -- folder of the stream files and the manifest.
+    metadata -- extra fields stored in the manifest and the stream headers.
+    buses -- bus objects by bus number, opened with i2c_bus.open_bus when missing.
+    metrics -- capture_metrics.MetricsRegistry receiving the metrics of every sensor, by name.
+    The sensors are created at once, configure them through self.sensors
+    (a list of (name, mpu6050)) before start().
+    """
+
+    capturing = False
+    epoch = None
+    on_session_closed = None  # callable receiving the session once every stream is closed
+
+    def __init__(self, sensors, basefolder, logger=None, metadata=None, buses=None, metrics=None):
+        self.basefolder = basefolder
+        self.logger = logger
+        self.metadata = dict(metadata or dict())
+        self.name = "session_" + time.strftime("%Y%m%d-%H%M%S", time.localtime())
+        self.path = os.path.join(basefolder, self.name + EXTENSION)
+        self.lock = threading.Lock()
+        self.workers = []
+
+        names = [sensor["name"] for sensor in sensors]
+        if len(set(names)) != len(names):
+            raise ValueError("Sensor names must be unique")
+
+        buses = dict(buses or dict())
+        self.descriptions = []
+        self.sensors = []
+        for description in sensors:
+            bus = description.get("bus", 1)
+            if bus not in buses:
+                # one bus object per bus, shared by its sensors and used by its worker only
+                buses[bus] = i2c_bus.open_bus(bus)
+            sensor = mpu6050(description.get("address", 0x68), bus=buses[bus], logger=logger, basefolder=basefolder,
+                             metrics=metrics.sensor(description["name"]) if metrics is not None else None)
+            self.sensors.append((description["name"], sensor))
+            self.descriptions.append(dict(name=description["name"], bus=bus,
+                                          address=description.get("address", 0x68)))
+
+    def log_exception(self, message):
+        if self.logger is not None:
+            self.logger.exception(message)
+
+    @property
+    def axis(self):
+        return self.sensors[0][1].axis
+
+    def stream_path(self, name):
+        """Path of the capture file of a sensor, without extension."""
+        return os.path.join(self.basefolder, "%s_%s" % (self.name, name))
+
+    def configure(self, **settings):
+        """Applies mpu6050.configure() settings to every sensor."""
+        for name, sensor in self.sensors:
+            sensor.configure(**settings)
+
+    def start(self):
+        for name, sensor in self.sensors:
+            sensor.metadata = dict(self.metadata, session=self.name, sensor=name)
+            sensor.capturingData = True
+
+        self.epoch = monotonic()
+        self.start_time = time.time()
+        self.capturing = True
+        self._write_manifest()
+
+        by_bus = dict()
+        for description, sensor in zip(self.descriptions, self.sensors):
+            by_bus.setdefault(description["bus"], []).append(sensor)
+        self.workers = [BusWorker(self, bus, sensors) for bus, sensors in sorted(by_bus.items())]
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        self.capturing = False
+
+    def join(self, timeout=None):
+        for worker in list(self.workers):
+            worker.join(timeout)
+
+    def mark(self, label):
+        """Records a marker in every stream, returns False when not capturing."""
+        return all([sensor.mark(label) for name, sensor in self.sensors]) and self.capturing
+
+    def worker_finished(self, worker):
+        with self.lock:
+            self.workers.remove(worker)
+            last = not self.workers
+        if last:
+            self._write_manifest()
+            if self.on_session_closed is not None:
+                self.on_session_closed(self)
+
+    def _write_manifest(self):
+        streams = []
+        for description, (name, sensor) in zip(self.descriptions, self.sensors):
+            stream = dict(description)
+            if sensor.capture_path is not None:
+                stream["file"] = os.path.basename(sensor.capture_path)
+                stream["packet_loss"] = sensor.packet_loss
+            streams.append(stream)
+
+        manifest = dict(self.metadata, version=VERSION, name=self.name, start_time=self.start_time,
+                        streams=streams)
+        with open(self.path, "w") as fd:
+            json.dump(manifest, fd, indent=2, sort_keys=True)
+
+
+class SessionReader(object):
+    """The streams of a session, on the common time base."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "r") as fd:
+            self.manifest = json.load(fd)
+        if self.manifest.get("version", 0) > VERSION:
+            raise ValueError("Unsupported session version %s: %s" % (self.manifest.get("version"), path))
+
+        folder = os.path.dirname(path)
+        self.streams = dict()
+        for stream in self.manifest["streams"]:
+            if "file" in stream:
+                self.streams[stream["name"]] = capture_file.open_capture(os.path.join(folder, stream["file"]))
+
+    def time_range(self):
+        """Returns the (start, end) times covered by every stream."""
+        start = max(reader.times()[0] for reader in self.streams.values() if len(reader))
+        end = min(reader.times()[-1] for reader in self.streams.values() if len(reader))
+        return start, end
+
+    def aligned(self, start_time=None, end_time=None, sample_rate=None):
+        """Resamples every stream on one time grid, by linear interpolation.
+
+        sample_rate -- Hz of the grid, the lowest stream rate by default.
+        Returns (times, dict of stream name -> (N, axis) samples).
+        """
+        if not self.streams or not all(len(reader) for reader in self.streams.values()):
+            raise ValueError("Session without data: %s" % self.path)
+
+        common_start, common_end = self.time_range()
+        start_time = common_start if start_time is None else max(start_time, common_start)
+        end_time = common_end if end_time is None else min(end_time, common_end)
+        if sample_rate is None:
+            sample_rate = min(reader.sample_rate for reader in self.streams.values())
+
+        grid = numpy.arange(start_time, end_time, 1.0 / sample_rate)
+        aligned = dict()
+        for name, reader in self.streams.items():
+            times = reader.times()
+            # one frame of margin on both sides of the grid, only that slice is read
+            start = max(0, int(numpy.searchsorted(times, start_time)) - 1)
+            stop = min(len(times), int(numpy.searchsorted(times, end_time, side="right")) + 1)
+            samples = reader.samples(start, stop)
+            aligned[name] = numpy.column_stack([numpy.interp(grid, times[start:stop], samples[:, column])
+                                                for column in range(samples.shape[1])])
+        return grid, aligned
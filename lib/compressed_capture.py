@@ -0,0 +1,250 @@
+"""Compressed container for MPU-6050 captures.
+
+Layout:
+
+    MAGIC (8 bytes) | header length (uint32) | JSON header | chunk ... chunk | index | trailer
+
+Every chunk holds chunk_frames frames (the last one possibly less),
+compressed on their own:
+
+    frames (uint32) | compressed length (uint32) | zlib data
+
+The frames are delta encoded per axis (the first frame of the chunk is
+kept as is) and byte shuffled, high bytes first, which makes the slowly
+changing vibration data compress well. The index is the list of
+(offset, compressed length, first frame, frames) of every chunk, so a
+reader only inflates the chunks covering the requested frames. The
+trailer is the index offset (uint64) followed by INDEX_MAGIC. A file
+without trailer (e.g. after a crash) is indexed by walking the chunks.
+
+Compression happens in CompressedCaptureWriter.write_frames, which runs
+on the capture consumer thread, never on the acquisition thread.
+"""
+
+import bisect
+import json
+import struct
+import zlib
+
+import numpy
+
+from . import capture_file
+from . import fifo_decoder
+from . import sample_clock
+
+MAGIC = b"MPU6050Z"
+INDEX_MAGIC = b"MPUINDEX"
+VERSION = 1
+EXTENSION = ".mpuz"
+
+_LENGTH = struct.Struct(">I")
+_CHUNK = struct.Struct(">II")
+_INDEX_ENTRY = struct.Struct(">QIQI")
+_TRAILER = struct.Struct(">Q8s")
+
+
+def encode_chunk(raw, level=6):
+    """Delta encodes, byte shuffles and compresses an (N, axis) int16 array."""
+    raw = numpy.asarray(raw, dtype=fifo_decoder.RAW_DTYPE)
+    deltas = raw.copy()
+    # int16 arithmetic wraps around, the decoder reverses it exactly
+    deltas[1:] = raw[1:] - raw[:-1]
+    shuffled = deltas.view(numpy.uint8).reshape(-1, 2).T.tobytes()
+    return zlib.compress(shuffled, level)
+
+
+def decode_chunk(data, frames, columns):
+    """Reverses encode_chunk, returns an (frames, columns) int16 array."""
+    shuffled = numpy.frombuffer(zlib.decompress(data), dtype=numpy.uint8)
+    deltas = shuffled.reshape(2, -1).T.copy().view(fifo_decoder.RAW_DTYPE).reshape(frames, columns)
+    return numpy.cumsum(deltas, axis=0, dtype=fifo_decoder.RAW_DTYPE)
+
+
+class CompressedCaptureWriter(object):
+    """Appends raw FIFO frames to a compressed capture, a chunk at a time.
+
+    Same interface as capture_file.CaptureWriter.
+    """
+
+    path = None
+    header = None
+    frame_size = 0
+    frame_count = 0
+
+    def __init__(self, path, header, chunk_frames=4096, level=6):
+        self.path = path
+        self.header = dict(header)
+        self.header["version"] = VERSION
+        self.header["dtype"] = fifo_decoder.RAW_DTYPE.str
+        self.header["codec"] = "zlib-delta-shuffle"
+        self.header["chunk_frames"] = chunk_frames
+        self.columns = len(self.header["axis"])
+        self.frame_size = self.columns * fifo_decoder.RAW_DTYPE.itemsize
+        self.chunk_frames = chunk_frames
+        self.level = level
+        self.index = []
+        self.pending = bytearray()
+
+        self._fd = open(path, "wb")
+        self._events_fd = None
+        encoded = json.dumps(self.header, sort_keys=True).encode("utf-8")
+        self._fd.write(MAGIC)
+        self._fd.write(_LENGTH.pack(len(encoded)))
+        self._fd.write(encoded)
+        self.offset = self._fd.tell()
+
+    def write_frames(self, buffer):
+        self.pending += buffer
+        chunk_bytes = self.chunk_frames * self.frame_size
+        while len(self.pending) >= chunk_bytes:
+            self._write_chunk(self.pending[:chunk_bytes])
+            del self.pending[:chunk_bytes]
+
+    def _write_chunk(self, data):
+        frames = len(data) // self.frame_size
+        raw = numpy.frombuffer(bytes(data), dtype=fifo_decoder.RAW_DTYPE).reshape(frames, self.columns)
+        compressed = encode_chunk(raw, self.level)
+
+        self._fd.write(_CHUNK.pack(frames, len(compressed)))
+        self._fd.write(compressed)
+        self.index.append((self.offset + _CHUNK.size, len(compressed), self.frame_count, frames))
+        self.offset += _CHUNK.size + len(compressed)
+        self.frame_count += frames
+
+    def write_event(self, event):
+        if self._events_fd is None:
+            self._events_fd = open(capture_file.events_path(self.path), "w")
+        self._events_fd.write(json.dumps(event, sort_keys=True) + "\n")
+
+    def flush(self):
+        self._fd.flush()
+        if self._events_fd is not None:
+            self._events_fd.flush()
+
+    def close(self):
+        if self._fd is not None:
+            frames = len(self.pending) // self.frame_size
+            if frames:
+                self._write_chunk(self.pending[:frames * self.frame_size])
+            del self.pending[:]
+
+            index_offset = self.offset
+            for entry in self.index:
+                self._fd.write(_INDEX_ENTRY.pack(*entry))
+            self._fd.write(_TRAILER.pack(index_offset, INDEX_MAGIC))
+            self._fd.close()
+            self._fd = None
+        if self._events_fd is not None:
+            self._events_fd.close()
+            self._events_fd = None
+
+
+def read_header(path):
+    with open(path, "rb") as fd:
+        if fd.read(len(MAGIC)) != MAGIC:
+            raise ValueError("Not a compressed MPU6050 capture file: %s" % path)
+        length, = _LENGTH.unpack(fd.read(_LENGTH.size))
+        header = json.loads(fd.read(length).decode("utf-8"))
+        header["data_offset"] = fd.tell()
+
+    if header.get("version", 0) > VERSION:
+        raise ValueError("Unsupported capture version %s: %s" % (header.get("version"), path))
+    return header
+
+
+def read_index(path, data_offset):
+    """Returns the chunk index of a file, walking the chunks if it has no trailer."""
+    with open(path, "rb") as fd:
+        fd.seek(0, 2)
+        size = fd.tell()
+
+        if size - data_offset >= _TRAILER.size:
+            fd.seek(size - _TRAILER.size)
+            index_offset, magic = _TRAILER.unpack(fd.read(_TRAILER.size))
+            if magic == INDEX_MAGIC:
+                fd.seek(index_offset)
+                data = fd.read(size - _TRAILER.size - index_offset)
+                return [_INDEX_ENTRY.unpack_from(data, offset)
+                        for offset in range(0, len(data), _INDEX_ENTRY.size)]
+
+        index = []
+        offset = data_offset
+        first_frame = 0
+        while offset + _CHUNK.size <= size:
+            fd.seek(offset)
+            frames, length = _CHUNK.unpack(fd.read(_CHUNK.size))
+            if offset + _CHUNK.size + length > size:
+                break  # truncated chunk
+            index.append((offset + _CHUNK.size, length, first_frame, frames))
+            offset += _CHUNK.size + length
+            first_frame += frames
+        return index
+
+
+class CompressedCaptureReader(object):
+    """Random access to a compressed capture.
+
+    Same interface as capture_file.CaptureReader, frames are inflated on
+    demand from the chunks covering the requested range.
+    """
+
+    def __init__(self, path, cache_chunks=4):
+        self.path = path
+        self.header = read_header(path)
+        self.axis = list(self.header["axis"])
+        self.events = capture_file.read_events(path)
+        self.index = read_index(path, self.header["data_offset"])
+        self.first_frames = [entry[2] for entry in self.index]
+        self.frame_count = sum(entry[3] for entry in self.index)
+        self.cache_chunks = cache_chunks
+        self._cache = dict()
+        self._times = None
+
+    def __len__(self):
+        return self.frame_count
+
+    @property
+    def sample_rate(self):
+        return float(self.header["sample_rate"])
+
+    def scale(self):
+        return fifo_decoder.scale_factors("GX" in self.axis, self.header["accel_scale_modifier"],
+                                          self.header["gyro_scale_modifier"])
+
+    def _chunk(self, number):
+        if number not in self._cache:
+            offset, length, _, frames = self.index[number]
+            with open(self.path, "rb") as fd:
+                fd.seek(offset)
+                data = fd.read(length)
+            if len(self._cache) >= self.cache_chunks:
+                self._cache.pop(next(iter(self._cache)))
+            self._cache[number] = decode_chunk(data, frames, len(self.axis))
+        return self._cache[number]
+
+    def raw_frames(self, start=0, stop=None):
+        """Returns the raw int16 frames [start, stop)."""
+        start, stop, _ = slice(start, stop).indices(self.frame_count)
+        if stop <= start:
+            return numpy.empty((0, len(self.axis)), dtype=fifo_decoder.RAW_DTYPE)
+
+        first = bisect.bisect_right(self.first_frames, start) - 1
+        last = bisect.bisect_right(self.first_frames, stop - 1) - 1
+        parts = [self._chunk(number) for number in range(first, last + 1)]
+        frames = numpy.concatenate(parts) if len(parts) > 1 else parts[0]
+        offset = self.first_frames[first]
+        return frames[start - offset:stop - offset]
+
+    def samples(self, start=0, stop=None):
+        return self.raw_frames(start, stop) * self.scale()
+
+    def times(self, start=0, stop=None):
+        if self._times is None:
+            self._times = sample_clock.reconstruct_times(self.frame_count, self.sample_rate, self.events)
+        return self._times[start:stop]
+
+    def gaps(self):
+        return [event for event in self.events if event.get("event") == "gap"]
+
+    def marks(self):
+        return sorted((event for event in self.events if event.get("event") == "mark"), key=lambda e: e["time"])
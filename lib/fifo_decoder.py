@@ -0,0 +1,59 @@
+"""Vectorized decoding of MPU-6050 FIFO bursts.
+
+The FIFO delivers big-endian int16 words, ACCEL X Y Z first and then
+GYRO X Y Z when the gyro is enabled. A whole burst is decoded at once
+into an (N, 3) or (N, 6) numpy array, without touching single samples
+from python.
+"""
+
+import numpy
+
+GRAVITIY_MS2 = 9.80665
+
+ACCEL_SCALE_MODIFIER_2G = 16384.0
+GYRO_SCALE_MODIFIER_250DEG = 131.0
+
+RAW_DTYPE = numpy.dtype(">i2")
+
+
+def packet_columns(capture_gyro):
+    """Returns the amount of int16 words in one FIFO packet."""
+    if capture_gyro:
+        return 6
+    return 3
+
+
+def scale_factors(capture_gyro, accel_scale_modifier=ACCEL_SCALE_MODIFIER_2G,
+                  gyro_scale_modifier=GYRO_SCALE_MODIFIER_250DEG):
+    """Builds the per column multipliers from raw counts to physical units.
+
+    Accel columns are converted to m/s^2 and gyro columns to deg/s.
+    """
+    factors = [GRAVITIY_MS2 / accel_scale_modifier] * 3
+    if capture_gyro:
+        factors += [1.0 / gyro_scale_modifier] * 3
+    return numpy.array(factors, dtype=numpy.float64)
+
+
+def decode_raw(buffer, capture_gyro):
+    """Views a burst of FIFO bytes as an (N, columns) int16 array.
+
+    buffer -- bytes/bytearray with a multiple of the packet size. Trailing
+    bytes of an incomplete packet are ignored.
+    """
+    columns = packet_columns(capture_gyro)
+    packet_size = columns * RAW_DTYPE.itemsize
+    length = len(buffer) - len(buffer) % packet_size
+    raw = numpy.frombuffer(buffer, dtype=RAW_DTYPE, count=length // RAW_DTYPE.itemsize)
+    return raw.reshape(-1, columns)
+
+
+def decode_FIFO_burst(buffer, capture_gyro, accel_scale_modifier=ACCEL_SCALE_MODIFIER_2G,
+                      gyro_scale_modifier=GYRO_SCALE_MODIFIER_250DEG):
+    """Decodes a burst of FIFO bytes into physical units.
+
+    Returns an (N, 3) array (X Y Z in m/s^2) or an (N, 6) array
+    (X Y Z in m/s^2, GX GY GZ in deg/s) when capture_gyro is True.
+    """
+    raw = decode_raw(buffer, capture_gyro)
+    return raw * scale_factors(capture_gyro, accel_scale_modifier, gyro_scale_modifier)
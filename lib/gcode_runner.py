@@ -0,0 +1,155 @@
+"""Background streaming of G-code scripts to the printer.
+
+GcodeRunner sends a list of commands from its own thread, in batches,
+and keeps at most window printer commands waiting for an "ok". The
+printer acknowledges a command once its planner accepted it, so the
+script runs as fast as the planner drains and no fixed delay is needed.
+
+The plugin feeds the acknowledgements in with on_ack(), from the
+gcode.received hook. The "ok" lines cannot be matched to the commands
+that caused them, an acknowledgement of a command OctoPrint sent itself
+(e.g. a temperature poll) frees a slot too; the window keeps that error
+small. @ commands are handled by OctoPrint and never acknowledged, so
+they do not take a slot.
+"""
+
+import threading
+
+from .sample_clock import monotonic
+
+STATE_RUNNING = "running"
+STATE_PAUSED = "paused"
+STATE_CANCELLED = "cancelled"
+STATE_FINISHED = "finished"
+
+
+def parse_script(lines):
+    """Returns the commands of a G-code script, without comments and blank lines, upper case."""
+    commands = []
+    for line in lines:
+        command = line.split(";", 1)[0].strip().upper()
+        if command:
+            commands.append(command)
+    return commands
+
+
+class GcodeRunner(threading.Thread):
+    """Streams commands to send(list_of_commands) with acknowledgement pacing.
+
+    name -- script name, reported with the progress.
+    window -- printer commands allowed to wait for an acknowledgement.
+    batch -- most commands handed to send at once.
+    ack_timeout -- seconds without acknowledgement after which the
+                   outstanding commands are assumed done, so a missed "ok"
+                   cannot stall the script.
+    on_progress -- callable receiving the progress() dict after every batch
+                   and state change.
+    """
+
+    def __init__(self, commands, send, name=None, window=4, batch=4, ack_timeout=10.0, on_progress=None,
+                 logger=None):
+        threading.Thread.__init__(self)
+        self.name = "Shooting G-code"
+        self.daemon = True
+
+        self.commands = list(commands)
+        self.send = send
+        self.script = name
+        self.window = window
+        self.batch = batch
+        self.ack_timeout = ack_timeout
+        self.on_progress = on_progress
+        self.logger = logger
+
+        self.condition = threading.Condition()
+        self.state = STATE_RUNNING
+        self.sent = 0
+        self.in_flight = 0
+        self.acknowledged = 0
+        self.start_time = None
+        self.end_time = None
+
+    def run(self):
+        self.start_time = monotonic()
+        total = len(self.commands)
+
+        while True:
+            with self.condition:
+                while self.state == STATE_PAUSED:
+                    self.condition.wait()
+                if self.state == STATE_CANCELLED or self.sent >= total:
+                    break
+
+                if self.in_flight >= self.window:
+                    waited_since = monotonic()
+                    self.condition.wait(self.ack_timeout)
+                    if self.in_flight >= self.window and monotonic() - waited_since >= self.ack_timeout:
+                        self._log_warning("No acknowledgement for %.1f s, resuming" % self.ack_timeout)
+                        self.in_flight = 0
+                    continue
+
+                lines = []
+                while self.sent < total and len(lines) < self.batch and self.in_flight < self.window:
+                    command = self.commands[self.sent]
+                    lines.append(command)
+                    self.sent += 1
+                    if not command.startswith("@"):
+                        self.in_flight += 1
+
+            self.send(lines)
+            self._report()
+
+        with self.condition:
+            if self.state != STATE_CANCELLED:
+                self.state = STATE_FINISHED
+        self.end_time = monotonic()
+        self._report()
+
+    def on_ack(self):
+        """Called for every "ok" received from the printer."""
+        with self.condition:
+            if self.in_flight:
+                self.in_flight -= 1
+                self.acknowledged += 1
+                self.condition.notify_all()
+
+    def pause(self):
+        self._set_state(STATE_PAUSED, (STATE_RUNNING,))
+
+    def resume(self):
+        self._set_state(STATE_RUNNING, (STATE_PAUSED,))
+
+    def cancel(self):
+        self._set_state(STATE_CANCELLED, (STATE_RUNNING, STATE_PAUSED))
+
+    def _set_state(self, state, allowed):
+        with self.condition:
+            if self.state not in allowed:
+                return
+            self.state = state
+            self.condition.notify_all()
+        self._report()
+
+    @property
+    def active(self):
+        return self.state in (STATE_RUNNING, STATE_PAUSED)
+
+    def progress(self):
+        with self.condition:
+            end = self.end_time if self.end_time is not None else monotonic()
+            return dict(
+                script=self.script,
+                state=self.state,
+                sent=self.sent,
+                total=len(self.commands),
+                in_flight=self.in_flight,
+                elapsed=round(end - self.start_time, 3) if self.start_time is not None else 0.0
+            )
+
+    def _report(self):
+        if self.on_progress is not None:
+            self.on_progress(self.progress())
+
+    def _log_warning(self, message):
+        if self.logger is not None:
+            self.logger.warning(message)
@@ -0,0 +1,20 @@
+"""I2C bus access for the sensor drivers.
+
+A bus is any object with the SMBus methods used by the drivers:
+read_byte_data, write_byte_data, read_i2c_block_data and
+write_i2c_block_data. On a Raspberry Pi that is smbus.SMBus, off-device
+lib.simulated_bus.SimulatedBus can be used instead.
+"""
+
+
+def open_bus(bus):
+    """Returns a bus object for bus.
+
+    bus -- the number of an I2C adapter (/dev/i2c-<bus>), opened with smbus,
+    or an already built bus object which is returned as is.
+    """
+    if hasattr(bus, "read_byte_data"):
+        return bus
+
+    import smbus
+    return smbus.SMBus(bus)
@@ -0,0 +1,48 @@
+"""Decimation of a running capture for live display.
+
+LiveEnvelope is registered as a capture listener and reduces every
+decoded burst to the per axis minimum and maximum. pop_frame() returns
+the envelope of everything received since the previous frame, so the UI
+gets a fixed amount of data per frame whatever the sample rate is.
+"""
+
+import threading
+
+import numpy
+
+
+class LiveEnvelope(object):
+    """Per axis min/max envelope of the samples since the last frame."""
+
+    def __init__(self, axis):
+        self.axis = list(axis)
+        self.lock = threading.Lock()
+        self.total_samples = 0
+        self._reset()
+
+    def _reset(self):
+        self.minimum = numpy.full(len(self.axis), numpy.inf)
+        self.maximum = numpy.full(len(self.axis), -numpy.inf)
+        self.samples = 0
+
+    def __call__(self, samples):
+        """Capture listener, receives the decoded (N, axis) samples."""
+        if not len(samples):
+            return
+        minimum = samples.min(axis=0)
+        maximum = samples.max(axis=0)
+        with self.lock:
+            numpy.minimum(self.minimum, minimum, out=self.minimum)
+            numpy.maximum(self.maximum, maximum, out=self.maximum)
+            self.samples += len(samples)
+            self.total_samples += len(samples)
+
+    def pop_frame(self):
+        """Returns the envelope since the last call as a dict, None if no sample arrived."""
+        with self.lock:
+            if not self.samples:
+                return None
+            frame = dict(axis=self.axis, min=[round(float(v), 4) for v in self.minimum],
+                         max=[round(float(v), 4) for v in self.maximum], samples=self.samples)
+            self._reset()
+        return frame
@@ -16,15 +16,26 @@ Code based on:
      Released under the MIT license
      Copyright (c) 2012 Jeff Rowberg
 
+The module is part of the lib package, run its 5 minute demo capture from
+the repository root with:
+
+    python -m lib.mpu6050
 """
 
-import csv
 import ctypes
 import sys
 import threading
 import time
 
-import smbus
+from . import capture_file
+from . import capture_metrics
+from . import capture_rotation
+from . import compressed_capture
+from . import i2c_bus
+from . import ring_buffer
+from .capture_consumer import CaptureConsumer
+from . import sample_clock
+from . import wait_strategy
 
 
 class mpu6050(threading.Thread):
@@ -35,6 +46,8 @@ class mpu6050(threading.Thread):
     capturingData = False
     logger = None
     basefolder = "."
+    wait_mode = wait_strategy.WAIT_SLEEP
+    int_source = None
     axis = ["X", "Y", "Z", "GX", "GY", "GZ"]  #
     x_accel_offset = 2354
     y_accel_offset = 640
@@ -161,10 +174,76 @@ class mpu6050(threading.Thread):
     FIFO_COUNT = 0x72  # 16-bit value
     FIFO_R_W = 0x74  # FIFO data register
 
-    def __init__(self, address, bus=1, logger=None, basefolder=None):
+    FIFO_SIZE = 1024  # bytes of FIFO buffer on silicon
+    I2C_BLOCK_MAX = 32  # largest SMBus block transfer
+
+    GYRO_OUTPUT_RATE_DLPF_OFF = 8000.0  # Hz, DLPF_CFG = 0 or 7
+    GYRO_OUTPUT_RATE_DLPF_ON = 1000.0  # Hz
+
+    rate_divider = 0
+    dlpf_mode = DLPF_BW_260
+
+    # Physical value -> register value of the configurable settings
+    ACCEL_RANGES = {2: ACCEL_RANGE_2G, 4: ACCEL_RANGE_4G, 8: ACCEL_RANGE_8G, 16: ACCEL_RANGE_16G}
+    GYRO_RANGES = {250: GYRO_RANGE_250DEG, 500: GYRO_RANGE_500DEG, 1000: GYRO_RANGE_1000DEG,
+                   2000: GYRO_RANGE_2000DEG}
+    DLPF_BANDWIDTHS = {260: DLPF_BW_260, 184: DLPF_BW_184, 94: DLPF_BW_94, 44: DLPF_BW_44, 21: DLPF_BW_21,
+                       10: DLPF_BW_10, 5: DLPF_BW_5}
+    ACCEL_SCALE_MODIFIERS = {2: ACCEL_SCALE_MODIFIER_2G, 4: ACCEL_SCALE_MODIFIER_4G, 8: ACCEL_SCALE_MODIFIER_8G,
+                             16: ACCEL_SCALE_MODIFIER_16G}
+    GYRO_SCALE_MODIFIERS = {250: GYRO_SCALE_MODIFIER_250DEG, 500: GYRO_SCALE_MODIFIER_500DEG,
+                            1000: GYRO_SCALE_MODIFIER_1000DEG, 2000: GYRO_SCALE_MODIFIER_2000DEG}
+    # registers only changed through write_bit(s), kept in the shadow copy; value: self-clearing bits
+    SHADOWED_REGISTERS = {PWR_MGMT_1: 1 << PWR_MGMT1_DEVICE_RESET_BIT, CONFIG: 0, GYRO_CONFIG: 0, ACCEL_CONFIG: 0,
+                          FIFO_EN: 0, USER_CTRL: 0x07}  # USER_CTRL: FIFO, I2C master and signal path resets
+    AXIS_ACCEL = ["X", "Y", "Z"]
+    AXIS_ACCEL_GYRO = ["X", "Y", "Z", "GX", "GY", "GZ"]
+    MIN_SAMPLE_RATE = 4  # Hz, 1kHz / (1 + 255)
+    MAX_SAMPLE_RATE = 1000  # Hz, output rate of the accelerometer
+
+    # Capture settings and statistics
+    sample_rate = 100  # Hz
+    accel_range = 2  # g
+    gyro_range = 250  # deg/s
+    dlpf_bandwidth = 44  # Hz
+    wait_watermark = 256  # bytes, for the sleep wait mode
+    compress = False  # write compressed_capture files instead of plain binary ones
+    max_duration = 300  # seconds after which a capture stops itself, 0 for no limit
+    rotate_seconds = 0  # start a new segment file every rotate_seconds of samples, 0 for a single file
+    rotate_bytes = 0  # start a new segment file once the current one reaches rotate_bytes, 0 for no limit
+    packet_count = 0
+    packet_loss = 0
+    overflow_count = 0
+    recovered_packets = 0  # whole packets drained from the FIFO on resynchronizations
+    bus_saturated = False  # the last burst read slower than the sensor fills the FIFO
+    dropped_chunks = 0
+    ring_capacity = 256  # bursts buffered between acquisition and consumer
+    listeners = ()  # callables receiving the decoded samples
+    metadata = None  # extra fields stored in the capture header, e.g. the G-code script
+    capture_path = None  # file of the current or last capture
+    on_capture_closed = None  # callable receiving the mpu6050 instance once the capture file is complete
+    on_segment_closed = None  # callable receiving the path of every segment completed by a rotation
+    capture_clock = None  # SampleClock of the running capture
+    capture_consumer = None  # CaptureConsumer of the running capture
+    capture_ring = None  # RingBuffer between acquisition and consumer of the running capture
+    capture_packet_size = 0  # bytes per FIFO packet of the running capture
+    capture_fifo_en = 0  # FIFO_EN value of the running capture
+    capture_budget = None  # wait_strategy.DrainBudget of the running or last capture
+    armed = None  # configuration written by arm(), None when the registers may differ from it
+    keep_int_source = False  # keep the interrupt source open between captures, see standby.StandbySensor
+    start_requested = None  # monotonic time of the start request of the running capture
+    start_latency = None  # dict of seconds from the start request to the FIFO start, first sample and first read
+
+    def __init__(self, address, bus=1, logger=None, basefolder=None, wait_mode=wait_strategy.WAIT_SLEEP,
+                 int_source=None, metrics=None):
         # Set up mpu6050
         self.address = address
-        self.bus = smbus.SMBus(bus)
+        self.wait_mode = wait_mode
+        self.int_source = int_source
+        # counters outlive the instance when the caller keeps them, e.g. in a capture_metrics.MetricsRegistry
+        self.metrics = metrics if metrics is not None else capture_metrics.CaptureMetrics()
+        self.bus = capture_metrics.InstrumentedBus(i2c_bus.open_bus(bus), self.metrics)
+        self.shadow = dict()
         self.wake_up()
         self.logger = logger
         if self.basefolder is not None:
@@ -231,6 +310,66 @@ class mpu6050(threading.Thread):
         if not self.capturingData:
             return
 
+        self.open_capture()
+        consumer = self.capture_consumer
+
+        if self.wait_mode == wait_strategy.WAIT_SLEEP:
+            waiter = wait_strategy.create(self.wait_mode, watermark=self.wait_watermark)
+        elif self.wait_mode == wait_strategy.WAIT_INTERRUPT:
+            waiter = wait_strategy.create(self.wait_mode, self.int_source, close_source=not self.keep_int_source)
+        else:
+            waiter = wait_strategy.create(self.wait_mode, self.int_source)
+        waiter.prepare(self)
+        packet_size = self.capture_packet_size
+        budget = self.capture_budget
+        self.log_debug("Waiting for data in %s mode" % waiter.name)
+
+        self.log_debug("Begin while")
+
+        while self.capturingData:
+            try:
+                wait_threshold = budget.threshold(waiter.threshold(packet_size))
+                FIFO_count = self.get_FIFO_count()
+                mpu_int_status = self.get_int_status()
+
+                while self.capturingData and FIFO_count < wait_threshold and not (
+                    mpu_int_status & self.INT_ENABLE_FIFO_OFLOW_INT):
+                    # self.log_debug("WAIT: FIFO count: %s Interrupt: %s" % (FIFO_count, mpu_int_status))
+                    waiter.wait(FIFO_count, packet_size, wait_threshold)
+                    self.metrics.wait_iterations += 1
+                    FIFO_count = self.get_FIFO_count()
+                    mpu_int_status = self.get_int_status()
+
+                self.service_FIFO(FIFO_count, mpu_int_status)
+
+            except (IOError) as e:
+                self.recover_FIFO(e)
+            except (RuntimeError, TypeError, NameError) as e:
+                self.log_exception("Exception: " + str(e))
+                consumer.stop()
+                self.capturingData = False
+                self.log_debug("Dirty Exit")
+                raise
+            except:
+                self.log_exception("Unexpected error: " + str(sys.exc_info()))
+                consumer.stop()
+                self.capturingData = False
+                self.log_debug("Dirty Exit")
+                raise
+
+        waiter.close()
+        self.close_capture()
+
+        self.log_debug("Clean Exit")
+
+    def open_capture(self, epoch=None, log_file=None):
+        """Configures the sensor, opens the capture file and starts the consumer.
+
+        The FIFO is reset last, sample 0 is the first one measured after this call.
+        epoch -- monotonic time the event times are relative to, shared by
+                 the sensors of a capture_session; the FIFO start by default.
+        log_file -- capture path without extension, a timestamped name in basefolder by default.
+        """
         self.log_debug("Opening logfile")
 
         if "GX" in self.axis:
@@ -240,30 +379,102 @@ class mpu6050(threading.Thread):
 
         if capture_gyro:
             packet_size = 12
+            axis_names = self.AXIS_ACCEL_GYRO
         else:
             packet_size = 6
+            axis_names = self.AXIS_ACCEL
 
-        log_file = self.basefolder + "/mpu6050_" + time.strftime("%Y%m%d-%H%M%S", time.localtime()) + ".csv"
+        accel_scale_modifier = self.ACCEL_SCALE_MODIFIERS[self.accel_range]
+        gyro_scale_modifier = self.GYRO_SCALE_MODIFIERS[self.gyro_range]
 
-        log_fd = open(log_file, 'wb')
-        csv_writer = csv.writer(log_fd, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+        fifo_en = 1 << self.FIFO_EN_ACCEL_BIT  # use FIFO for accel
+        if capture_gyro:
+            # use FIFO for Gyro X, Y and Z
+            fifo_en |= (1 << self.FIFO_EN_XG_BIT) | (1 << self.FIFO_EN_YG_BIT) | (1 << self.FIFO_EN_ZG_BIT)
+
+        self.arm()
+
+        # chunks are compressed by the consumer thread, acquisition only ever copies raw bursts
+        writer_class = compressed_capture.CompressedCaptureWriter if self.compress else capture_file.CaptureWriter
+        if log_file is None:
+            log_file = self.basefolder + "/mpu6050_" + time.strftime("%Y%m%d-%H%M%S", time.localtime())
+        log_file += compressed_capture.EXTENSION if self.compress else capture_file.EXTENSION
+
+        header = dict(
+            start_time=time.time(),
+            sample_rate=self.get_sample_rate(),
+            rate_divider=self.rate_divider,
+            dlpf_mode=self.dlpf_mode,
+            accel_range=self.accel_range,
+            gyro_range=self.gyro_range,
+            dlpf_bandwidth=self.dlpf_bandwidth,
+            accel_scale_modifier=accel_scale_modifier,
+            gyro_scale_modifier=gyro_scale_modifier,
+            offsets=dict(X=self.x_accel_offset, Y=self.y_accel_offset, Z=self.z_accel_offset,
+                         GX=self.x_gyro_offset, GY=self.y_gyro_offset, GZ=self.z_gyro_offset),
+            axis=axis_names
+        )
+        header.update(self.metadata or dict())
+        if self.rotate_seconds or self.rotate_bytes:
+            # rotation runs in the consumer thread, with the writes
+            log_fd = capture_rotation.RotatingWriter(writer_class, log_file, header, self.rotate_seconds,
+                                                     self.rotate_bytes, self._segment_closed)
+        else:
+            log_fd = writer_class(log_file, header)
+        self.capture_path = log_fd.path
 
         self.log_debug("Logfile opened")
 
+        # acquisition only moves raw bursts to the ring, the consumer decodes and persists them
+        ring = ring_buffer.RingBuffer(self.ring_capacity, self.FIFO_SIZE)
+        consumer = CaptureConsumer(self, ring, log_fd, capture_gyro, axis_names,
+                                   accel_scale_modifier, gyro_scale_modifier)
+        for listener in self.listeners:
+            consumer.add_listener(listener)
+        consumer.start()
+        self.capture_packet_size = packet_size
+        self.capture_ring = ring
+        self.capture_fifo_en = fifo_en
+        self.capture_budget = wait_strategy.DrainBudget(packet_size, self.get_sample_rate(), self.FIFO_SIZE)
+
+        clock = sample_clock.SampleClock(self.get_sample_rate(), epoch=epoch)
+        self.packet_count = 0
+        self.packet_loss = 0
+        self.overflow_count = 0
+        self.recovered_packets = 0
+        self.bus_saturated = False
+        self.dropped_chunks = 0
+        self.metrics.captures += 1
+        self.metrics.capturing = 1
+        self.metrics.queue_depth = 0
+        self.metrics.queue_high_water = 0
+
+        self.start_latency = None
+
+        # start feeding an empty FIFO, so sample 0 is the first one after here
+        self.reset_user_ctrl_FIFO()
+        self.write_register(self.FIFO_EN, fifo_en)
+        self.get_int_status()  # clears an overflow raised while configuring
+        consumer.post_event(clock.start())
+        self.capture_clock = clock
+        self.capture_consumer = consumer
+
+    def arm(self, force=False):
+        """Writes the acquisition configuration with the FIFO idle.
+
+        A capture only has to reset and enable the FIFO afterwards, so an
+        armed sensor starts sampling within a few transactions. Nothing is
+        written while the configuration is the one already armed.
+        force -- write every register again, e.g. after a bus error.
+        """
+        key = self._arm_key()
+        if self.armed == key and not force:
+            return
+        self.armed = None
+
         # FIFO stuff
-        self.reset_user_ctrl_FIFO()  # reset FIFO
         self.set_int_enable(self.INT_ENABLE_FIFO_OFLOW_INT)  # interrupt when data overflow
-        self.set_FIFO_config(self.FIFO_EN_ACCEL_BIT, 1)  # use FIFO for accel
-
-        if capture_gyro:
-            self.set_FIFO_config(self.FIFO_EN_ZG_BIT, 1)  # use FIFO for Gyro Z
-            self.set_FIFO_config(self.FIFO_EN_YG_BIT, 1)  # use FIFO for Gyro Y
-            self.set_FIFO_config(self.FIFO_EN_XG_BIT, 1)  # use FIFO for Gyro X
-        else:
-            self.set_FIFO_config(self.FIFO_EN_ZG_BIT, 0)  # use FIFO for Gyro Z
-            self.set_FIFO_config(self.FIFO_EN_YG_BIT, 0)  # use FIFO for Gyro Y
-            self.set_FIFO_config(self.FIFO_EN_XG_BIT, 0)  # use FIFO for Gyro X
-
+        self.write_register(self.FIFO_EN, 0)  # fed by open_capture only
         self.set_user_ctrl_FIFO_enable()  # enable using FIFO
 
         # Your offsets:	2348	635  	1776	 54	  49	 -27
@@ -275,144 +486,324 @@ class mpu6050(threading.Thread):
         self.set_x_gyro_offset(self.x_gyro_offset)
         self.set_y_gyro_offset(self.y_gyro_offset)
         self.set_z_gyro_offset(self.z_gyro_offset)
-        self.set_accel_range(self.ACCEL_RANGE_2G)  # set 2G for maximal sensibility
-        self.set_gyro_range(self.GYRO_RANGE_250DEG)  # set 250DEG for maximal sensibility
-        self.set_DLF_mode(self.DLPF_BW_44)  # digital low-pass filter
+        self.set_accel_range(self.ACCEL_RANGES[self.accel_range])  # 2G for maximal sensibility
+        self.set_gyro_range(self.GYRO_RANGES[self.gyro_range])  # 250DEG for maximal sensibility
+        self.set_DLF_mode(self.DLPF_BANDWIDTHS[self.dlpf_bandwidth])  # digital low-pass filter
 
-        if capture_gyro:
-            csv_writer.writerow(["Time", "X", "Y", "Z", "GX", "GY", "GZ"])
-            self.set_rate(1000 / 100)  # (1khz / 10) = 100 hz
-        else:
-            csv_writer.writerow(["Time", "X", "Y", "Z"])
-            self.set_rate(1000 / 100)  # (1khz / 5) = 200 hz
+        self.set_rate(self.get_rate_divider(self.sample_rate))
+        self.armed = key
+        self.log_debug("Armed at %s Hz" % self.get_sample_rate())
 
-        start_time = time.time()
-        packet_count = 0
-        packet_loss = 0
+    def _arm_key(self):
+        return (self.sample_rate, self.accel_range, self.gyro_range, self.dlpf_bandwidth,
+                self.x_accel_offset, self.y_accel_offset, self.z_accel_offset,
+                self.x_gyro_offset, self.y_gyro_offset, self.z_gyro_offset)
 
-        self.log_debug("Begin while")
+    def service_FIFO(self, FIFO_count, mpu_int_status):
+        """Handles one FIFO state of the running capture: resynchronizes it on
+        overflow, drains its whole packets otherwise.
 
-        while self.capturingData:
-            try:
-                FIFO_count = self.get_FIFO_count()
-                mpu_int_status = self.get_int_status()
+        Returns the number of frames read.
+        """
+        clock = self.capture_clock
+        packet_size = self.capture_packet_size
+
+        # If overflow is detected by status or fifo count the head of the FIFO lost its packet alignment
+        if (FIFO_count >= self.FIFO_SIZE) or (mpu_int_status & self.INT_ENABLE_FIFO_OFLOW_INT):
+            self.log_warning("OVERFLOW: FIFO count: %s Interrupt: %s, FIFO blow %s" % (
+                FIFO_count, mpu_int_status, FIFO_count >= self.FIFO_SIZE))
+            self.overflow_count += 1
+            self.metrics.overflow_resets += 1
+            return self.resync_FIFO()
+
+        if not mpu_int_status & self.INT_ENABLE_DATA_RDY_EN:
+            return 0
+
+        self.capture_budget.record_wake(FIFO_count)
+
+        # drain every whole packet available in block transfers, without an overflow the head is
+        # aligned and a partial count is a packet still being written, left for the next burst
+        started = sample_clock.monotonic()
+        FIFO_buffer = self.get_FIFO_burst(packet_size, FIFO_count)
+        duration = sample_clock.monotonic() - started
+        self.capture_budget.record_read(len(FIFO_buffer), duration)
+        self.metrics.bursts += 1
+        self.metrics.burst_latency.observe(duration)
+        if not self.capture_budget.can_keep_up():
+            self.metrics.saturated_bursts += 1
+            if not self.bus_saturated:
+                self.log_warning("The bus reads the FIFO slower than the sensor fills it, samples will be lost: "
+                                 "lower the sample rate or capture fewer axes")
+        self.bus_saturated = not self.capture_budget.can_keep_up()
+        if not FIFO_buffer:
+            return 0
+
+        frames = self._store_frames(FIFO_buffer)
+
+        # safety exit, unless the capture is unbounded
+        if self.max_duration and clock.elapsed() - clock.start_offset > self.max_duration:
+            self.log_warning("Timeout")
+            self.capturingData = False
+        return frames
+
+    def resync_FIFO(self):
+        """Recovers the packet alignment of the FIFO, keeping the whole packets it holds.
+
+        The sensors stop feeding the FIFO, so its content holds still. Packets
+        always end at the tail of the FIFO (an overflow drops the oldest
+        bytes), so the count modulo the packet size is the partial packet at
+        its head: it is discarded and the rest drained. The samples
+        overwritten before the drained packets and the ones measured while
+        the FIFO was stopped are recorded as gaps.
+        Returns the number of frames recovered.
+        """
+        clock = self.capture_clock
+        packet_size = self.capture_packet_size
+        self.metrics.resyncs += 1
+
+        self.write_register(self.FIFO_EN, 0)
+        stopped = clock.elapsed()
+        self.get_int_status()  # clears an overflow raised since the status was read
+        FIFO_count = min(self.get_FIFO_count(), self.FIFO_SIZE)
+        self.get_FIFO_bytes(FIFO_count % packet_size)
+        FIFO_buffer = self.get_FIFO_bytes(FIFO_count - FIFO_count % packet_size)
+        frames = len(FIFO_buffer) // packet_size
+
+        # the drained packets are the newest samples before the stop
+        overwritten = int(round(clock.expected_index(stopped) - clock.sample_index)) - frames
+        self._post_gap(clock.gap(max(0, overwritten), elapsed=stopped - frames / clock.rate))
+        if frames:
+            self._store_frames(FIFO_buffer, elapsed=stopped)
+            self.recovered_packets += frames
+            self.metrics.recovered_samples += frames
+
+        self.reset_user_ctrl_FIFO()
+        self.write_register(self.FIFO_EN, self.capture_fifo_en)
+        self._post_gap(clock.gap())
+        return frames
+
+    def recover_FIFO(self, error):
+        """Resynchronizes the FIFO after a bus error, restarts it when that fails too."""
+        self.log_warning("Exception: " + str(error))
+        try:
+            self.resync_FIFO()
+        except IOError as e:
+            self.log_warning("Resynchronization failed: " + str(e))
+            self.reset_user_ctrl_FIFO()
+            self.write_register(self.FIFO_EN, self.capture_fifo_en)
+            self._post_gap(self.capture_clock.gap())
+
+    def _store_frames(self, FIFO_buffer, elapsed=None):
+        """Hands whole packets to the consumer and accounts them on the clock.
+
+        Returns the number of frames.
+        """
+        clock = self.capture_clock
+        consumer = self.capture_consumer
+        ring = self.capture_ring
+        metrics = self.metrics
+        frames = len(FIFO_buffer) // self.capture_packet_size
+        if self.start_requested is not None:
+            self._record_start_latency()
+        self.packet_count += frames
+        metrics.samples += frames
+
+        sync = clock.advance(frames, elapsed)
+        if sync is not None:
+            consumer.post_event(sync)
+
+        if not ring.put(FIFO_buffer):
+            # the consumer fell behind, the burst is lost
+            gap = clock.drop(frames)
+            consumer.post_event(gap)
+            self.packet_count -= frames
+            self.packet_loss += frames
+            metrics.samples -= frames
+            metrics.lost_samples += frames
+            metrics.dropped_chunks += 1
+        metrics.queue_depth = len(ring)
+        metrics.queue_high_water = ring.high_water
+        return frames
+
+    def _record_start_latency(self):
+        """Measures the start of the capture against its request, on the first frames read."""
+        requested, self.start_requested = self.start_requested, None
+        clock = self.capture_clock
+        fifo = clock.start_time - requested
+        self.start_latency = dict(fifo=fifo, first_sample=fifo + 1.0 / clock.sample_rate,
+                                  first_read=sample_clock.monotonic() - requested)
+        self.metrics.start_latency.observe(self.start_latency["first_sample"])
+        self.log("Start latency: FIFO %.1f ms, first sample %.1f ms, first read %.1f ms" % (
+            fifo * 1000, self.start_latency["first_sample"] * 1000, self.start_latency["first_read"] * 1000))
+
+    def _post_gap(self, gap):
+        if gap["samples"]:
+            self.capture_consumer.post_event(gap)
+            self.packet_loss += gap["samples"]
+            self.metrics.lost_samples += gap["samples"]
+
+    def close_capture(self):
+        """Waits for the consumer to persist everything and closes the capture."""
+        ring = self.capture_ring
+        consumer = self.capture_consumer
+        try:
+            # the sensor stays armed, with an idle FIFO, until the next capture
+            self.write_register(self.FIFO_EN, 0)
+        except IOError as e:
+            self.log_warning("Could not stop the FIFO: " + str(e))
+            self.armed = None
+        self.start_requested = None
+        self.capture_clock = None
+        self.capture_consumer = None
+        self.capture_ring = None
+        consumer.stop()
+        consumer.join()
+        self.metrics.capturing = 0
+        self.metrics.queue_depth = 0
+        self.capture_path = consumer.writer.path  # the last segment of a rotating capture
+        self.dropped_chunks = ring.dropped_chunks
+        if ring.dropped_chunks:
+            self.log_warning("Consumer fell behind, %d chunks dropped" % ring.dropped_chunks)
+
+        if self.on_capture_closed is not None:
+            self.on_capture_closed(self)
+
+    def recording_path(self):
+        """Returns the file the running capture writes to, None when no capture runs."""
+        consumer = self.capture_consumer
+        return consumer.writer.path if consumer is not None else None
+
+    def _segment_closed(self, path):
+        self.log("Capture segment %s complete" % path)
+        if self.on_segment_closed is not None:
+            self.on_segment_closed(path)
 
-                while self.capturingData and FIFO_count < packet_size and not (
-                    mpu_int_status & self.INT_ENABLE_FIFO_OFLOW_INT):
-                    # self.log_debug("WAIT: FIFO count: %s Interrupt: %s" % (FIFO_count, mpu_int_status))
-                    FIFO_count = self.get_FIFO_count()
-                    mpu_int_status = self.get_int_status()
+    def stop(self):
+        self.capturingData = False
 
-                # If overflow is detected by status or fifo count we want to reset
-                if (FIFO_count > 1024) or (mpu_int_status & self.INT_ENABLE_FIFO_OFLOW_INT):
-                    self.reset_user_ctrl_FIFO()
-                    self.log_warning("OVERFLOW: FIFO count: %s Interrupt: %s, FIFO blow %s" % (
-                        FIFO_count, mpu_int_status, FIFO_count > 1024))
-                    packet_loss += FIFO_count / packet_size
-                elif mpu_int_status & self.INT_ENABLE_DATA_RDY_EN and (FIFO_count % packet_size) is 0:
-                    while self.capturingData and FIFO_count > packet_size:
-                        packet_count += 1
-                        # self.log_debug("READING: FIFO count: %s Interrupt: %s" % (FIFO_count, mpu_int_status))
-                        FIFO_buffer = self.get_FIFO_bytes(packet_size)
-                        # self.log_debug("READING 0")
-                        acc_x = ctypes.c_int16((FIFO_buffer[0] << 8) + FIFO_buffer[1]).value
-                        acc_y = ctypes.c_int16((FIFO_buffer[2] << 8) + FIFO_buffer[3]).value
-                        acc_z = ctypes.c_int16((FIFO_buffer[4] << 8) + FIFO_buffer[5]).value
-                        acc_x /= self.ACCEL_SCALE_MODIFIER_2G
-                        acc_y /= self.ACCEL_SCALE_MODIFIER_2G
-                        acc_z /= self.ACCEL_SCALE_MODIFIER_2G
-                        acc_x *= self.GRAVITIY_MS2
-                        acc_y *= self.GRAVITIY_MS2
-                        acc_z *= self.GRAVITIY_MS2
-
-                        delta_time = (time.time() - start_time)
-
-                        if capture_gyro:
-                            gyro_x = ctypes.c_int16((FIFO_buffer[6] << 8) + FIFO_buffer[7]).value
-                            gyro_y = ctypes.c_int16((FIFO_buffer[8] << 8) + FIFO_buffer[9]).value
-                            gyro_z = ctypes.c_int16((FIFO_buffer[10] << 8) + FIFO_buffer[11]).value
-                            gyro_x /= self.GYRO_SCALE_MODIFIER_250DEG
-                            gyro_y /= self.GYRO_SCALE_MODIFIER_250DEG
-                            gyro_z /= self.GYRO_SCALE_MODIFIER_250DEG
-
-                            if packet_count % 50 is 0:
-                                self.log_debug(
-                                    "Time: %3.5f Packets: %s Loss: %s X: %3.5f Y: %3.5f Z: %3.5f, GX: %3.5f, GY: %3.5f, GZ: %3.5f" % (
-                                        delta_time, packet_count, packet_loss,
-                                        acc_x, acc_y, acc_z, gyro_x, gyro_y, gyro_z))
-                        elif packet_count % 50 is 0:
-                            self.log_debug("Time: %3.5f Packets: %s Loss: %s X: %3.5f Y: %3.5f Z: %3.5f" % (
-                                delta_time, packet_count, packet_loss, acc_x, acc_y, acc_z))
-
-                        if capture_gyro:
-                            data_concat = [
-                                "%.3f" % delta_time,
-                                "%.5f" % acc_x,
-                                "%.5f" % acc_y,
-                                "%.5f" % acc_z,
-                                "%.5f" % gyro_x,
-                                "%.5f" % gyro_y,
-                                "%.5f" % gyro_z
-                            ]
-                        else:
-                            data_concat = [
-                                "%.3f" % delta_time,
-                                "%.5f" % acc_x,
-                                "%.5f" % acc_y,
-                                "%.5f" % acc_z
-                            ]
-
-                        csv_writer.writerow(data_concat)
-
-                        if FIFO_count < packet_size:
-                            FIFO_count = 0
-                        else:
-                            FIFO_count -= packet_size
-
-                        # safety exit if more than 5 minutes recording
-                        if delta_time > 300:
-                            self.log_warning("Timeout")
-                            self.capturingData = False
+    def mark(self, label):
+        """Records a marker event at the current time of the running capture.
 
-            except (IOError) as e:
-                self.log_warning("Exception: " + str(e))
-                self.reset_user_ctrl_FIFO()
-                packet_loss += FIFO_count / packet_size
-            except (RuntimeError, TypeError, NameError) as e:
-                self.log_exception("Exception: " + str(e))
-                if log_fd:
-                    log_fd.close()
-                self.capturingData = False
-                self.log_debug("Dirty Exit")
-                raise
-            except:
-                self.log_exception("Unexpected error: " + str(sys.exc_info()))
-                if log_fd:
-                    log_fd.close()
-                self.capturingData = False
-                self.log_debug("Dirty Exit")
-                raise
+        label -- free text, e.g. the name of the move starting now.
+        Returns False when no capture is running.
+        """
+        clock, consumer = self.capture_clock, self.capture_consumer
+        if clock is None or consumer is None:
+            return False
+        consumer.post_event(clock.mark(label))
+        return True
+
+    @classmethod
+    def validate_configuration(cls, sample_rate=None, accel_range=None, gyro_range=None, dlpf_bandwidth=None,
+                               capture_gyro=None, accel_offsets=None, gyro_offsets=None, wait_mode=None,
+                               wait_watermark=None, compress=None, max_duration=None, rotate_seconds=None,
+                               rotate_bytes=None):
+        """Checks the acquisition parameters accepted by configure().
+
+        Raises ValueError on the first invalid value.
+        """
+        if sample_rate is not None and not cls.MIN_SAMPLE_RATE <= sample_rate <= cls.MAX_SAMPLE_RATE:
+            raise ValueError("Sample rate must be between %d and %d Hz" % (cls.MIN_SAMPLE_RATE,
+                                                                          cls.MAX_SAMPLE_RATE))
+        if accel_range is not None and accel_range not in cls.ACCEL_RANGES:
+            raise ValueError("Accel range must be one of %s g" % sorted(cls.ACCEL_RANGES))
+        if gyro_range is not None and gyro_range not in cls.GYRO_RANGES:
+            raise ValueError("Gyro range must be one of %s deg/s" % sorted(cls.GYRO_RANGES))
+        if dlpf_bandwidth is not None and dlpf_bandwidth not in cls.DLPF_BANDWIDTHS:
+            raise ValueError("DLPF bandwidth must be one of %s Hz" % sorted(cls.DLPF_BANDWIDTHS))
+        for offsets in (accel_offsets, gyro_offsets):
+            if offsets is not None and (len(offsets) != 3 or any(not -32768 <= int(o) <= 32767 for o in offsets)):
+                raise ValueError("Offsets must be 3 values between -32768 and 32767")
+        if wait_mode is not None and wait_mode not in wait_strategy.WAIT_MODES:
+            raise ValueError("Wait mode must be one of %s" % ", ".join(wait_strategy.WAIT_MODES))
+        if wait_watermark is not None and not 0 < wait_watermark <= cls.FIFO_SIZE:
+            raise ValueError("Wait watermark must be between 1 and %d bytes" % cls.FIFO_SIZE)
+        for name, value in (("Maximum duration", max_duration), ("Rotation interval", rotate_seconds),
+                            ("Rotation size", rotate_bytes)):
+            if value is not None and value < 0:
+                raise ValueError("%s must be positive, or 0 for no limit" % name)
+
+    def configure(self, sample_rate=None, accel_range=None, gyro_range=None, dlpf_bandwidth=None,
+                  capture_gyro=None, accel_offsets=None, gyro_offsets=None, wait_mode=None, wait_watermark=None,
+                  compress=None, max_duration=None, rotate_seconds=None, rotate_bytes=None):
+        """Sets the acquisition parameters used by the next capture.
+
+        sample_rate -- Hz, from MIN_SAMPLE_RATE to MAX_SAMPLE_RATE.
+        accel_range -- g, one of ACCEL_RANGES.
+        gyro_range -- deg/s, one of GYRO_RANGES.
+        dlpf_bandwidth -- Hz, one of DLPF_BANDWIDTHS.
+        capture_gyro -- False for accel only (6 byte) packets.
+        accel_offsets, gyro_offsets -- (x, y, z) offset register values.
+        wait_mode -- one of wait_strategy.WAIT_MODES.
+        wait_watermark -- FIFO bytes to wait for in the sleep wait mode.
+        compress -- True to write compressed captures.
+        max_duration -- seconds after which the capture stops itself, 0 for no limit.
+        rotate_seconds, rotate_bytes -- segment limits of long captures, 0 for a single file.
+        Raises ValueError on invalid values, leaving the configuration untouched.
+        """
+        self.validate_configuration(sample_rate, accel_range, gyro_range, dlpf_bandwidth, capture_gyro,
+                                    accel_offsets, gyro_offsets, wait_mode, wait_watermark, compress,
+                                    max_duration, rotate_seconds, rotate_bytes)
+
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+        if accel_range is not None:
+            self.accel_range = accel_range
+        if gyro_range is not None:
+            self.gyro_range = gyro_range
+        if dlpf_bandwidth is not None:
+            self.dlpf_bandwidth = dlpf_bandwidth
+        if capture_gyro is not None:
+            self.axis = list(self.AXIS_ACCEL_GYRO if capture_gyro else self.AXIS_ACCEL)
+        if accel_offsets is not None:
+            self.x_accel_offset, self.y_accel_offset, self.z_accel_offset = [int(o) for o in accel_offsets]
+        if gyro_offsets is not None:
+            self.x_gyro_offset, self.y_gyro_offset, self.z_gyro_offset = [int(o) for o in gyro_offsets]
+        if wait_mode is not None:
+            self.wait_mode = wait_mode
+        if wait_watermark is not None:
+            self.wait_watermark = wait_watermark
+        if compress is not None:
+            self.compress = bool(compress)
+        if max_duration is not None:
+            self.max_duration = max_duration
+        if rotate_seconds is not None:
+            self.rotate_seconds = rotate_seconds
+        if rotate_bytes is not None:
+            self.rotate_bytes = rotate_bytes
 
-        if log_fd:
-            log_fd.close()
+    # Core bit and byte operations
+    def read_register(self, address):
+        """Reads a register, from the shadow copy when it holds it."""
+        if address in self.shadow:
+            return self.shadow[address]
+        value = self.bus.read_byte_data(self.address, address)
+        if address in self.SHADOWED_REGISTERS:
+            self.shadow[address] = value
+        return value
 
-        self.log_debug("Clean Exit")
+    def write_register(self, address, value):
+        """Writes a register and keeps its shadow copy in sync."""
+        value &= 0xFF
+        self.bus.write_byte_data(self.address, address, ctypes.c_int8(value).value)
+        if address in self.SHADOWED_REGISTERS:
+            # self-clearing bits read back as 0
+            self.shadow[address] = value & ~self.SHADOWED_REGISTERS[address]
 
-    def stop(self):
-        self.capturingData = False
+    def invalidate_shadow(self):
+        """Forgets the shadow copy, e.g. after the registers went back to their reset values."""
+        self.shadow.clear()
 
-    # Core bit and byte operations
     def read_bit(self, address, bit_position):
         return self.read_bits(address, bit_position, 1)
 
     def write_bit(self, address, bit_num, bit_value):
-        byte = self.bus.read_byte_data(self.address, address)
+        byte = self.read_register(address)
         if bit_value:
             byte |= 1 << bit_num
         else:
             byte &= ~(1 << bit_num)
-        self.bus.write_byte_data(self.address, address,
-                                 ctypes.c_int8(byte).value)
+        self.write_register(address, byte)
 
     def read_bits(self, address, bit_start, length):
         byte = self.bus.read_byte_data(self.address, address)
@@ -422,7 +813,7 @@ class mpu6050(threading.Thread):
         return byte
 
     def write_bits(self, address, bit_start, length, data):
-        byte = self.bus.read_byte_data(self.address, address)
+        byte = self.read_register(address)
         mask = ((1 << length) - 1) << (bit_start - length + 1)
         # Get data in position and zero all non-important bits in data
         data <<= bit_start - length + 1
@@ -431,8 +822,7 @@ class mpu6050(threading.Thread):
         byte &= ~mask
         byte = byte | data
         # Write the data to the I2C device
-        self.bus.write_byte_data(self.address, address,
-                                 ctypes.c_int8(byte).value)
+        self.write_register(address, byte)
 
     def wake_up(self):
         # Wake up the MPU-6050 since it starts in sleep mode
@@ -441,6 +831,9 @@ class mpu6050(threading.Thread):
     def reset(self):
         # Reset device
         self.write_bit(self.PWR_MGMT_1, self.PWR_MGMT1_DEVICE_RESET_BIT, 1)
+        # every register is back to its reset value, the shadow copy and the armed configuration are stale
+        self.invalidate_shadow()
+        self.armed = None
         time.sleep(50 / 1000)
 
     # I2C communication methods
@@ -470,6 +863,31 @@ class mpu6050(threading.Thread):
         once
         """
         self.bus.write_byte_data(self.address, self.SMPLRT_DIV, divider)
+        self.rate_divider = divider
+
+    def get_output_rate(self, dlpf_mode=None):
+        """Returns the gyroscope output rate in Hz the divider applies to.
+
+        dlpf_mode -- DLPF_CFG value, the last one set by default.
+        """
+        if dlpf_mode is None:
+            dlpf_mode = self.dlpf_mode
+        if dlpf_mode in (0, 7):
+            return self.GYRO_OUTPUT_RATE_DLPF_OFF
+        return self.GYRO_OUTPUT_RATE_DLPF_ON
+
+    def get_rate_divider(self, sample_rate, dlpf_mode=None):
+        """Returns the SMPLRT_DIV value closest to sample_rate (Hz), for dlpf_mode (the current one by default)."""
+        return max(0, min(255, int(round(self.get_output_rate(dlpf_mode) / sample_rate)) - 1))
+
+    def get_sample_rate(self):
+        """Returns the sample rate in Hz, from the last divider and DLPF mode set."""
+        return self.get_output_rate() / (1 + self.rate_divider)
+
+    def get_configured_sample_rate(self):
+        """Returns the sample rate in Hz the next capture runs at, from configure() settings."""
+        dlpf_mode = self.DLPF_BANDWIDTHS[self.dlpf_bandwidth]
+        return self.get_output_rate(dlpf_mode) / (1 + self.get_rate_divider(self.sample_rate, dlpf_mode))
 
     def set_DLF_mode(self, mode):
         """Configure the Digital Low-pass Filter.
@@ -486,6 +904,7 @@ class mpu6050(threading.Thread):
         """
         self.write_bits(self.CONFIG, self.CFG_DLPF_CFG_BIT,
                         self.CFG_DLPF_CFG_LENGTH, mode)
+        self.dlpf_mode = mode
 
     # Acceleration and gyro offset
     def set_x_accel_offset(self, offset):
@@ -524,15 +943,34 @@ class mpu6050(threading.Thread):
         self.bus.write_byte_data(self.address, self.ZG_OFFS_USRL,
                                  ctypes.c_int8(offset).value)
 
-    def get_FIFO_bytes(self, FIFO_count):  # @todo: fix reading timeout
+    def get_FIFO_bytes(self, FIFO_count):
         """Reads the FIFO buffer.
 
-        Returns a list of bytes with the data on FIFO buffer.
+        FIFO_count -- the amount of bytes to read.
+        Bytes are fetched with I2C block transfers of up to I2C_BLOCK_MAX bytes,
+        instead of one transaction per byte.
+        Returns a bytearray with the data on FIFO buffer.
+        """
+        return_buffer = bytearray()
+        remaining = FIFO_count
+        while remaining > 0:
+            length = min(remaining, self.I2C_BLOCK_MAX)
+            return_buffer.extend(self.bus.read_i2c_block_data(self.address, self.FIFO_R_W, length))
+            remaining -= length
+        return return_buffer
+
+    def get_FIFO_burst(self, packet_size, FIFO_count=None):
+        """Drains all the whole packets available on FIFO buffer.
+
+        packet_size -- the size in bytes of one FIFO packet.
+        FIFO_count -- the current FIFO count, read from the device if None.
+        Returns a bytearray with a multiple of packet_size bytes, possibly empty.
         """
-        return_list = list()
-        for index in range(0, FIFO_count):
-            return_list.append(self.bus.read_byte_data(self.address, self.FIFO_R_W))
-        return return_list
+        if FIFO_count is None:
+            FIFO_count = self.get_FIFO_count()
+
+        packets = min(FIFO_count, self.FIFO_SIZE) // packet_size
+        return self.get_FIFO_bytes(packets * packet_size)
 
     def get_int_enable(self):
         """Get the current configuration of which events will signal an interruption
@@ -572,9 +1010,12 @@ class mpu6050(threading.Thread):
         return value
 
     def get_FIFO_count(self):
-        """Reads the current amount of data on FIFO buffer."""
-        count = self.read_i2c_word(self.FIFO_COUNT)
-        return count
+        """Reads the current amount of data on FIFO buffer.
+
+        Both count registers are fetched in a single block transfer.
+        """
+        high, low = self.bus.read_i2c_block_data(self.address, self.FIFO_COUNT, 2)
+        return (high << 8) | low
 
     def set_user_ctrl_FIFO_enable(self):
         """Enables the FIFO buffer on USER_CTRL register."""
@@ -759,6 +1200,7 @@ class mpu6050(threading.Thread):
 
 
 if __name__ == "__main__":
+    # relative imports above: python -m lib.mpu6050, not python lib/mpu6050.py
     mpu = mpu6050(0x68, basefolder=".")
     mpu.start()
     time.sleep(300)
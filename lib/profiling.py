@@ -0,0 +1,150 @@
+"""On demand profiling of the capture and G-code threads.
+
+SamplingProfiler runs on its own thread for a bounded window and
+periodically samples the stacks of the target threads through
+sys._current_frames(). The profiled threads run no extra code at all,
+so profiling costs nothing while it is off, and it can start or stop
+at any time, in the middle of a capture.
+
+Results are written next to each other:
+
+    <name>.folded           -- collapsed stacks, "thread;outer;...;inner count" per line,
+                               for flamegraph.pl, speedscope or inferno
+    <name>.allocations.txt  -- tracemalloc: memory allocated during the window by the
+                               plugin modules, per line of code (Python 3 only)
+"""
+
+import collections
+import os
+import sys
+import threading
+import time
+
+from .sample_clock import monotonic
+
+MAX_DURATION = 300.0  # seconds
+
+
+def _stack(frame):
+    """Returns the folded representation of a stack, outermost frame first."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def _plugin_folders():
+    """Folders of the plugin packages, lib and octoprint_shooting (once OctoPrint loaded it).
+
+    Both are top level packages when installed, their parent is site-packages.
+    """
+    folders = [os.path.dirname(os.path.abspath(__file__))]
+    plugin = sys.modules.get("octoprint_shooting")
+    if plugin is not None and getattr(plugin, "__file__", None):
+        folders.append(os.path.dirname(os.path.abspath(plugin.__file__)))
+    return folders
+
+
+class SamplingProfiler(threading.Thread):
+    """Samples the stacks of the target threads for duration seconds.
+
+    targets -- callable returning a dict of name -> threading.Thread, called
+               on every sample so threads started during the window are
+               picked up.
+    path -- result path without extension.
+    interval -- seconds between samples.
+    trace_allocations -- also record the allocations with tracemalloc.
+    on_finished -- callable receiving the profiler once the results are written.
+    """
+
+    def __init__(self, targets, path, duration=10.0, interval=0.005, trace_allocations=True, on_finished=None,
+                 logger=None):
+        threading.Thread.__init__(self)
+        self.name = "Shooting profiler"
+        self.daemon = True
+
+        self.targets = targets
+        self.path = path
+        self.duration = min(float(duration), MAX_DURATION)
+        self.interval = interval
+        self.trace_allocations = trace_allocations
+        self.on_finished = on_finished
+        self.logger = logger
+
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.elapsed = 0.0
+        self.files = []
+        self.stopped = threading.Event()
+
+    def stop(self):
+        """Ends the window early, the results are still written."""
+        self.stopped.set()
+
+    def run(self):
+        tracemalloc, started_tracing, before = self._start_tracing()
+        started = monotonic()
+        try:
+            while not self.stopped.is_set() and monotonic() - started < self.duration:
+                self._sample()
+                self.stopped.wait(self.interval)
+            self.elapsed = monotonic() - started
+
+            self.files.append(self._write_stacks())
+            if before is not None:
+                self.files.append(self._write_allocations(tracemalloc, before))
+        except Exception as e:
+            self._log_exception("Profiling failed: %s" % e)
+        finally:
+            if started_tracing:
+                tracemalloc.stop()
+            if self.on_finished is not None:
+                self.on_finished(self)
+
+    def _sample(self):
+        frames = sys._current_frames()
+        for name, thread in self.targets().items():
+            frame = frames.get(thread.ident)
+            if frame is not None:
+                self.stacks[name + ";" + _stack(frame)] += 1
+        self.samples += 1
+
+    def _start_tracing(self):
+        if not self.trace_allocations:
+            return None, False, None
+        try:
+            import tracemalloc
+        except ImportError:
+            return None, False, None
+
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start(16)
+        return tracemalloc, started, tracemalloc.take_snapshot()
+
+    def _write_stacks(self):
+        path = self.path + ".folded"
+        with open(path, "w") as fd:
+            for stack, count in sorted(self.stacks.items()):
+                fd.write("%s %d\n" % (stack, count))
+        return path
+
+    def _write_allocations(self, tracemalloc, before, limit=50):
+        # allocations are process wide, the plugin modules are what the profiled threads run
+        filters = [tracemalloc.Filter(True, os.path.join(folder, "*")) for folder in _plugin_folders()]
+        after = tracemalloc.take_snapshot().filter_traces(filters)
+        statistics = after.compare_to(before.filter_traces(filters), "lineno")
+
+        path = self.path + ".allocations.txt"
+        with open(path, "w") as fd:
+            fd.write("# %d samples, %.1f s, %s\n" % (self.samples, self.elapsed,
+                                                   time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime())))
+            for statistic in statistics[:limit]:
+                fd.write("%s\n" % statistic)
+        return path
+
+    def _log_exception(self, message):
+        if self.logger is not None:
+            self.logger.exception(message)
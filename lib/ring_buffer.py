@@ -0,0 +1,86 @@
+"""Bounded single producer/single consumer ring of byte chunks.
+
+Storage is allocated once; put() copies a chunk into the next free slot
+and never blocks, so the acquisition thread is never held up by a slow
+consumer. When the ring is full the chunk is dropped and counted.
+"""
+
+import threading
+
+
+class RingBuffer(object):
+    """Ring of capacity slots of up to chunk_size bytes each."""
+
+    def __init__(self, capacity=256, chunk_size=1024):
+        self.capacity = capacity
+        self.chunk_size = chunk_size
+        self.storage = bytearray(capacity * chunk_size)
+        self.lengths = [0] * capacity
+        self.view = memoryview(self.storage)
+        self.head = 0  # next slot to write
+        self.tail = 0  # next slot to read
+        self.count = 0
+        self.dropped_chunks = 0
+        self.dropped_bytes = 0
+        self.high_water = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def __len__(self):
+        return self.count
+
+    def put(self, data):
+        """Copies data in the ring.
+
+        Returns False, and counts the drop, when the ring is full.
+        """
+        length = len(data)
+        if length > self.chunk_size:
+            raise ValueError("Chunk of %d bytes exceeds the slot size of %d" % (length, self.chunk_size))
+
+        with self.condition:
+            if self.count == self.capacity:
+                self.dropped_chunks += 1
+                self.dropped_bytes += length
+                return False
+            slot = self.head
+
+        # only the producer writes this slot until it is published below
+        start = slot * self.chunk_size
+        self.view[start:start + length] = data
+        self.lengths[slot] = length
+
+        with self.condition:
+            self.head = (slot + 1) % self.capacity
+            self.count += 1
+            self.high_water = max(self.high_water, self.count)
+            self.condition.notify()
+        return True
+
+    def peek(self, timeout=None):
+        """Waits for the oldest chunk and returns a memoryview on it.
+
+        The view stays valid until advance() is called.
+        Returns None on timeout, or when the ring is closed and empty.
+        """
+        with self.condition:
+            if self.count == 0 and not self.closed:
+                self.condition.wait(timeout)
+            if self.count == 0:
+                return None
+            slot = self.tail
+
+        start = slot * self.chunk_size
+        return self.view[start:start + self.lengths[slot]]
+
+    def advance(self):
+        """Releases the chunk returned by peek()."""
+        with self.condition:
+            self.tail = (self.tail + 1) % self.capacity
+            self.count -= 1
+
+    def close(self):
+        """Wakes up the consumer, peek() returns None once the ring is drained."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
@@ -0,0 +1,187 @@
+"""Sample-accurate time base for MPU-6050 captures.
+
+Samples leave the FIFO in bursts, so the host time at which a sample is
+read says little about when it was measured. Instead every sample gets a
+running index and its time is reconstructed from the configured sample
+rate. The index is periodically anchored to a monotonic host clock, which
+corrects the drift of the sensor oscillator, and samples lost on FIFO
+resets are accounted for as explicit gaps so time is never compressed.
+"""
+
+import time
+
+monotonic = getattr(time, "monotonic", time.time)
+
+
+class SampleClock(object):
+    """Tracks the sample index of a running capture against a monotonic clock.
+
+    The methods returning events give dicts meant to be stored next to the
+    capture (see capture_file.CaptureWriter.write_event):
+
+    start -- sample 0 was measured "time" seconds after the epoch
+    sync -- anchors sample index "sample" to "time" seconds after the epoch
+    gap  -- "samples" samples were lost before frame "frame"; "sample" and
+            "time" anchor the first sample after the gap
+    mark -- user marker "label" at "time" seconds after the epoch, e.g. the
+            start of a move; "sample" is the sample index expected then
+
+    The epoch is start() unless given, clocks of several sensors sharing
+    one epoch give times on a common time base.
+    """
+
+    sample_rate = None
+    rate = None
+    sync_interval = 1.0
+    clock = None
+    epoch = None
+    origin = None  # effective epoch
+    start_time = None
+    start_offset = 0.0  # seconds from the epoch to start()
+    sample_index = 0  # counts lost samples too
+    frame_index = 0  # counts only the samples actually delivered
+    lost_samples = 0
+    _anchor = None
+
+    def __init__(self, sample_rate, sync_interval=1.0, clock=monotonic, epoch=None):
+        self.sample_rate = float(sample_rate)
+        self.rate = self.sample_rate
+        self.sync_interval = sync_interval
+        self.clock = clock
+        self.epoch = epoch
+
+    def start(self):
+        """Marks sample 0, call when the FIFO starts filling.
+
+        Returns the start event.
+        """
+        self.start_time = self.clock()
+        self.origin = self.start_time if self.epoch is None else self.epoch
+        self.start_offset = self.start_time - self.origin
+        self.sample_index = 0
+        self.frame_index = 0
+        self.lost_samples = 0
+        self.rate = self.sample_rate
+        self._anchor = (0, self.start_offset)
+        return dict(event="start", frame=0, sample=0, time=self.start_offset)
+
+    def elapsed(self):
+        """Seconds on the monotonic clock since the epoch."""
+        return self.clock() - self.origin
+
+    def expected_index(self, elapsed=None):
+        """Sample index the sensor should have reached at the given time."""
+        if elapsed is None:
+            elapsed = self.elapsed()
+        anchor_index, anchor_time = self._anchor
+        return anchor_index + (elapsed - anchor_time) * self.rate
+
+    def advance(self, frames, elapsed=None):
+        """Accounts frames delivered by the sensor.
+
+        elapsed -- time of the last frame, now by default.
+        Returns a sync event when the drift correction is due, None otherwise.
+        """
+        self.sample_index += frames
+        self.frame_index += frames
+
+        if elapsed is None:
+            elapsed = self.elapsed()
+        if elapsed - self._anchor[1] < self.sync_interval:
+            return None
+        return self.sync(elapsed)
+
+    def sync(self, elapsed=None):
+        """Anchors the current sample index to the monotonic clock."""
+        if elapsed is None:
+            elapsed = self.elapsed()
+
+        anchor_index, anchor_time = self._anchor
+        if elapsed > anchor_time and self.sample_index > anchor_index:
+            measured = (self.sample_index - anchor_index) / (elapsed - anchor_time)
+            # smooth out the jitter of the burst reads, keep following the oscillator drift
+            self.rate += (measured - self.rate) * 0.25
+
+        self._anchor = (self.sample_index, elapsed)
+        return dict(event="sync", frame=self.frame_index, sample=self.sample_index, time=elapsed)
+
+    def gap(self, samples=None, elapsed=None):
+        """Records lost samples, e.g. after a FIFO reset.
+
+        samples -- amount of lost samples; when None it is computed from the
+        time elapsed since the last anchor.
+        elapsed -- time of the first sample after the gap, now by default.
+        Returns the gap event.
+        """
+        if elapsed is None:
+            elapsed = self.elapsed()
+        if samples is None:
+            samples = max(0, int(round(self.expected_index(elapsed) - self.sample_index)))
+
+        frame = self.frame_index
+        self.sample_index += samples
+        self.lost_samples += samples
+        self._anchor = (self.sample_index, elapsed)
+        return dict(event="gap", frame=frame, samples=samples, sample=self.sample_index, time=elapsed)
+
+    def drop(self, frames):
+        """Turns the last frames delivered through advance() into a gap.
+
+        Used when delivered frames could not be stored.
+        Returns the gap event.
+        """
+        self.frame_index -= frames
+        self.lost_samples += frames
+        return dict(event="gap", frame=self.frame_index, samples=frames, sample=self.sample_index,
+                    time=self.elapsed())
+
+    def mark(self, label):
+        """Returns a marker event for the current time."""
+        elapsed = self.elapsed()
+        return dict(event="mark", label=label, sample=int(round(self.expected_index(elapsed))), time=elapsed)
+
+
+def reconstruct_times(frame_count, sample_rate, events=()):
+    """Rebuilds the time of every stored frame from the clock events.
+
+    Frames are mapped to their sample index (skipping over gaps), then the
+    times are interpolated between the anchors. Past the last anchor the
+    average rate of the anchored section is used.
+    Returns a float64 numpy array of frame_count times in seconds.
+    """
+    import numpy
+
+    frames = numpy.arange(frame_count, dtype=numpy.float64)
+
+    anchor_samples = [0.0]
+    anchor_times = [0.0]
+    gap_frames = []
+    gap_sizes = []
+    for event in events:
+        if event.get("event") == "start":
+            anchor_times[0] = float(event["time"])
+        if event.get("event") == "gap":
+            gap_frames.append(event["frame"])
+            gap_sizes.append(event["samples"])
+        if event.get("event") in ("sync", "gap"):
+            anchor_samples.append(float(event["sample"]))
+            anchor_times.append(float(event["time"]))
+
+    samples = frames
+    if gap_frames:
+        offsets = numpy.cumsum(gap_sizes)
+        position = numpy.searchsorted(numpy.asarray(gap_frames), frames, side="right")
+        samples = frames + numpy.concatenate(([0], offsets))[position]
+
+    anchor_samples = numpy.asarray(anchor_samples)
+    anchor_times = numpy.asarray(anchor_times)
+
+    if len(anchor_samples) > 1 and anchor_times[-1] > anchor_times[0]:
+        rate = (anchor_samples[-1] - anchor_samples[0]) / (anchor_times[-1] - anchor_times[0])
+    else:
+        rate = float(sample_rate)
+
+    times = numpy.interp(samples, anchor_samples, anchor_times)
+    beyond = samples > anchor_samples[-1]
+    times[beyond] = anchor_times[-1] + (samples[beyond] - anchor_samples[-1]) / rate
+    return times
@@ -0,0 +1,180 @@
+"""Parameterized G-code test scripts.
+
+A template is a G-code file with {name} placeholders and directives in
+comments:
+
+    ; @param name=default description   declares a parameter, its type is the type of the default
+    ; @repeat name                      repeats the block up to @end the parameter times
+    ; @if name                          keeps the block up to @end if the parameter is true
+    ; @end
+
+Any plain G-code file is a template without parameters, "; @" comments
+that are not one of these directives are left as comments.
+
+ScriptLibrary expands templates into command lists and caches them by
+template, parameters and file modification time, so running the same
+script again costs a stat() and no parsing.
+"""
+
+import collections
+import os
+import threading
+
+from .gcode_runner import parse_script
+
+EXTENSION = ".gcode"
+DIRECTIVES = ("param", "repeat", "if", "end")
+_TRUE = ("1", "true", "yes", "on")
+_FALSE = ("0", "false", "no", "off")
+
+
+def _convert(value, default):
+    """Converts a parameter value to the type of its default."""
+    if isinstance(default, bool):
+        if isinstance(value, bool):
+            return value
+        text = str(value).strip().lower()
+        if text in _TRUE:
+            return True
+        if text in _FALSE:
+            return False
+        raise ValueError("Not a boolean: %s" % value)
+    return type(default)(value)
+
+
+def _parse_default(text):
+    for kind in (int, float):
+        try:
+            return kind(text)
+        except ValueError:
+            pass
+    if text.lower() in ("true", "false"):
+        return text.lower() == "true"
+    return text
+
+
+class ScriptTemplate(object):
+    """A parsed template: its parameters, with defaults and descriptions, and its block tree."""
+
+    def __init__(self, name, lines):
+        self.name = name
+        self.defaults = collections.OrderedDict()
+        self.descriptions = dict()
+
+        # every block is a list of lines and (directive, parameter, block) tuples
+        self.body = []
+        stack = [self.body]
+        for number, line in enumerate(lines, 1):
+            text = line.strip()
+            if not text.startswith("; @"):
+                stack[-1].append(line)
+                continue
+
+            words = text[3:].split(None, 2)
+            directive = words[0] if words else ""
+            if directive not in DIRECTIVES:
+                # an ordinary comment, e.g. "; @author ..."
+                stack[-1].append(line)
+            elif directive == "param" and len(words) > 1 and "=" in words[1]:
+                key, default = words[1].split("=", 1)
+                self.defaults[key] = _parse_default(default)
+                self.descriptions[key] = words[2] if len(words) > 2 else ""
+            elif directive in ("repeat", "if") and len(words) > 1:
+                block = []
+                stack[-1].append((directive, words[1], block))
+                stack.append(block)
+            elif directive == "end" and len(stack) > 1:
+                stack.pop()
+            else:
+                raise ValueError("%s line %d: invalid directive %s" % (name, number, text))
+
+        if len(stack) > 1:
+            raise ValueError("%s: missing @end" % name)
+
+    def parameters(self, params=None):
+        """Returns the defaults updated with params, converted to the default types."""
+        values = collections.OrderedDict(self.defaults)
+        for key, value in (params or dict()).items():
+            if key not in self.defaults:
+                raise ValueError("%s: unknown parameter %s" % (self.name, key))
+            values[key] = _convert(value, self.defaults[key])
+        return values
+
+    def expand(self, params=None):
+        """Returns the commands of the script for the given parameters."""
+        values = self.parameters(params)
+        lines = []
+        self._expand(self.body, values, lines)
+        return parse_script(lines)
+
+    def _expand(self, block, values, lines):
+        for item in block:
+            if not isinstance(item, tuple):
+                command = item.split(";", 1)[0]
+                try:
+                    lines.append(command.format(**values))
+                except KeyError as e:
+                    raise ValueError("%s: unknown placeholder %s" % (self.name, e))
+                continue
+
+            directive, key, children = item
+            if key not in values:
+                raise ValueError("%s: unknown parameter %s" % (self.name, key))
+            if directive == "repeat":
+                for _ in range(int(values[key])):
+                    self._expand(children, values, lines)
+            elif values[key]:
+                self._expand(children, values, lines)
+
+
+class ScriptLibrary(object):
+    """The templates of a folder, with a cache of the expanded command lists."""
+
+    def __init__(self, folder, cache_size=32):
+        self.folder = folder
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        self.templates = dict()  # name -> (mtime, ScriptTemplate)
+        self.cache = collections.OrderedDict()  # (name, params, mtime) -> commands
+
+    def path(self, name):
+        if os.path.basename(name) != name:
+            raise ValueError("Invalid script name: %s" % name)
+        return os.path.join(self.folder, name + EXTENSION)
+
+    def names(self):
+        return sorted(os.path.splitext(filename)[0] for filename in os.listdir(self.folder)
+                      if filename.endswith(EXTENSION))
+
+    def template(self, name):
+        """Returns the parsed template, parsing the file again only if it changed."""
+        return self._load(name)[1]
+
+    def _load(self, name):
+        path = self.path(name)
+        mtime = os.stat(path).st_mtime
+        with self.lock:
+            cached = self.templates.get(name)
+        if cached is not None and cached[0] == mtime:
+            return cached
+
+        with open(path, "r") as fd:
+            cached = (mtime, ScriptTemplate(name, fd.read().splitlines()))
+        with self.lock:
+            self.templates[name] = cached
+        return cached
+
+    def commands(self, name, params=None):
+        """Returns the expanded commands of a template, as a tuple."""
+        mtime, template = self._load(name)
+        values = template.parameters(params)
+        key = (name, tuple(values.items()), mtime)
+
+        with self.lock:
+            commands = self.cache.pop(key, None)
+            if commands is None:
+                commands = tuple(template.expand(values))
+            self.cache[key] = commands
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return commands
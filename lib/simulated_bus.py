@@ -0,0 +1,283 @@
+"""In-process simulation of an I2C bus with MPU-6050 sensors on it.
+
+SimulatedMPU6050 models the part of the register map the driver uses:
+PWR_MGMT_1 (sleep and device reset), SMPLRT_DIV, CONFIG (DLPF), the
+range and offset registers, FIFO_EN, USER_CTRL (FIFO enable and reset),
+INT_ENABLE/INT_STATUS, FIFO_COUNT and FIFO_R_W. Samples are pushed in the
+FIFO at the configured sample rate as time passes, from a
+VibrationWaveform, and the FIFO overflows at 1024 bytes like the silicon
+does: the oldest bytes are lost and the overflow status bit is raised.
+
+SimulatedBus dispatches SMBus calls to the simulated devices, counts the
+transactions and can add a per transaction latency.
+
+Example:
+
+    bus = SimulatedBus({0x68: SimulatedMPU6050(VibrationWaveform([(45.0, 0.5)]))})
+    mpu = mpu6050(0x68, bus=bus)
+"""
+
+import math
+import threading
+import time
+
+import numpy
+
+from .sample_clock import monotonic
+
+
+class VibrationWaveform(object):
+    """Synthetic multi-tone vibration signal.
+
+    tones -- list of (frequency Hz, amplitude m/s^2) or
+             (frequency Hz, amplitude m/s^2, axis weights (x, y, z)) tuples.
+    noise -- standard deviation of the white noise added to every axis, m/s^2.
+    gravity -- static acceleration (x, y, z) in m/s^2.
+    gyro_ratio -- deg/s of rotation per m/s^2 of vibration, for the gyro axes.
+    """
+
+    def __init__(self, tones=((45.0, 0.5),), noise=0.02, gravity=(0.0, 0.0, 9.80665), gyro_ratio=0.5,
+                 seed=None):
+        self.tones = []
+        for tone in tones:
+            weights = tone[2] if len(tone) > 2 else (1.0, 1.0, 1.0)
+            self.tones.append((float(tone[0]), float(tone[1]), numpy.asarray(weights, dtype=numpy.float64)))
+        self.noise = noise
+        self.gravity = numpy.asarray(gravity, dtype=numpy.float64)
+        self.gyro_ratio = gyro_ratio
+        self.random = numpy.random.RandomState(seed)
+
+    def sample(self, times):
+        """Returns (accel m/s^2, gyro deg/s) arrays of shape (len(times), 3)."""
+        times = numpy.asarray(times, dtype=numpy.float64)[:, None]
+        vibration = numpy.zeros((len(times), 3))
+        for frequency, amplitude, weights in self.tones:
+            vibration += amplitude * numpy.sin(2 * math.pi * frequency * times) * weights
+
+        if self.noise:
+            vibration += self.random.normal(0.0, self.noise, vibration.shape)
+
+        return vibration + self.gravity, vibration * self.gyro_ratio
+
+
+class SimulatedMPU6050(object):
+    """Register level model of a MPU-6050."""
+
+    GRAVITIY_MS2 = 9.80665
+    FIFO_SIZE = 1024
+
+    SMPLRT_DIV = 0x19
+    CONFIG = 0x1A
+    GYRO_CONFIG = 0x1B
+    ACCEL_CONFIG = 0x1C
+    FIFO_EN = 0x23
+    INT_PIN_CFG = 0x37
+    INT_ENABLE = 0x38
+    INT_STATUS = 0x3A
+    USER_CTRL = 0x6A
+    PWR_MGMT_1 = 0x6B
+    FIFO_COUNT_H = 0x72
+    FIFO_COUNT_L = 0x73
+    FIFO_R_W = 0x74
+    WHO_AM_I = 0x75
+
+    INT_DATA_RDY = 0x01
+    INT_FIFO_OFLOW = 0x10
+
+    USER_CTRL_FIFO_EN = 0x40
+    USER_CTRL_FIFO_RESET = 0x04
+    PWR_MGMT1_DEVICE_RESET = 0x80
+    PWR_MGMT1_SLEEP = 0x40
+
+    FIFO_EN_TEMP = 0x80
+    FIFO_EN_XG = 0x40
+    FIFO_EN_YG = 0x20
+    FIFO_EN_ZG = 0x10
+    FIFO_EN_ACCEL = 0x08
+
+    ACCEL_SCALE = (16384.0, 8192.0, 4096.0, 2048.0)
+    GYRO_SCALE = (131.0, 65.5, 32.8, 16.4)
+
+    def __init__(self, waveform=None, clock=monotonic, rate_error=0.0):
+        """waveform -- the VibrationWaveform measured by the sensor.
+        clock -- time source, in seconds.
+        rate_error -- relative error of the sensor oscillator, e.g. 0.01 runs 1% fast.
+        """
+        self.waveform = waveform or VibrationWaveform()
+        self.clock = clock
+        self.rate_error = rate_error
+        self.lock = threading.RLock()
+        self.overflows = 0
+        self.samples_generated = 0
+        self.reset()
+
+    def reset(self):
+        """Power on state of the registers."""
+        with self.lock:
+            self.registers = bytearray(128)
+            self.registers[self.PWR_MGMT_1] = self.PWR_MGMT1_SLEEP
+            self.registers[self.WHO_AM_I] = 0x68
+            self.fifo = bytearray()
+            self.sample_time = 0.0
+            self.last_update = self.clock()
+
+    def sample_rate(self):
+        dlpf = self.registers[self.CONFIG] & 0x07
+        output_rate = 8000.0 if dlpf in (0, 7) else 1000.0
+        return output_rate / (1 + self.registers[self.SMPLRT_DIV]) * (1.0 + self.rate_error)
+
+    def packet(self, accel, gyro):
+        """Builds the FIFO bytes of the given samples, following FIFO_EN."""
+        fifo_en = self.registers[self.FIFO_EN]
+        accel_scale = self.ACCEL_SCALE[(self.registers[self.ACCEL_CONFIG] >> 3) & 0x03]
+        gyro_scale = self.GYRO_SCALE[(self.registers[self.GYRO_CONFIG] >> 3) & 0x03]
+
+        columns = []
+        if fifo_en & self.FIFO_EN_ACCEL:
+            columns.append(accel / self.GRAVITIY_MS2 * accel_scale)
+        if fifo_en & self.FIFO_EN_TEMP:
+            columns.append(numpy.full((len(accel), 1), (25.0 - 36.53) * 340.0))
+        for bit, axis in ((self.FIFO_EN_XG, 0), (self.FIFO_EN_YG, 1), (self.FIFO_EN_ZG, 2)):
+            if fifo_en & bit:
+                columns.append(gyro[:, axis:axis + 1] * gyro_scale)
+
+        if not columns:
+            return b""
+        counts = numpy.clip(numpy.round(numpy.hstack(columns)), -32768, 32767)
+        return counts.astype(">i2").tobytes()
+
+    def update(self):
+        """Generates the samples due since the last access."""
+        now = self.clock()
+        elapsed = now - self.last_update
+        self.last_update = now
+
+        if self.registers[self.PWR_MGMT_1] & self.PWR_MGMT1_SLEEP:
+            return
+
+        rate = self.sample_rate()
+        first = int(self.sample_time * rate)
+        self.sample_time += elapsed
+        last = int(self.sample_time * rate)
+        if last <= first:
+            return
+
+        self.samples_generated += last - first
+        self.registers[self.INT_STATUS] |= self.INT_DATA_RDY
+
+        if not self.registers[self.USER_CTRL] & self.USER_CTRL_FIFO_EN:
+            return
+
+        # a full FIFO only keeps the newest bytes, no need to generate the rest
+        count = min(last - first, self.FIFO_SIZE)
+        accel, gyro = self.waveform.sample(numpy.arange(last - count, last) / rate)
+        self.fifo += self.packet(accel, gyro)
+
+        if len(self.fifo) > self.FIFO_SIZE:
+            del self.fifo[:len(self.fifo) - self.FIFO_SIZE]
+            self.registers[self.INT_STATUS] |= self.INT_FIFO_OFLOW
+            self.overflows += 1
+
+    def read(self, register, length):
+        with self.lock:
+            self.update()
+            if register == self.FIFO_R_W:
+                # reading an empty FIFO returns 0xFF
+                data = self.fifo[:length]
+                del self.fifo[:length]
+                return data + b"\xff" * (length - len(data))
+            return bytearray(self._read_register(register + offset) for offset in range(length))
+
+    def _read_register(self, register):
+        if register == self.FIFO_COUNT_H:
+            return (len(self.fifo) >> 8) & 0xFF
+        if register == self.FIFO_COUNT_L:
+            return len(self.fifo) & 0xFF
+        if register == self.INT_STATUS:
+            value = self.registers[register]
+            self.registers[register] = 0
+            return value
+        return self.registers[register]
+
+    def write(self, register, data):
+        with self.lock:
+            self.update()
+            for offset, value in enumerate(data):
+                self._write_register(register + offset, value & 0xFF)
+
+    def _write_register(self, register, value):
+        if register == self.PWR_MGMT_1 and value & self.PWR_MGMT1_DEVICE_RESET:
+            self.reset()
+            return
+        if register == self.USER_CTRL and value & self.USER_CTRL_FIFO_RESET:
+            del self.fifo[:]
+            value &= ~self.USER_CTRL_FIFO_RESET
+        if register == self.FIFO_R_W:
+            self.fifo.append(value)
+            return
+        self.registers[register] = value
+
+
+class SimulatedBus(object):
+    """SMBus compatible bus with simulated devices on it.
+
+    devices -- dict of address: device.
+    latency -- fixed cost of one transaction, in seconds.
+    byte_time -- cost of every transferred byte, in seconds (22.5us at 400kHz).
+    """
+
+    I2C_BLOCK_MAX = 32
+
+    def __init__(self, devices=None, latency=0.0, byte_time=0.0):
+        self.devices = dict(devices or {})
+        self.latency = latency
+        self.byte_time = byte_time
+        self.transactions = 0
+        self.bytes_transferred = 0
+        self.busy_time = 0.0
+
+    def _device(self, address):
+        try:
+            return self.devices[address]
+        except KeyError:
+            raise IOError(121, "Remote I/O error: no device at 0x%02x" % address)
+
+    def _transfer(self, length):
+        self.transactions += 1
+        self.bytes_transferred += length
+        delay = self.latency + self.byte_time * length
+        if delay > 0:
+            time.sleep(delay)
+            self.busy_time += delay
+
+    def read_byte_data(self, address, register):
+        device = self._device(address)
+        self._transfer(1)
+        return device.read(register, 1)[0]
+
+    def write_byte_data(self, address, register, value):
+        device = self._device(address)
+        self._transfer(1)
+        device.write(register, [value])
+
+    def read_i2c_block_data(self, address, register, length=I2C_BLOCK_MAX):
+        if length > self.I2C_BLOCK_MAX:
+            raise IOError(22, "Invalid argument: block length %d" % length)
+        device = self._device(address)
+        self._transfer(length)
+        return list(device.read(register, length))
+
+    def write_i2c_block_data(self, address, register, data):
+        if len(data) > self.I2C_BLOCK_MAX:
+            raise IOError(22, "Invalid argument: block length %d" % len(data))
+        device = self._device(address)
+        self._transfer(len(data))
+        device.write(register, data)
+
+    def reset_counters(self):
+        self.transactions = 0
+        self.bytes_transferred = 0
+        self.busy_time = 0.0
+
+    def close(self):
+        pass
@@ -0,0 +1,124 @@
+"""Hot standby of a single MPU-6050.
+
+A cold start creates the sensor, writes its whole configuration and only
+then starts the FIFO, which delays the first sample by tens of
+milliseconds. StandbySensor keeps one sensor armed between captures (see
+mpu6050.arm): the registers already hold the configuration, the FIFO is
+idle and a capture thread waits for the start request. Starting a
+capture then only resets and enables the FIFO, stopping it only
+disables it again.
+
+    standby = StandbySensor(mpu6050(0x68), logger)
+    standby.configure(sample_rate=1000)  # re-armed while idle
+    standby.start()
+    ...
+    standby.stop()
+    print(standby.sensor.start_latency)
+"""
+
+import threading
+
+from .sample_clock import monotonic
+
+
+class StandbySensor(object):
+    """Runs the captures of an armed sensor from one persistent thread.
+
+    sensor -- mpu6050 instance, never started as a thread itself.
+    The interrupt source of the sensor, if any, stays open until close().
+    """
+
+    recording = False
+    closed = False
+
+    def __init__(self, sensor, logger=None):
+        self.sensor = sensor
+        self.logger = logger
+        self.condition = threading.Condition()
+
+        sensor.keep_int_source = True
+        sensor.arm()
+
+        self.thread = threading.Thread(target=self._run, name="MPU6050 standby")
+        self.thread.daemon = True
+        self.workers = [self.thread]  # threads sampled by the profiler
+        self.thread.start()
+
+    @property
+    def axis(self):
+        return self.sensor.axis
+
+    def configure(self, **settings):
+        """Applies mpu6050.configure() settings and arms the sensor with them.
+
+        Raises RuntimeError while a capture runs.
+        """
+        with self.condition:
+            if self.recording:
+                raise RuntimeError("Cannot configure the sensor while it captures")
+            self.sensor.configure(**settings)
+            self.sensor.arm()
+
+    def start(self, requested=None):
+        """Starts a capture, returns False if one is already running.
+
+        requested -- monotonic time of the start request, now by default;
+                     the start latency of the capture is measured from it.
+        """
+        with self.condition:
+            if self.recording or self.closed:
+                return False
+            self.sensor.start_requested = monotonic() if requested is None else requested
+            self.sensor.capturingData = True
+            self.recording = True
+            self.condition.notify_all()
+        return True
+
+    def stop(self, timeout=2.0):
+        """Stops the running capture and waits until its file is complete.
+
+        Returns False if it is still closing after timeout seconds.
+        """
+        self.sensor.stop()
+        deadline = monotonic() + timeout
+        with self.condition:
+            while self.recording and monotonic() < deadline:
+                self.condition.wait(deadline - monotonic())
+            return not self.recording
+
+    def mark(self, label):
+        return self.sensor.mark(label)
+
+    def close(self, timeout=2.0):
+        """Stops the capture thread and releases the interrupt source."""
+        self.stop(timeout)
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join(timeout)
+        self.sensor.keep_int_source = False
+        if self.sensor.int_source is not None:
+            self.sensor.int_source.close()
+
+    def _run(self):
+        sensor = self.sensor
+        while True:
+            with self.condition:
+                while not self.recording and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+            try:
+                sensor.start_capture()
+            except Exception as e:
+                self._log_exception("Capture failed: %s" % e)
+                # the registers may not hold the armed configuration any more
+                sensor.armed = None
+            finally:
+                with self.condition:
+                    self.recording = False
+                    self.condition.notify_all()
+
+    def _log_exception(self, message):
+        if self.logger is not None:
+            self.logger.exception(message)
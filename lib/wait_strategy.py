@@ -0,0 +1,287 @@
+"""Strategies to wait for MPU-6050 FIFO data.
+
+spin      -- polls FIFO_COUNT/INT_STATUS back to back (the historical behaviour)
+sleep     -- sleeps until the FIFO is expected to hold a watermark of bytes
+interrupt -- blocks on an edge of the INT pin, read from a file descriptor
+
+DrainBudget lowers the byte count a capture waits for when the measured
+wake-up lateness and bus speed would let the FIFO get close to full.
+
+Interrupt sources are objects with fileno(), poll_events and acknowledge():
+GpioChardevSource (/dev/gpiochipN), SysfsGpioSource (/sys/class/gpio) and
+FileDescriptorSource for any readable descriptor, e.g. one end of a pipe.
+"""
+
+import fcntl
+import os
+import select
+import struct
+import time
+
+WAIT_SPIN = "spin"
+WAIT_SLEEP = "sleep"
+WAIT_INTERRUPT = "interrupt"
+
+WAIT_MODES = (WAIT_SPIN, WAIT_SLEEP, WAIT_INTERRUPT)
+
+
+class SpinWait(object):
+    """Returns immediately, the caller keeps polling the device."""
+
+    name = WAIT_SPIN
+
+    def prepare(self, sensor):
+        pass
+
+    def threshold(self, packet_size):
+        """Returns how many FIFO bytes are worth a burst read."""
+        return packet_size
+
+    def wait(self, FIFO_count, packet_size, target=None):
+        pass
+
+    def close(self):
+        pass
+
+
+class SleepWait(object):
+    """Sleeps until the FIFO is expected to hold watermark bytes.
+
+    watermark -- bytes to wait for, rounded down to whole packets.
+    min_sleep -- shortest sleep, avoids hammering the bus when data is due.
+    """
+
+    name = WAIT_SLEEP
+    watermark = 256
+    min_sleep = 0.001
+    sample_rate = 1000.0
+
+    def __init__(self, watermark=256, min_sleep=0.001):
+        self.watermark = watermark
+        self.min_sleep = min_sleep
+
+    def prepare(self, sensor):
+        self.sample_rate = sensor.get_sample_rate()
+
+    def threshold(self, packet_size):
+        return max(self.watermark - self.watermark % packet_size, packet_size)
+
+    def wait(self, FIFO_count, packet_size, target=None):
+        """target -- bytes to wait for, threshold() by default."""
+        if target is None:
+            target = self.threshold(packet_size)
+        missing_packets = max(1, (target - FIFO_count + packet_size - 1) // packet_size)
+        time.sleep(max(self.min_sleep, missing_packets / self.sample_rate))
+
+    def close(self):
+        pass
+
+
+class InterruptWait(object):
+    """Blocks until the INT pin of the sensor signals new data.
+
+    source -- interrupt source, see the module documentation.
+    timeout -- longest wait in seconds, so a stop request is never missed.
+    close_source -- False to keep the source open on close(), for the next capture.
+    """
+
+    name = WAIT_INTERRUPT
+    source = None
+    timeout = 0.1
+    close_source = True
+
+    def __init__(self, source, timeout=0.1, close_source=True):
+        self.source = source
+        self.timeout = timeout
+        self.close_source = close_source
+        self._poll = select.poll()
+        self._poll.register(source.fileno(), source.poll_events)
+
+    def prepare(self, sensor):
+        # 50us pulse on every data ready, status cleared on INT_STATUS read
+        sensor.set_int_config(0)
+        sensor.set_int_enable(sensor.INT_ENABLE_DATA_RDY_EN | sensor.INT_ENABLE_FIFO_OFLOW_INT)
+
+    def threshold(self, packet_size):
+        return packet_size
+
+    def wait(self, FIFO_count, packet_size, target=None):
+        if self._poll.poll(int(self.timeout * 1000)):
+            self.source.acknowledge()
+
+    def close(self):
+        self._poll.unregister(self.source.fileno())
+        if self.close_source:
+            self.source.close()
+
+
+class DrainBudget(object):
+    """Keeps the FIFO of a capture away from its 1024 byte limit.
+
+    Measures how late the FIFO gets drained (the bytes found past the
+    threshold on wake up, a decaying peak) and the bus time per FIFO byte,
+    and caps the wait threshold so the FIFO peaks at about margin of its
+    size. When the bus reads slower than the sensor fills, no threshold
+    helps: can_keep_up() turns False.
+    """
+
+    margin = 0.5
+    decay = 0.95
+    late_bytes = 0.0  # decaying peak of the bytes past the threshold on wake up
+    byte_time = 0.0  # seconds of bus time per FIFO byte read
+    limit = None  # last threshold returned by threshold()
+
+    def __init__(self, packet_size, sample_rate, fifo_size=1024, margin=0.5):
+        self.packet_size = packet_size
+        self.fill_rate = float(sample_rate) * packet_size  # bytes/s
+        self.fifo_size = fifo_size
+        self.margin = margin
+
+    def threshold(self, threshold):
+        """Returns the threshold to wait for, at most the given one, in whole packets."""
+        # bytes arriving while the first block is read
+        safe = self.fifo_size * self.margin - self.late_bytes - self.fill_rate * self.byte_time * 32
+        limit = min(threshold, int(safe))
+        self.limit = max(self.packet_size, limit - limit % self.packet_size)
+        return self.limit
+
+    def record_wake(self, FIFO_count):
+        """Accounts the FIFO count found when the threshold was reached."""
+        if self.limit is None:
+            return
+        self.late_bytes = max(FIFO_count - self.limit, self.late_bytes * self.decay)
+
+    def record_read(self, length, seconds):
+        """Accounts the bus time of a FIFO read of length bytes."""
+        if length > 0:
+            self.byte_time += (seconds / length - self.byte_time) * 0.25
+
+    def can_keep_up(self):
+        """False while reading a byte takes longer than the sensor takes to write one."""
+        return self.byte_time * self.fill_rate < 1.0
+
+    def stats(self):
+        return dict(threshold=self.limit, late_bytes=round(self.late_bytes, 1),
+                    byte_time=self.byte_time, fill_rate=self.fill_rate, can_keep_up=self.can_keep_up())
+
+
+class FileDescriptorSource(object):
+    """Interrupt source backed by any readable file descriptor.
+
+    Every byte readable on the descriptor is one interrupt.
+    """
+
+    poll_events = select.POLLIN
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def fileno(self):
+        return self.fd
+
+    def acknowledge(self):
+        os.read(self.fd, 4096)
+
+    def close(self):
+        pass
+
+
+class SysfsGpioSource(object):
+    """Interrupt source on a GPIO exported through /sys/class/gpio."""
+
+    poll_events = select.POLLPRI | select.POLLERR
+    SYSFS_GPIO = "/sys/class/gpio"
+
+    def __init__(self, pin, edge="rising"):
+        self.pin = pin
+        gpio_path = "%s/gpio%d" % (self.SYSFS_GPIO, pin)
+
+        if not os.path.exists(gpio_path):
+            with open(self.SYSFS_GPIO + "/export", "w") as fd:
+                fd.write(str(pin))
+        with open(gpio_path + "/direction", "w") as fd:
+            fd.write("in")
+        with open(gpio_path + "/edge", "w") as fd:
+            fd.write(edge)
+
+        self.fd = os.open(gpio_path + "/value", os.O_RDONLY | os.O_NONBLOCK)
+        self.acknowledge()
+
+    def fileno(self):
+        return self.fd
+
+    def acknowledge(self):
+        # reading the value from the start re-arms the edge detection
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        os.read(self.fd, 8)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class GpioChardevSource(object):
+    """Interrupt source on a GPIO line of a /dev/gpiochipN character device.
+
+    Uses the line event interface (GPIO_GET_LINEEVENT_IOCTL) of the kernel.
+    """
+
+    poll_events = select.POLLIN | select.POLLPRI
+
+    GPIOHANDLE_REQUEST_INPUT = 1 << 0
+    GPIOEVENT_REQUEST_RISING_EDGE = 1 << 0
+    GPIOEVENT_REQUEST_FALLING_EDGE = 1 << 1
+
+    # struct gpioevent_request { u32 lineoffset; u32 handleflags; u32 eventflags; char consumer_label[32]; int fd; }
+    _EVENT_REQUEST = struct.Struct("=III32si")
+    # _IOWR(0xB4, 0x04, struct gpioevent_request)
+    GPIO_GET_LINEEVENT_IOCTL = (3 << 30) | (_EVENT_REQUEST.size << 16) | (0xB4 << 8) | 0x04
+    # struct gpioevent_data { u64 timestamp; u32 id; }
+    EVENT_DATA_SIZE = 16
+
+    def __init__(self, line, chip="/dev/gpiochip0", edge="rising"):
+        self.line = line
+        event_flags = {
+            "rising": self.GPIOEVENT_REQUEST_RISING_EDGE,
+            "falling": self.GPIOEVENT_REQUEST_FALLING_EDGE,
+            "both": self.GPIOEVENT_REQUEST_RISING_EDGE | self.GPIOEVENT_REQUEST_FALLING_EDGE
+        }[edge]
+
+        chip_fd = os.open(chip, os.O_RDONLY)
+        try:
+            request = bytearray(self._EVENT_REQUEST.pack(line, self.GPIOHANDLE_REQUEST_INPUT, event_flags,
+                                                         b"octoprint-shooting", 0))
+            fcntl.ioctl(chip_fd, self.GPIO_GET_LINEEVENT_IOCTL, request, True)
+        finally:
+            os.close(chip_fd)
+
+        self.fd = self._EVENT_REQUEST.unpack(bytes(request))[4]
+        fcntl.fcntl(self.fd, fcntl.F_SETFL, fcntl.fcntl(self.fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def fileno(self):
+        return self.fd
+
+    def acknowledge(self):
+        try:
+            while os.read(self.fd, self.EVENT_DATA_SIZE * 16):
+                pass
+        except OSError:
+            pass  # EAGAIN, queue drained
+
+    def close(self):
+        os.close(self.fd)
+
+
+def create(mode, source=None, **kwargs):
+    """Builds the wait strategy for mode, one of WAIT_MODES.
+
+    source -- interrupt source, required by the interrupt mode.
+    """
+    if mode == WAIT_SPIN:
+        return SpinWait()
+    if mode == WAIT_SLEEP:
+        return SleepWait(**kwargs)
+    if mode == WAIT_INTERRUPT:
+        if source is None:
+            raise ValueError("The interrupt wait mode needs an interrupt source")
+        return InterruptWait(source, **kwargs)
+    raise ValueError("Unknown wait mode: %s" % mode)
@@ -7,30 +7,54 @@
 # coding=utf-8
 from __future__ import absolute_import
 
+import time
+
+_import_start = time.time()
+
 # import sys
 # import glob
-# import os
 # from datetime import datetime
 # from datetime import timedelta
 # import octoprint.util
 # import requests
 # import inspect
-# import threading
 # import json
-import io
-import time
+import hashlib
+import os
+import threading
 
+import flask
 import octoprint.plugin
-from lib.mpu6050 import mpu6050
+# only the light modules are imported with the plugin, the driver, numpy and the capture
+# modules are imported on first use so they cost nothing to OctoPrint startup
+from lib import wait_strategy
+from lib.capture_metrics import MetricsRegistry
+from lib.gcode_runner import GcodeRunner
+from lib.script_templates import ScriptLibrary
+from lib.sample_clock import monotonic
 from octoprint.events import Events
-from octoprint.server.util import flask
+from octoprint.util import RepeatedTimer
 
 
 # from octoprint.events import eventManager, Events
 # from octoprint.util import RepeatedTimer
 # from subprocess import Popen, PIPE
 # import RPi.GPIO as GPIO
-# import flask
+
+
+# Acquisition presets, applied over the individual settings when selected
+CAPTURE_PROFILES = dict(
+    # accel only 6 byte packets at the full accelerometer rate, for high-frequency ringing
+    high_rate=dict(sample_rate=1000, capture_gyro=False, dlpf_bandwidth=184, wait_watermark=512),
+    # low rate, long sleeps between FIFO reads, for background monitoring
+    monitor=dict(sample_rate=50, capture_gyro=False, dlpf_bandwidth=21, wait_mode="sleep", wait_watermark=768)
+)
+
+CAPTURE_SETTINGS = ("sample_rate", "accel_range", "gyro_range", "dlpf_bandwidth", "capture_gyro", "accel_offsets",
+                    "gyro_offsets", "wait_mode", "wait_watermark", "compress")
+
+# long captures, converted to the max_duration, rotate_seconds and rotate_bytes of mpu6050.configure
+LONG_CAPTURE_SETTINGS = ("max_duration", "rotate_minutes", "rotate_megabytes")
 
 
 class ShootingPlugin(octoprint.plugin.SettingsPlugin,
@@ -42,13 +66,51 @@ class ShootingPlugin(octoprint.plugin.SettingsPlugin,
     capturing_vibration = False
     script_file = "vibration_test_1"
     mpu = None
+    live_envelope = None
+    live_spectrum = None  # StreamingSTFT of the running or last capture
+    live_timer = None
+    live_start_time = None
+    catalog = None
+    capture_readers = None
+    running_script = None
+    gcode_job = None
+    scripts = None
+    metrics = MetricsRegistry()  # capture health, kept across captures
+    profiler = None  # SamplingProfiler of the running or last profiling window
+    standby = None  # StandbySensor kept armed between captures, when enabled
+    standby_source = None  # wait mode and INT pin wiring the standby sensor was created with
 
     # ~~ SettingsPlugin mixin
 
     def get_settings_defaults(self):
         return dict(
             # put your plugin's default settings here
-            script_file="vibration_test_1"
+            script_file="vibration_test_1",  # template in the scripts folder, run by @START
+            script_params=dict(),  # template parameters, e.g. {"axis": "X", "passes": 10}
+            capture_profile="custom",  # custom, high_rate or monitor
+            sample_rate=100,  # Hz
+            accel_range=2,  # g
+            gyro_range=250,  # deg/s
+            dlpf_bandwidth=44,  # Hz
+            capture_gyro=True,
+            accel_offsets=[2354, 640, 1779],
+            gyro_offsets=[15, 46, -25],
+            wait_mode="sleep",  # spin, sleep or interrupt
+            wait_watermark=256,  # bytes
+            compress=False,  # chunked, delta encoded captures (.mpuz)
+            max_duration=300,  # seconds, 0 captures until @MPU6050 STOP
+            rotate_minutes=0,  # new capture segment file every N minutes, 0 for a single file
+            rotate_megabytes=0,  # new capture segment file every N MB, 0 for no size limit
+            disk_budget_megabytes=0,  # oldest captures are deleted past this total, 0 keeps everything
+            standby=False,  # keep the sensor armed between captures, @MPU6050 START only enables its FIFO
+            int_gpio_chip="/dev/gpiochip0",  # INT pin wiring, for the interrupt wait mode
+            int_gpio_line=17,
+            # several sensors captured together, e.g. [{"name": "hotend", "bus": 1, "address": 104}, ...];
+            # empty for the single sensor at 0x68 on bus 1
+            sensors=[],
+            live_frame_rate=10,  # frames per second sent to the Shooting tab
+            live_window=30,  # seconds shown on the Shooting tab
+            gcode_window=4  # script commands allowed to wait for the printer acknowledgement
         )
 
     def get_settings_version(self):
@@ -57,11 +119,52 @@ class ShootingPlugin(octoprint.plugin.SettingsPlugin,
     # def on_settings_migrate(self, target, current):
     #     assert target == get_settings_version()
 
+    def on_settings_save(self, data):
+        from lib.mpu6050 import mpu6050
+
+        try:
+            mpu6050.validate_configuration(**self.get_capture_settings(data))
+        except (ValueError, TypeError) as e:
+            self._logger.error("Invalid capture settings, keeping the previous ones: {}".format(e))
+            for key in CAPTURE_SETTINGS + LONG_CAPTURE_SETTINGS + ("capture_profile",):
+                data.pop(key, None)
+
+        octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
+        self.arm_standby()
+
+    def get_capture_settings(self, overrides=None):
+        """Returns the acquisition parameters for mpu6050.configure, from the
+        stored settings updated with overrides and the selected profile."""
+        overrides = overrides or dict()
+
+        def setting(key):
+            if key in overrides:
+                return overrides[key]
+            return self._settings.get([key])
+
+        capture_settings = dict((key, setting(key)) for key in CAPTURE_SETTINGS)
+        for key in ("sample_rate", "accel_range", "gyro_range", "dlpf_bandwidth", "wait_watermark"):
+            capture_settings[key] = int(capture_settings[key])
+        capture_settings["capture_gyro"] = bool(capture_settings["capture_gyro"])
+        capture_settings["compress"] = bool(capture_settings["compress"])
+        capture_settings["max_duration"] = int(setting("max_duration"))
+        capture_settings["rotate_seconds"] = int(setting("rotate_minutes")) * 60
+        capture_settings["rotate_bytes"] = int(setting("rotate_megabytes")) * 1024 * 1024
+
+        profile = setting("capture_profile")
+        if profile in CAPTURE_PROFILES:
+            capture_settings.update(CAPTURE_PROFILES[profile])
+        elif profile != "custom":
+            raise ValueError("Unknown capture profile: {}".format(profile))
+
+        return capture_settings
+
     # ~~ AssetPlugin mixin
 
     def get_assets(self):
         return dict(
-            js=["js/shooting.js", "js/plotly-latest.min.js"],
+            # js/plotly-latest.min.js is loaded by shooting.js when the tab is first shown
+            js=["js/shooting.js"],
             css=["css/shooting.css"],
             less=["less/shooting.less"]
         )
@@ -78,7 +181,16 @@ class ShootingPlugin(octoprint.plugin.SettingsPlugin,
     # ~~ StartupPlugin mixin
 
     def on_after_startup(self):
-        self._logger.info("Shooting is here!")
+        self._logger.info("Shooting is here! Plugin imported in {:.1f} ms".format(IMPORT_SECONDS * 1000))
+
+        self.scripts = ScriptLibrary(os.path.join(self._basefolder, "scripts"))
+
+        # the catalog imports numpy, open it off the startup path
+        catalog = threading.Thread(target=self.open_catalog, name="Shooting catalog")
+        catalog.daemon = True
+        catalog.start()
+
+        self.arm_standby()
 
     # ~~ BlueprintPlugin mixin
 
@@ -88,6 +200,224 @@ class ShootingPlugin(octoprint.plugin.SettingsPlugin,
             return flask.make_response("Expected a text to echo back.", 400)
         return flask.request.values["text"]
 
+    @octoprint.plugin.BlueprintPlugin.route("/scripts", methods=["GET"])
+    def list_scripts(self):
+        scripts = []
+        for name in self.scripts.names():
+            try:
+                template = self.scripts.template(name)
+            except ValueError as e:
+                self._logger.warning("Invalid script template: {}".format(e))
+                continue
+            scripts.append(dict(name=name, defaults=template.defaults, descriptions=template.descriptions))
+        return flask.jsonify(scripts=scripts)
+
+    @octoprint.plugin.BlueprintPlugin.route("/scripts/<name>", methods=["GET"])
+    def preview_script(self, name):
+        """Expanded commands of a template, the query parameters override its defaults."""
+        try:
+            commands = self.scripts.commands(name, flask.request.args.to_dict())
+        except (IOError, OSError):
+            return flask.make_response("Unknown script.", 404)
+        except ValueError as e:
+            return flask.make_response("Invalid script parameters: {}".format(e), 400)
+        return flask.jsonify(name=name, commands=commands)
+
+    @octoprint.plugin.BlueprintPlugin.route("/gcode", methods=["GET"])
+    def get_gcode_job(self):
+        if self.gcode_job is None:
+            return flask.jsonify(state=None)
+        return flask.jsonify(self.gcode_job.progress())
+
+    @octoprint.plugin.BlueprintPlugin.route("/gcode/<action>", methods=["POST"])
+    def control_gcode_job(self, action):
+        if action not in ("pause", "resume", "cancel"):
+            return flask.make_response("Unknown action.", 400)
+        if self.gcode_job is None or not self.gcode_job.active:
+            return flask.make_response("No script running.", 409)
+        getattr(self.gcode_job, action)()
+        return flask.jsonify(self.gcode_job.progress())
+
+    @octoprint.plugin.BlueprintPlugin.route("/metrics", methods=["GET"])
+    def get_metrics(self):
+        return flask.jsonify(capturing=self.capturing_vibration, sensors=self.metrics.snapshot())
+
+    @octoprint.plugin.BlueprintPlugin.route("/metrics/prometheus", methods=["GET"])
+    def get_prometheus_metrics(self):
+        """Metrics in the Prometheus text format, scrape with the API key, e.g. ?apikey=..."""
+        response = flask.make_response(self.metrics.prometheus())
+        response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+        return response
+
+    @octoprint.plugin.BlueprintPlugin.route("/profile", methods=["GET"])
+    def get_profile(self):
+        return flask.jsonify(self.profile_status())
+
+    @octoprint.plugin.BlueprintPlugin.route("/profile", methods=["POST"])
+    def control_profile(self):
+        """Starts a profiling window of "duration" seconds (10 by default), or ends it early with "stop"."""
+        values = flask.request.values
+        if "stop" in values:
+            self.stop_profiling()
+            return flask.jsonify(self.profile_status())
+        try:
+            duration = float(values.get("duration", 10))
+        except ValueError:
+            return flask.make_response("Invalid profiling duration.", 400)
+        if not self.start_profiling(duration):
+            return flask.make_response("Profiling already running.", 409)
+        return flask.jsonify(self.profile_status())
+
+    @octoprint.plugin.BlueprintPlugin.route("/captures", methods=["GET"])
+    def list_captures(self):
+        if self.catalog is None:
+            return flask.make_response("Capture catalog not ready.", 503)
+
+        values = flask.request.values
+        try:
+            offset = int(values.get("offset", 0))
+            total, captures = self.catalog.query(
+                offset=offset,
+                limit=int(values.get("limit", 50)),
+                since=float(values["since"]) if "since" in values else None,
+                until=float(values["until"]) if "until" in values else None,
+                script=values.get("script"),
+                sample_rate=float(values["sample_rate"]) if "sample_rate" in values else None,
+                descending=values.get("order", "desc") != "asc"
+            )
+        except ValueError:
+            return flask.make_response("Invalid capture query.", 400)
+
+        return flask.jsonify(total=total, offset=offset, captures=captures)
+
+    @octoprint.plugin.BlueprintPlugin.route("/captures/<capture_id>", methods=["GET"])
+    def get_capture(self, capture_id):
+        capture = self.catalog.get(capture_id) if self.catalog is not None else None
+        if capture is None:
+            return flask.make_response("Unknown capture.", 404)
+        return flask.jsonify(capture)
+
+    @octoprint.plugin.BlueprintPlugin.route("/captures/<capture_id>/data", methods=["GET"])
+    def get_capture_data(self, capture_id):
+        """Downsampled slice of a capture.
+
+        Query: start, end (seconds from the capture epoch, as the returned times), axis (comma separated), points, method (minmax or lttb),
+        format (json, or binary: per axis float32 little-endian times then values, axis and
+        point count in the X-Capture-Axis and X-Capture-Points headers).
+        """
+        path = self.catalog.file_path(capture_id) if self.catalog is not None else None
+        if path is None or not os.path.exists(path):
+            return flask.make_response("Unknown capture.", 404)
+
+        import numpy
+        from lib.capture_query import query_range
+
+        values = flask.request.values
+        binary = values.get("format") == "binary"
+        stat = os.stat(path)
+        # finished captures never change, the file size and mtime identify the content
+        etag = hashlib.sha1("{}:{}:{}:{}".format(capture_id, stat.st_size, stat.st_mtime,
+                                                 sorted(values.items())).encode("utf-8")).hexdigest()
+        if etag in flask.request.if_none_match:
+            return flask.Response(status=304, headers={"ETag": '"{}"'.format(etag)})
+
+        try:
+            data = query_range(self.get_capture_reader(path),
+                               start_time=float(values["start"]) if "start" in values else None,
+                               end_time=float(values["end"]) if "end" in values else None,
+                               axis=values["axis"].split(",") if values.get("axis") else None,
+                               points=int(values.get("points", 1000)),
+                               method=values.get("method", "minmax"))
+        except ValueError as e:
+            return flask.make_response("Invalid capture query: {}".format(e), 400)
+
+        if binary:
+            body = b"".join(numpy.asarray(column, dtype="<f4").tobytes()
+                            for column in data["times"] + data["values"])
+            response = flask.make_response(body)
+            response.headers["Content-Type"] = "application/octet-stream"
+            response.headers["X-Capture-Axis"] = ",".join(data["axis"])
+            response.headers["X-Capture-Points"] = str(len(data["times"][0]) if data["times"] else 0)
+        else:
+            response = flask.jsonify(
+                id=capture_id, start=data["start"], stop=data["stop"], method=data["method"], axis=data["axis"],
+                t=[numpy.round(column, 4).tolist() for column in data["times"]],
+                v=[numpy.round(column, 5).tolist() for column in data["values"]]
+            )
+
+        response.headers["ETag"] = '"{}"'.format(etag)
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response
+
+    @octoprint.plugin.BlueprintPlugin.route("/captures/<capture_id>/segments", methods=["GET"])
+    def get_capture_segments(self, capture_id):
+        """Per move RMS and peaks of a capture, split at its MARK events, and their statistics per label."""
+        path = self.catalog.file_path(capture_id) if self.catalog is not None else None
+        if path is None or not os.path.exists(path):
+            return flask.make_response("Unknown capture.", 404)
+
+        from lib import analysis
+
+        labels = flask.request.values.get("labels")
+        reader = self.get_capture_reader(path)
+        segments = analysis.segment_capture(reader, labels.split(",") if labels else None)
+        results = analysis.analyze_segments(reader, segments)
+        return flask.jsonify(segments=results, labels=analysis.compare_segments(results))
+
+    @octoprint.plugin.BlueprintPlugin.route("/captures/<capture_id>/spectrum", methods=["GET"])
+    def get_capture_spectrum(self, capture_id):
+        """Welch PSD and resonance peaks of every axis of a whole capture.
+
+        Query: segment_length (samples per FFT segment), peaks (most peaks per axis).
+        """
+        path = self.catalog.file_path(capture_id) if self.catalog is not None else None
+        if path is None or not os.path.exists(path):
+            return flask.make_response("Unknown capture.", 404)
+
+        from lib import analysis
+
+        values = flask.request.values
+        try:
+            result = analysis.analyze_capture(self.get_capture_reader(path),
+                                              segment_length=int(values.get("segment_length", 1024)),
+                                              max_peaks=int(values.get("peaks", 10)))
+        except ValueError as e:
+            return flask.make_response("Invalid spectrum query: {}".format(e), 400)
+
+        return flask.jsonify(
+            id=capture_id, sample_rate=result["sample_rate"], frequencies=result["frequencies"].tolist(),
+            psd=dict((name, axis["psd"].tolist()) for name, axis in result["axes"].items()),
+            peaks=dict((name, axis["peaks"]) for name, axis in result["axes"].items())
+        )
+
+    @octoprint.plugin.BlueprintPlugin.route("/spectrogram", methods=["GET"])
+    def get_live_spectrogram(self):
+        """Rolling spectrogram of the running capture, or of the last one.
+
+        Query: frames, the newest spectra returned (100 by default).
+        """
+        spectrum, envelope = self.live_spectrum, self.live_envelope
+        if spectrum is None or envelope is None:
+            return flask.make_response("No capture.", 404)
+        try:
+            frames = max(1, int(flask.request.values.get("frames", 100)))
+        except ValueError:
+            return flask.make_response("Invalid frame count.", 400)
+
+        times, frequencies, power = spectrum.spectrogram()
+        times, power = times[-frames:], power[-frames:]
+        return flask.jsonify(sample_rate=spectrum.sample_rate, t=[round(float(t), 4) for t in times],
+                             frequencies=frequencies.tolist(),
+                             power=dict((name, power[:, :, column].tolist())
+                                        for column, name in enumerate(envelope.axis)))
+
+    @octoprint.plugin.BlueprintPlugin.route("/captures/rebuild", methods=["POST"])
+    def rebuild_captures(self):
+        if self.catalog is None:
+            return flask.make_response("Capture catalog not ready.", 503)
+        indexed = self.rebuild_catalog(full="full" in flask.request.values)
+        return flask.jsonify(indexed=indexed)
+
     # ~~ EventHandlerPlugin mixin
 
     def on_event(self, event, payload):
@@ -119,17 +449,44 @@ class ShootingPlugin(octoprint.plugin.SettingsPlugin,
     def atcommand_handler_hook(self, comm, phase, command, parameters, tags=None, *args, **kwargs):
 
         command = command.upper()
+        # script names and parameters keep their case, "@START [script] [name=value ...]"
+        script_parameters = parameters.split() if parameters else []
         parameters = parameters.upper()
 
         self._logger.info("Command received {command}.".format(command=command))
 
         if command == "START":
-            self.start_gcode(self.script_file + ".gcode")
+            name = self._settings.get(["script_file"])
+            params = dict(self._settings.get(["script_params"]) or dict())
+            if script_parameters and "=" not in script_parameters[0]:
+                name = script_parameters.pop(0)
+                params = dict()
+            params.update(parameter.split("=", 1) for parameter in script_parameters if "=" in parameter)
+            self.start_gcode(name, dict((key.lower(), value) for key, value in params.items()))
             return
 
         if command != "MPU6050":
             return
 
+        # "@MPU6050 MARK <label>" timestamps the start of a move in the running capture
+        if script_parameters and script_parameters[0].upper() == "MARK":
+            label = " ".join(script_parameters[1:])
+            if not self.mpu or not self.mpu.mark(label):
+                self._logger.warning("Marker \"{}\" ignored, no capture running".format(label))
+            return
+
+        # "@MPU6050 PROFILE [seconds|STOP]" samples the capture and script threads for a while
+        if script_parameters and script_parameters[0].upper() == "PROFILE":
+            argument = script_parameters[1].upper() if len(script_parameters) > 1 else "10"
+            if argument == "STOP":
+                self.stop_profiling()
+            else:
+                try:
+                    self.start_profiling(float(argument))
+                except ValueError:
+                    self._logger.warning("Invalid profiling duration: {}".format(argument))
+            return
+
         if parameters is None:
             parameters = set()
 
@@ -145,6 +502,9 @@ class ShootingPlugin(octoprint.plugin.SettingsPlugin,
             tags = set()
 
     def printer_message_received_hook(self, comm, line, *args, **kwargs):
+        if self.gcode_job is not None and line.startswith("ok"):
+            self.gcode_job.on_ack()
+
         if "FIRMWARE_NAME" not in line:
             return line
 
@@ -172,46 +532,315 @@ class ShootingPlugin(octoprint.plugin.SettingsPlugin,
 
     # ~~ Shooting functions
 
-    def start_gcode(self, filename):
+    def start_gcode(self, name, params=None):
+        """Streams a script template from the scripts folder in the background."""
 
         # @todo: if printer is idle and ready
 
         # @todo: check if @commands are sync with movement
-        path = self._basefolder + "/scripts/" + filename
-        self._logger.info("Franz: print file base: \"{}\".".format(path))
+        if self.gcode_job is not None and self.gcode_job.active:
+            self._logger.warning("Script {} is still running, ignoring {}".format(self.gcode_job.script, name))
+            return
 
-        file = io.open(path, 'rt', encoding='utf8')
+        try:
+            commands = self.scripts.commands(name, params)
+        except (IOError, OSError, ValueError) as e:
+            self._logger.error("Could not load script {}: {}".format(name, e))
+            return
 
-        for line in file:
-            self._printer.commands(line.strip().upper())
-            self._logger.info("Sending GCODE command: %s", line.strip().upper())
-            time.sleep(0.2)
+        self.running_script = name
+        self.gcode_job = GcodeRunner(commands, self._printer.commands, name=name,
+                                     window=self._settings.get_int(["gcode_window"]),
+                                     on_progress=self.send_gcode_progress, logger=self._logger)
+        self.gcode_job.start()
 
-        file.close()
+    def send_gcode_progress(self, progress):
+        if progress["state"] != "running":
+            self._logger.info("Script {script}: {state}, {sent}/{total} commands in {elapsed} s".format(**progress))
+        message = dict(progress)
+        message["type"] = "gcode"
+        self._plugin_manager.send_plugin_message(self._identifier, message)
 
     def start_capture_vibration(self):
+        from lib.analysis import StreamingSTFT
+        from lib.live_envelope import LiveEnvelope
+
+        requested = monotonic()
         if self.mpu:
             self._logger.info("Previous instance of MPU6050 exists")
-            self.mpu.stop()
-            time.sleep(0.1)
+            if self.mpu is self.standby:
+                # same budget as the cold path, the capture thread closes the file meanwhile
+                self.standby.stop(timeout=0.1)
+            else:
+                self.mpu.stop()
+                time.sleep(0.1)
+
+        # settings are read on every start, changes apply to the next capture without a restart
+        capture_settings = self.get_capture_settings()
+
+        sensors = self._settings.get(["sensors"])
+        if sensors:
+            from lib.capture_session import CaptureSession
+
+            # one thread per bus, the bus workers poll the FIFOs instead of waiting on them
+            self.mpu = CaptureSession(sensors, self.get_plugin_data_folder(), logger=self._logger,
+                                      metadata=dict(script=self.running_script), metrics=self.metrics)
+            self.mpu.configure(**capture_settings)
+            for name, sensor in self.mpu.sensors:
+                sensor.on_capture_closed = self.on_capture_closed
+                sensor.on_segment_closed = self.on_segment_closed
+                sensor.start_requested = requested
+            # the Shooting tab shows the first sensor
+            live_sensor = self.mpu.sensors[0][1]
+        elif self.standby is not None:
+            if self.standby.recording:
+                # the previous capture did not close within the stop timeout
+                message = "MPU6050 still closing the previous capture, start ignored"
+                self._logger.warning(message)
+                self.send_notification(message, "error")
+                return
+            # already configured, only the registers of a changed setting are written again
+            self.mpu = self.standby
+            self.mpu.configure(**capture_settings)
+            live_sensor = self.mpu.sensor
+            live_sensor.metadata = dict(script=self.running_script)
+        else:
+            self.mpu = self.create_sensor(capture_settings)
+            self.mpu.metadata = dict(script=self.running_script)
+            self.mpu.start_requested = requested
+            live_sensor = self.mpu
+
+        self.live_envelope = LiveEnvelope(live_sensor.axis)
+        # spectra of the capture are computed as it runs, in the consumer thread
+        self.live_spectrum = StreamingSTFT(live_sensor.get_configured_sample_rate(), len(live_sensor.axis))
+        live_sensor.listeners = [self.live_envelope, self.live_spectrum]
+
+        if self.mpu is self.standby:
+            self.standby.start(requested)
+        else:
+            self.mpu.start()
+        self.capturing_vibration = True
+        self.start_live_stream()
+
+    def create_sensor(self, capture_settings):
+        """Returns the single mpu6050 at 0x68, configured with capture_settings."""
+        from lib.mpu6050 import mpu6050
+
+        int_source = None
+        if capture_settings["wait_mode"] == wait_strategy.WAIT_INTERRUPT:
+            int_source = wait_strategy.GpioChardevSource(self._settings.get_int(["int_gpio_line"]),
+                                                         chip=self._settings.get(["int_gpio_chip"]))
+
+        sensor = mpu6050(0x68, logger=self._logger, basefolder=self.get_plugin_data_folder(),
+                         int_source=int_source, metrics=self.metrics.sensor("mpu6050"))
+        sensor.configure(**capture_settings)
+        sensor.on_capture_closed = self.on_capture_closed
+        sensor.on_segment_closed = self.on_segment_closed
+        return sensor
+
+    def arm_standby(self):
+        """Creates, re-arms or closes the standby sensor following the settings."""
+        enabled = self._settings.get_boolean(["standby"]) and not self._settings.get(["sensors"])
+        standby = self.standby
+        if standby is not None and standby.recording:
+            # re-armed by the next start
+            return
 
-        self.mpu = mpu6050(0x68, logger=self._logger, basefolder=self.get_plugin_data_folder())
-        self.mpu.start()
+        try:
+            capture_settings = self.get_capture_settings() if enabled else None
+            source = None
+            if enabled:
+                source = (capture_settings["wait_mode"], self._settings.get(["int_gpio_chip"]),
+                          self._settings.get_int(["int_gpio_line"]))
+            if standby is not None and source != self.standby_source:
+                self.standby = None
+                standby.close()
+                standby = None
+            if not enabled:
+                return
+
+            if standby is None:
+                from lib.standby import StandbySensor
+
+                self.standby = StandbySensor(self.create_sensor(capture_settings), logger=self._logger)
+                self.standby_source = source
+                self._logger.info("MPU6050 armed in standby")
+            else:
+                standby.configure(**capture_settings)
+        except ImportError as e:
+            # e.g. no smbus on this host, every capture starts cold and reports the problem itself
+            self._logger.warning("MPU6050 standby unavailable, starting captures cold: {}".format(e))
+            if self.standby is not None:
+                self.standby.close()
+                self.standby = None
+        except (IOError, OSError, ValueError) as e:
+            self._logger.error("Could not arm the MPU6050: {}".format(e))
+            if self.standby is not None:
+                self.standby.close()
+                self.standby = None
 
     def stop_capture_vibration(self):
         if self.mpu:
             self._logger.info("Stopping instance of MPU6050")
-            self.mpu.stop()
-
-        time.sleep(0.2)
+            if self.mpu is self.standby:
+                # runs on the printer communication thread, the capture thread closes the file on its own
+                self.standby.stop(timeout=0)
+            else:
+                self.mpu.stop()
+                time.sleep(0.2)
+
+        self.stop_live_stream()
+        self.capturing_vibration = False
+        self.update_ui()
         self._logger.info("Deleting MPU6050")
         del self.mpu
 
+    def on_capture_closed(self, mpu):
+        self.index_capture(mpu.capture_path)
+
+    def on_segment_closed(self, path):
+        # called from the consumer thread, reading the segment for the catalog must not hold it up
+        index = threading.Thread(target=self.index_capture, args=(path,), name="Shooting segment")
+        index.daemon = True
+        index.start()
+
+    def index_capture(self, path):
+        if self.catalog is None:
+            return
+        try:
+            self.catalog.add(path)
+        except (IOError, OSError, ValueError) as e:
+            self._logger.error("Could not index capture {}: {}".format(path, e))
+        self.apply_retention()
+
+    def apply_retention(self):
+        """Deletes the oldest captures past the disk budget."""
+        budget = self._settings.get_int(["disk_budget_megabytes"])
+        if not budget or self.catalog is None:
+            return
+        deleted = self.catalog.prune(budget * 1024 * 1024, exclude=self.recording_paths())
+        if deleted:
+            self._logger.info("Disk budget of {} MB reached, deleted {}".format(budget, ", ".join(deleted)))
+
+    def recording_paths(self):
+        """Files still being written by the running capture, kept out of the catalog."""
+        mpu = self.mpu
+        if mpu is None:
+            return []
+        if hasattr(mpu, "sensors"):
+            sensors = [sensor for name, sensor in mpu.sensors]
+        else:
+            sensors = [getattr(mpu, "sensor", mpu)]  # a StandbySensor or a single mpu6050
+        return [path for path in [sensor.recording_path() for sensor in sensors] if path is not None]
+
+    def open_catalog(self):
+        from lib.capture_catalog import CaptureCatalog
+
+        data_folder = self.get_plugin_data_folder()
+        self.catalog = CaptureCatalog(os.path.join(data_folder, "captures.db"), data_folder, logger=self._logger)
+        # picks up captures added, changed or deleted while OctoPrint was down
+        self.rebuild_catalog()
+
+    def get_capture_reader(self, path):
+        if self.capture_readers is None:
+            from lib.capture_query import ReaderCache
+
+            self.capture_readers = ReaderCache()
+        return self.capture_readers.get(path)
+
+    def rebuild_catalog(self, full=False):
+        indexed = self.catalog.rebuild(full=full, exclude=self.recording_paths())
+        self._logger.info("Capture catalog updated, {} captures indexed".format(indexed))
+        return indexed
+
+    def start_profiling(self, duration=10.0):
+        """Profiles the capture and G-code threads for duration seconds, returns False if already running."""
+        from lib.profiling import SamplingProfiler
+
+        if self.profiler is not None and self.profiler.is_alive():
+            return False
+
+        folder = os.path.join(self.get_plugin_data_folder(), "profiles")
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        path = os.path.join(folder, "profile_" + time.strftime("%Y%m%d-%H%M%S", time.localtime()))
+        self.profiler = SamplingProfiler(self.profile_targets, path, duration=duration,
+                                         on_finished=self.on_profile_finished, logger=self._logger)
+        self.profiler.start()
+        self._logger.info("Profiling for {:.0f} s".format(self.profiler.duration))
+        return True
+
+    def stop_profiling(self):
+        if self.profiler is not None:
+            self.profiler.stop()
+
+    def profile_targets(self):
+        """The threads sampled by the profiler: capture acquisition and G-code runner."""
+        targets = dict()
+        mpu = self.mpu
+        if mpu is not None:
+            for thread in getattr(mpu, "workers", [mpu]):
+                targets[thread.name] = thread
+        if self.gcode_job is not None:
+            targets[self.gcode_job.name] = self.gcode_job
+        return targets
+
+    def profile_status(self):
+        profiler = self.profiler
+        if profiler is None:
+            return dict(running=False, files=[])
+        return dict(running=profiler.is_alive(), duration=profiler.duration, samples=profiler.samples,
+                    files=[os.path.basename(path) for path in profiler.files])
+
+    def on_profile_finished(self, profiler):
+        self._logger.info("Profile of {} samples written: {}".format(profiler.samples, ", ".join(profiler.files)))
+
+    def start_live_stream(self):
+        """Publishes the live envelope to the Shooting tab at a fixed frame rate."""
+        self.stop_live_stream()
+
+        frame_rate = max(1, self._settings.get_int(["live_frame_rate"]))
+        self.live_start_time = monotonic()
+        self.live_timer = RepeatedTimer(1.0 / frame_rate, self.send_live_frame, run_first=False)
+        self.live_timer.start()
+        self.update_ui()
+
+    def stop_live_stream(self):
+        if self.live_timer is not None:
+            self.live_timer.cancel()
+            self.live_timer = None
+            # flush what arrived after the last frame
+            self.send_live_frame()
+
+    def send_live_frame(self):
+        if self.live_envelope is None:
+            return
+
+        frame = self.live_envelope.pop_frame()
+        if frame is None:
+            return
+
+        frame["type"] = "live"
+        frame["time"] = round(monotonic() - self.live_start_time, 3)
+        self._plugin_manager.send_plugin_message(self._identifier, frame)
+
+    def send_notification(self, message, message_type="info"):
+        """Shows message in a notification of the web interface."""
+        self._plugin_manager.send_plugin_message(self._identifier, dict(is_msg=True, msg=message,
+                                                                        msg_type=message_type))
+
     def update_ui(self):
-        self.update_ui_current_temperature()
+        self.update_ui_capture_state()
 
-    def update_ui_current_temperature(self):
-        self._plugin_manager.send_plugin_message(self._identifier, dict(sensor_data=self.temperature_sensor_data))
+    def update_ui_capture_state(self):
+        axis = self.live_envelope.axis if self.live_envelope is not None else []
+        self._plugin_manager.send_plugin_message(self._identifier, dict(
+            type="capture",
+            capturing=self.capturing_vibration,
+            axis=axis,
+            frame_rate=self._settings.get_int(["live_frame_rate"]),
+            window=self._settings.get_int(["live_window"])
+        ))
 
 
 # If you want your plugin to be registered within OctoPrint under a different name than what you defined in setup.py
@@ -231,3 +860,6 @@ def __plugin_load__():
         "octoprint.comm.protocol.gcode.received": __plugin_implementation__.printer_message_received_hook,
         "octoprint.comm.protocol.gcode.error": __plugin_implementation__.printer_error_hook
     }
+
+
+IMPORT_SECONDS = time.time() - _import_start
@@ -0,0 +1,60 @@
+; Back and forth passes along one axis, recorded between the @MPU6050 markers.
+; The defaults reproduce vibration_test_1 (Prusa Mk2s volume: X 0-250; Y -3-210; Z 0-200).
+;
+; @param axis=Y swept axis
+; @param low=0 start of the passes
+; @param high=210 end of the passes
+; @param center=105 position where the recording starts and ends
+; @param cross_axis=X axis held still during the passes
+; @param cross_position=125 position of the held axis
+; @param z_lift=10 nozzle height during the test
+; @param feedrate=6000 mm/min
+; @param passes=19 back and forth passes after the first one
+; @param home=true home all axes first
+; @param record=true capture the passes with the MPU6050
+; @param marks=false MARK every pass in the capture, waits for the previous pass to end
+
+; @if home
+G28 ; go home
+; @end
+
+G90 ; use absolute positioning for the XYZ axes
+G1 F{feedrate} ; Set base speed
+G1 Z{z_lift} ; Goes up a little
+G1 {cross_axis}{cross_position} ; Center on the held axis
+
+G1 {axis}{low}
+G1 {axis}{center}
+M400 ; Wait finishing movements
+; @if record
+@MPU6050 START ; Start recording
+; @end
+
+; @if marks
+@MPU6050 MARK forward
+; @end
+G1 {axis}{high} ; first pass
+; @repeat passes
+; @if marks
+M400 ; the marker is handled when sent, wait for the move to start it in sync
+@MPU6050 MARK back
+; @end
+G1 {axis}{low} ; back pass
+; @if marks
+M400
+@MPU6050 MARK forward
+; @end
+G1 {axis}{high} ; end of pass
+; @end
+; @if marks
+M400
+@MPU6050 MARK end
+; @end
+
+G1 {axis}{center} ; return to center
+M400 ; Wait finishing movements
+; @if record
+@MPU6050 STOP ; Stop recording
+; @end
+
+G1 {axis}{low} ; keep moving to home
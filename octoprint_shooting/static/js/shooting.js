@@ -16,26 +16,25 @@ $(function () {
 
         self.currentUrl = ko.observable();
         self.plot = null; // plotly graph
+        self.plotlyLoading = null; // the charting bundle is only downloaded when the tab is first shown
         self.defaultColors = {
             background: '#ffffff',
             axises: '#000000'
         }
 
-        self.bindFromSettings = function () {
-            self.rpi_outputs(self.settingsViewModel.settings.plugins.enclosure.rpi_outputs());
-            self.rpi_inputs(self.settingsViewModel.settings.plugins.enclosure.rpi_inputs());
-            self.use_sudo(self.settingsViewModel.settings.plugins.enclosure.use_sudo());
-            self.gcode_control(self.settingsViewModel.settings.plugins.enclosure.gcode_control());
-            self.neopixel_dma(self.settingsViewModel.settings.plugins.enclosure.neopixel_dma());
-            self.debug(self.settingsViewModel.settings.plugins.enclosure.debug());
-            self.debug_temperature_log(self.settingsViewModel.settings.plugins.enclosure.debug_temperature_log());
-            self.use_board_pin_number(self.settingsViewModel.settings.plugins.enclosure.use_board_pin_number());
-            self.filament_sensor_gcode(self.settingsViewModel.settings.plugins.enclosure.filament_sensor_gcode());
-            self.notification_provider(self.settingsViewModel.settings.plugins.enclosure.notification_provider());
-            self.notification_event_name(self.settingsViewModel.settings.plugins.enclosure.notification_event_name());
-            self.notification_api_key(self.settingsViewModel.settings.plugins.enclosure.notification_api_key());
-            self.notifications(self.settingsViewModel.settings.plugins.enclosure.notifications());
-        };
+        // live capture stream
+        self.capturing = ko.observable(false);
+        self.liveAxis = [];
+        self.liveFrameRate = 10; // frames per second, sent by the backend
+        self.liveWindow = 30; // seconds kept on the chart
+        self.liveSamples = ko.observable(0);
+
+        // background G-code script
+        self.scriptProgress = ko.observable(null);
+        self.scriptActive = ko.pureComputed(function () {
+            var progress = self.scriptProgress();
+            return progress != null && (progress.state == "running" || progress.state == "paused");
+        });
 
         // Called when the first initialization has been done. All view models are constructed and hence their
         // dependencies resolved, no bindings have been done yet.
@@ -44,11 +43,7 @@ $(function () {
         // This will get called before the ShootingViewModel gets bound to the DOM, but after its dependencies have
         // already been initialized. It is especially guaranteed that this method gets called _after_ the settings
         // have been retrieved from the OctoPrint backend and thus the SettingsViewModel been properly populated.
-        self.onBeforeBinding = function () {
-            self.bindFromSettings();
-            self.newUrl(self.settingsViewModel.settings.plugins.shooting.url());
-            self.goToUrl();
-        }
+        // self.onBeforeBinding = function() {}
 
         // Called per view model after binding it to its binding targets.
         // self.onAfterBinding = function() {}
@@ -61,22 +56,36 @@ $(function () {
             self.settingsOpen = false;
 
             self.plot = document.getElementById("plotLy");
+            self.liveAxis = ["X", "Y", "Z"];
+        }
 
-            // data [{},{}]
-            data = [{
-                type: 'scatter',
-                x: [1, 2, 3, 4, 5],
-                y: [1, 2, 4, 8, 16],
-                name: 'data',
-                marker: {         // marker is an object, valid marker keys: #scatter-marker
-                    color: 'rgb(255, 0, 0)' // more about "marker.color": #scatter-marker-color
-                }
-            }];
+        // loads plotly once, the load time is logged to the browser console
+        self.loadPlotly = function () {
+            if (self.plotlyLoading == null) {
+                var started = performance.now();
+                self.plotlyLoading = $.ajax({
+                    url: PLUGIN_BASEURL + "shooting/static/js/plotly-latest.min.js",
+                    dataType: "script",
+                    cache: true
+                }).done(function () {
+                    console.log("Shooting: charts loaded in " + Math.round(performance.now() - started) + " ms");
+                    self.resetLivePlot(self.liveAxis);
+                }).fail(function () {
+                    self.plotlyLoading = null;
+                });
+            }
+            return self.plotlyLoading;
+        };
 
-            layout = {
-                title: 'Simple Chart',
+        self.plotReady = function () {
+            return self.plot != null && typeof Plotly != 'undefined';
+        };
+
+        self.liveLayout = function () {
+            return {
+                title: 'Vibration',
                 xaxis: {
-                    title: 'time',
+                    title: 'time (s)',
                     type: 'linear',
                     rangemode: 'nonnegative',
                     showgrid: true,
@@ -94,32 +103,79 @@ $(function () {
                     mirror: true,
                     color: self.defaultColors.axises
                 },
+                yaxis2: {
+                    title: 'rotation (&deg;/s)',
+                    type: 'linear',
+                    overlaying: 'y',
+                    side: 'right',
+                    showgrid: false,
+                    color: self.defaultColors.axises
+                },
                 autosize: true,
                 height: self.plot.clientHeight,
                 width: 588, //self.plot.clientWidth,
-                margin: {l: 50, r: 30, b: 50, t: 30},
+                margin: {l: 50, r: 50, b: 50, t: 30},
                 showlegend: true,
                 hovermode: 'x',
                 paper_bgcolor: self.defaultColors.background,
                 plot_bgcolor: self.defaultColors.background
             };
+        };
 
-            Plotly.plot(self.plot, data, layout);
-
-            // // update plot
-            // if (self.plot) {
-            //     var tracesToUpdate = []; // [0,1,2,3,...]
-            //     for (var i = 0; i < newData.x.length; i++) {
-            //         tracesToUpdate.push(i);
-            //     }
-            //
-            //     // update layout
-            //     Plotly.extendTraces(self.plot, newData, tracesToUpdate, result.length)
-            // }
-
-            // change colors, etc
-            // Plotly.relayout(self.plot, relayout);
-        }
+        // one trace per axis, gyro axes on the right y axis
+        self.resetLivePlot = function (axis) {
+            self.liveAxis = axis.slice();
+            self.liveSamples(0);
+
+            if (!self.plotReady()) {
+                return;
+            }
+
+            var data = axis.map(function (name) {
+                return {
+                    type: 'scatter',
+                    mode: 'lines',
+                    x: [],
+                    y: [],
+                    name: name,
+                    yaxis: name.charAt(0) == 'G' ? 'y2' : 'y'
+                };
+            });
+
+            Plotly.newPlot(self.plot, data, self.liveLayout());
+        };
+
+        // every frame holds the min/max envelope of each axis since the previous frame
+        self.appendLiveFrame = function (frame) {
+            if (!self.plotReady()) {
+                // the tab was never shown, the chart starts with the frames after it is
+                self.liveAxis = frame.axis.slice();
+                self.liveSamples(self.liveSamples() + frame.samples);
+                return;
+            }
+
+            if (self.liveAxis.join() != frame.axis.join()) {
+                self.resetLivePlot(frame.axis);
+            }
+
+            var update = {x: [], y: []};
+            var traces = [];
+            frame.axis.forEach(function (name, index) {
+                update.x.push([frame.time, frame.time]);
+                update.y.push([frame.min[index], frame.max[index]]);
+                traces.push(index);
+            });
+
+            // bounded window, two points per frame
+            var maxPoints = Math.ceil(self.liveWindow * self.liveFrameRate * 2);
+            Plotly.extendTraces(self.plot, update, traces, maxPoints);
+            self.liveSamples(self.liveSamples() + frame.samples);
+        };
+
+        self.controlScript = function (action) {
+            OctoPrint.postJson(OctoPrint.getBlueprintUrl("shooting") + "gcode/" + action, {})
+                .done(self.scriptProgress);
+        };
 
         // Called if a disconnect from the server is detected.
         // self.onServerDisconnect = function() {}
@@ -157,90 +213,21 @@ $(function () {
                 return;
             }
 
-            if (data.hasOwnProperty("sensor_data")) {
-                data.sensor_data.forEach(function (sensor_data) {
-                    var linked_temp_sensor = ko.utils.arrayFilter(self.rpi_inputs_temperature_sensors(), function (temperature_sensor) {
-                        return (sensor_data['index_id'] == temperature_sensor.index_id());
-                    }).pop();
-                    if (linked_temp_sensor) {
-                        linked_temp_sensor.temp_sensor_temp(sensor_data['temperature'])
-                        linked_temp_sensor.temp_sensor_humidity(sensor_data['humidity'])
-                    }
-                })
-            }
-
-            if (data.hasOwnProperty("set_temperature")) {
-                data.set_temperature.forEach(function (set_temperature) {
-                    var linked_temp_control = ko.utils.arrayFilter(self.rpi_outputs(), function (temp_control) {
-                        return (set_temperature['index_id'] == temp_control.index_id());
-                    }).pop();
-                    if (linked_temp_control) {
-                        linked_temp_control.temp_ctr_set_value(set_temperature['set_temperature'])
-                    }
-                })
-            }
-
-            if (data.hasOwnProperty("rpi_output_regular")) {
-                data.rpi_output_regular.forEach(function (output) {
-                    var linked_output = ko.utils.arrayFilter(self.rpi_outputs(), function (item) {
-                        return (output['index_id'] == item.index_id());
-                    }).pop();
-                    if (linked_output) {
-                        linked_output.gpio_status(output['status'])
-                        linked_output.auto_shutdown(output['auto_shutdown'])
-                        linked_output.auto_startup(output['auto_startup'])
-                    }
-                })
-            }
-
-            if (data.hasOwnProperty("rpi_output_temp_hum_ctrl")) {
-                data.rpi_output_temp_hum_ctrl.forEach(function (output) {
-                    var linked_output = ko.utils.arrayFilter(self.rpi_outputs(), function (item) {
-                        return (output['index_id'] == item.index_id());
-                    }).pop();
-                    if (linked_output) {
-                        linked_output.gpio_status(output['status'])
-                        linked_output.auto_shutdown(output['auto_shutdown'])
-                        linked_output.auto_startup(output['auto_startup'])
-                    }
-                })
-            }
-
-            if (data.hasOwnProperty("rpi_output_pwm")) {
-                data.rpi_output_pwm.forEach(function (output) {
-                    var linked_output = ko.utils.arrayFilter(self.rpi_outputs(), function (item) {
-                        return (output['index_id'] == item.index_id());
-                    }).pop();
-                    if (linked_output) {
-                        linked_output.duty_cycle(output['pwm_value'])
-                        linked_output.auto_shutdown(output['auto_shutdown'])
-                        linked_output.auto_startup(output['auto_startup'])
-                    }
-                })
+            if (data.type == "capture") {
+                self.liveFrameRate = data.frame_rate || self.liveFrameRate;
+                self.liveWindow = data.window || self.liveWindow;
+                if (data.capturing && !self.capturing()) {
+                    self.resetLivePlot(data.axis);
+                }
+                self.capturing(data.capturing);
             }
 
-            if (data.hasOwnProperty("rpi_output_neopixel")) {
-                data.rpi_output_neopixel.forEach(function (output) {
-                    var linked_output = ko.utils.arrayFilter(self.rpi_outputs(), function (item) {
-                        return (output['index_id'] == item.index_id());
-                    }).pop();
-                    if (linked_output) {
-                        linked_output.neopixel_color(output['color'])
-                        linked_output.auto_shutdown(output['auto_shutdown'])
-                        linked_output.auto_startup(output['auto_startup'])
-                    }
-                })
+            if (data.type == "live") {
+                self.appendLiveFrame(data);
             }
 
-            if (data.hasOwnProperty("filament_sensor_status")) {
-                data.filament_sensor_status.forEach(function (filament_sensor) {
-                    var linked_filament_sensor = ko.utils.arrayFilter(self.rpi_inputs(), function (item) {
-                        return (filament_sensor['index_id'] == item.index_id());
-                    }).pop();
-                    if (linked_filament_sensor) {
-                        linked_filament_sensor.filament_sensor_enabled(filament_sensor['filament_sensor_enabled'])
-                    }
-                })
+            if (data.type == "gcode") {
+                self.scriptProgress(data);
             }
 
             if (data.is_msg) {
@@ -264,7 +251,12 @@ $(function () {
         // self.onTabChange(next, current) = function() {}
         // Called after the main tab view switches to a new tab, so after the new tab becomes visible. Called with the
         // current and previous tab’s hash (e.g. #control).
-        // self.onAfterTabChange(current, previous) = function() {}
+        self.onAfterTabChange = function (current, previous) {
+            if (current == "#tab_plugin_shooting") {
+                self.loadPlotly();
+            }
+        };
+
         // Your view model may return additional custom control definitions for inclusion on the “Control” tab of
         // OctoPrint’s interface. See the custom control feature.
         // self.getAdditionalControls() = function() {}
@@ -281,9 +273,7 @@ $(function () {
 
         // Called just before the settings view model is sent to the server. This is useful, for example, if your plugin
         // needs to compute persisted settings from a custom view model.
-        self.onSettingsBeforeSave = function () {
-            self.bindFromSettings();
-        }
+        // self.onSettingsBeforeSave = function() {}
 
         // Called when the user settings dialog is shown.
         // self.onUserSettingsShown = function() {}
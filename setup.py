@@ -35,7 +35,7 @@ plugin_url = "https://github.com/franzbischoff/OctoPrint-Shooting"
 plugin_license = "AGPLv3"
 
 # Any additional requirements besides OctoPrint should be listed here
-plugin_requires = ["pysmbus>=0.1"]  # ["RPi.GPIO>=0.6"]
+plugin_requires = ["pysmbus>=0.1", "numpy"]  # ["RPi.GPIO>=0.6"]
 
 ### --------------------------------------------------------------------------------------------------------------------
 ### More advanced options that you usually shouldn't have to touch follow after this point